@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Benchmark the bin/ scripts on synthetic cohorts, offline.
+
+Generates signatures of samples in groups, and peptide fastas, of the given
+sizes, then times each stage and records its peak memory as traced by
+tracemalloc. That includes NumPy arrays, but not memory allocated by
+sourmash's Rust extension, so the maximum resident set size of the whole
+run is saved too. Stages are:
+
+- load_sketches: sourmash_utils.load_sketches
+- load_sketch_arrays: sourmash_utils.load_sketch_arrays without cache
+- load_sketch_arrays_cold_cache / load_sketch_arrays_warm_cache
+- make_matrix: differential_hash_expression.get_training_data, first group vs
+  the rest
+- fit: differential_hash_expression.differential_hash_expression
+- write_coefficients: differential_hash_expression.write_hash_coefficients
+- kmer_scanning: hash2kmer.iter_matching_kmers, with --processes workers
+
+Results are saved as JSON. With --baseline, the minimum times of each stage
+are compared to those of a previous results file.
+
+    python benchmarks/benchmark.py --samples 300 --output after.json \\
+        --baseline before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import sklearn
+import sourmash
+from sourmash import MinHash, SourmashSignature
+from sencha.sequence_encodings import encode_peptide
+
+BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                   'bin')
+sys.path.insert(0, BIN)
+
+import differential_hash_expression  # noqa: E402
+import hash2kmer  # noqa: E402
+import sourmash_utils  # noqa: E402
+
+AMINO_ACIDS = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+KSIZE = 45
+MOLECULE = 'dayhoff'
+
+
+def make_signatures(folder, n_samples, n_groups, hashes_per_sample,
+                    fraction_group_specific, rng):
+    """Write one signature per sample, returns filenames and groups
+
+    Every group has its own pool of hashes that fraction_group_specific of
+    the hashes of its samples are drawn from, the rest are drawn from a pool
+    shared by all groups. Abundances are random.
+    """
+    n_specific = int(hashes_per_sample * fraction_group_specific)
+    n_shared = hashes_per_sample - n_specific
+    max_hash = np.iinfo(np.uint64).max
+    shared_pool = rng.integers(1, max_hash, 4 * n_shared, dtype=np.uint64,
+                               endpoint=True)
+    group_pools = [rng.integers(1, max_hash, 2 * n_specific, dtype=np.uint64,
+                                endpoint=True) for _ in range(n_groups)]
+
+    filenames = []
+    groups = []
+    for i in range(n_samples):
+        group = i % n_groups
+        hashes = np.concatenate([
+            rng.choice(shared_pool, n_shared, replace=False),
+            rng.choice(group_pools[group], n_specific, replace=False)])
+        abundances = rng.integers(1, 100, len(hashes))
+
+        minhash = MinHash(n=0, ksize=KSIZE, scaled=1, is_protein=False,
+                          dayhoff=True, track_abundance=True)
+        minhash.set_abundances(dict(zip(hashes.tolist(),
+                                        abundances.tolist())))
+        name = f'group{group}_sample{i}'
+        filename = os.path.join(folder, f'{name}.sig')
+        with open(filename, 'w') as f:
+            sourmash.save_signatures(
+                [SourmashSignature(minhash, name=name)], f)
+        filenames.append(filename)
+        groups.append(f'group{group}')
+    return filenames, groups
+
+
+def make_fastas(folder, n_files, n_records, protein_length, n_query_hashes,
+                rng):
+    """Write random peptide fastas, returns filenames and hashes of k-mers
+    sampled from them"""
+    ksize = hash2kmer.revise_ksize(KSIZE, MOLECULE, input_is_protein=True)
+    filenames = []
+    query_hashes = set()
+    for i in range(n_files):
+        filename = os.path.join(folder, f'peptides{i}.fasta')
+        with open(filename, 'w') as f:
+            for j in range(n_records):
+                sequence = ''.join(rng.choice(AMINO_ACIDS, protein_length))
+                f.write(f'>peptides{i}_record{j}\n{sequence}\n')
+
+                # Query the hash of a random k-mer of some records
+                if rng.random() < n_query_hashes / (n_files * n_records):
+                    start = rng.integers(0, protein_length - ksize + 1)
+                    kmer = encode_peptide(sequence[start:start + ksize],
+                                          MOLECULE)
+                    windows = np.frombuffer(kmer.encode(), dtype=np.uint8)
+                    query_hashes.add(int(sourmash_utils.hash_murmur_many(
+                        windows[np.newaxis, :])[0]))
+        filenames.append(filename)
+    return filenames, np.array(sorted(query_hashes), dtype=np.uint64)
+
+
+def run_stage(results, name, function, repeats, trace_memory):
+    """Time repeats runs of function, and record the peak traced memory
+
+    Returns the result of the last run
+    """
+    seconds = []
+    peak = 0
+    for _ in range(repeats):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+        if trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    results[name] = dict(seconds=seconds, min_seconds=min(seconds),
+                         peak_memory_bytes=peak if trace_memory else None)
+    print(f'{name}: {min(seconds):.3f} s'
+          + (f', {peak / 1024 ** 2:.1f} MiB' if trace_memory else ''),
+          file=sys.stderr)
+    return result
+
+
+def run_benchmarks(args, folder):
+    rng = np.random.default_rng(args.seed)
+    sig_folder = os.path.join(folder, 'signatures')
+    fasta_folder = os.path.join(folder, 'fastas')
+    os.makedirs(sig_folder)
+    os.makedirs(fasta_folder)
+
+    print('Generating synthetic cohort', file=sys.stderr)
+    sig_filenames, groups = make_signatures(
+        sig_folder, args.samples, args.groups, args.hashes_per_sample,
+        args.fraction_group_specific, rng)
+    fasta_filenames, query_hashes = make_fastas(
+        fasta_folder, args.fasta_files, args.fasta_records,
+        args.protein_length, args.query_hashes, rng)
+
+    results = {}
+    repeats = args.repeats
+    trace_memory = not args.no_memory
+
+    run_stage(results, 'load_sketches',
+              lambda: sourmash_utils.load_sketches(sig_filenames, KSIZE,
+                                                   MOLECULE),
+              repeats, trace_memory)
+    sketches = run_stage(
+        results, 'load_sketch_arrays',
+        lambda: sourmash_utils.load_sketch_arrays(sig_filenames, KSIZE,
+                                                  MOLECULE),
+        repeats, trace_memory)
+
+    cache_dirs = iter(range(repeats))
+    run_stage(results, 'load_sketch_arrays_cold_cache',
+              lambda: sourmash_utils.load_sketch_arrays(
+                  sig_filenames, KSIZE, MOLECULE,
+                  cache_dir=os.path.join(folder, f'cache{next(cache_dirs)}')),
+              repeats, trace_memory)
+    run_stage(results, 'load_sketch_arrays_warm_cache',
+              lambda: sourmash_utils.load_sketch_arrays(
+                  sig_filenames, KSIZE, MOLECULE,
+                  cache_dir=os.path.join(folder, 'cache0')),
+              repeats, trace_memory)
+
+    sigs1 = [s for s, group in zip(sketches, groups) if group == 'group0']
+    sigs2 = [s for s, group in zip(sketches, groups) if group != 'group0']
+    X, y, hashes = run_stage(
+        results, 'make_matrix',
+        lambda: differential_hash_expression.get_training_data(
+            sigs1, sigs2, with_abundance=args.with_abundance),
+        repeats, trace_memory)
+    coefficients = run_stage(
+        results, 'fit',
+        lambda: differential_hash_expression.differential_hash_expression(
+            X, y, C=args.inverse_regularization_strength,
+            n_jobs=args.processes),
+        repeats, trace_memory)
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        run_stage(results, 'write_coefficients',
+                  lambda: differential_hash_expression.write_hash_coefficients(
+                      coefficients, hashes, 'group0', threshold=0),
+                  repeats, trace_memory)
+    finally:
+        os.chdir(cwd)
+
+    n_kmers = run_stage(
+        results, 'kmer_scanning',
+        lambda: sum(len(kmers) for _, _, _, kmers in
+                    hash2kmer.iter_matching_kmers(
+                        fasta_filenames, query_hashes, KSIZE, MOLECULE,
+                        input_is_protein=True, processes=args.processes)),
+        repeats, trace_memory)
+
+    counts = dict(signatures=len(sketches), matrix_shape=list(X.shape),
+                  matrix_nnz=int(X.nnz),
+                  nonzero_coefficients=int(np.count_nonzero(coefficients)),
+                  query_hashes=len(query_hashes), kmers_found=n_kmers,
+                  # Kilobytes on Linux
+                  max_rss_bytes=resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss * 1024)
+    return results, counts
+
+
+def compare_to_baseline(results, baseline):
+    print(f'{"stage":<32}{"baseline s":>12}{"current s":>12}{"ratio":>8}',
+          file=sys.stderr)
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['min_seconds']
+        after = result['min_seconds']
+        print(f'{name:<32}{before:>12.3f}{after:>12.3f}'
+              f'{after / before if before else float("nan"):>8.2f}',
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--samples', type=int, default=60)
+    parser.add_argument('--groups', type=int, default=3)
+    parser.add_argument('--hashes-per-sample', type=int, default=5000)
+    parser.add_argument('--fraction-group-specific', type=float, default=0.3,
+                        help='fraction of the hashes of each sample drawn '
+                             'from hashes specific to its group')
+    parser.add_argument('--with-abundance', action='store_true',
+                        help='use abundances as features')
+    parser.add_argument('--fasta-files', type=int, default=2)
+    parser.add_argument('--fasta-records', type=int, default=2000,
+                        help='number of records per fasta')
+    parser.add_argument('--protein-length', type=int, default=300)
+    parser.add_argument('--query-hashes', type=int, default=100,
+                        help='approximate number of hashes to scan the '
+                             'fastas for')
+    parser.add_argument('-C', '--inverse-regularization-strength', type=float,
+                        default=0.1,
+                        help='C of the logistic regression, same default as '
+                             'the pipeline')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='processes for fitting and k-mer scanning')
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true',
+                        help="don't trace memory, which slows down stages "
+                             "allocating many Python objects")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON file to save results to')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of a previous run to compare to')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        results, counts = run_benchmarks(args, folder)
+
+    parameters = {key: value for key, value in vars(args).items()
+                  if key not in ('output', 'baseline')}
+    environment = dict(python=platform.python_version(),
+                       platform=platform.platform(),
+                       cpu_count=os.cpu_count(), numpy=np.__version__,
+                       sklearn=sklearn.__version__,
+                       sourmash=sourmash.VERSION)
+    with open(args.output, 'w') as f:
+        json.dump(dict(parameters=parameters, environment=environment,
+                       counts=counts, results=results), f, indent=2)
+    print(f'Wrote {args.output}', file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_to_baseline(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+"""
+Combine the coefficients of all groups into one hash, group, coefficient table.
+
+    combine_hash_coefficients.py --output hash_group_coefficients.csv \
+        *__hash_coefficients.npz
+
+Reads the "<group>__hash_coefficients.npz" files written by
+differential_hash_expression.py, and writes one row per nonzero coefficient
+(or informative hash) of every group, sorted by hash then group, with the
+columns hash, group, coefficient and informative (1 if the hash is an
+informative hash of the group, else 0). With --informative-only, only the
+informative hashes are written.
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Local file
+from sourmash_utils import error, notify
+
+COLUMNS = ['hash', 'group', 'coefficient', 'informative']
+
+
+def load_coefficients(filename):
+    """Read the coefficients saved by save_coefficients_npz as a DataFrame"""
+    with np.load(filename) as npz:
+        return pd.DataFrame({
+            'hash': npz['hashes'],
+            'group': str(npz['group']),
+            'coefficient': npz['coefficients'],
+            'informative': npz['informative'].astype(np.int8),
+        }, columns=COLUMNS)
+
+
+def combine_coefficients(filenames, informative_only=False):
+    tables = [load_coefficients(filename) for filename in filenames]
+    table = pd.concat(tables, ignore_index=True) if tables \
+        else pd.DataFrame(columns=COLUMNS)
+    if informative_only:
+        table = table[table['informative'] == 1]
+    return table.sort_values(['hash', 'group'], kind='mergesort')
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('coefficients', nargs='+',
+                   help='"<group>__hash_coefficients.npz" files')
+    p.add_argument('-o', '--output', default='hash_group_coefficients.csv',
+                   help='CSV file to write the combined table to')
+    p.add_argument('--informative-only', action='store_true',
+                   help='only write the informative hashes of each group')
+    args = p.parse_args()
+
+    table = combine_coefficients(args.coefficients,
+                                 informative_only=args.informative_only)
+    if table.empty:
+        error("ERROR, no coefficients loaded from {} files!",
+              len(args.coefficients))
+        return -1
+
+    table.to_csv(args.output, index=False)
+    notify('wrote {} coefficients of {} groups to {}', len(table),
+           table['group'].nunique(), args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
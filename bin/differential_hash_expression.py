@@ -2,50 +2,150 @@
 from __future__ import print_function
 
 import argparse
-import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
 from collections import defaultdict
-from itertools import groupby
+from contextlib import contextmanager
+import hashlib
+import json
 import os
+import sys
+import tempfile
+import time
 
 import numpy as np
-import pandas as pd
-from pathvalidate import sanitize_filename
-import screed
-from sklearn.linear_model import LogisticRegression
-from sourmash.cli.utils import add_construct_moltype_args
-from sourmash.sourmash_args import calculate_moltype
-from tqdm import tqdm
+# pandas, scipy, sklearn and pathvalidate are imported where they are used,
+# as importing them takes seconds
 
 # Local file
 import sourmash_utils
+from sourmash_utils import (add_construct_moltype_args, calculate_moltype,
+                            error, profiler)
 
 MAX_GROUP_SIZE = 100
 GROUP = 'group'
 SIG = 'sig'
 FASTA = 'fasta'
 
+# Prefix of the output files of every group, written when fitting all groups
+GROUP_FILE_PREFIXES_CSV = 'group_file_prefixes.csv'
+
+
+# Univariate statistics to prescreen hashes with before fitting
+PRESCREEN_STATISTICS = 'chi2', 'fisher', 'fraction'
+PRESCREEN_STATISTIC = 'chi2'
+
+
+# Sparse-preserving transforms of hash abundances, see transform_abundances
+ABUNDANCE_TRANSFORMS = 'log1p', 'total', 'tfidf', 'maxabs'
+
+
+# Minimum Jaccard similarity of the presence of a hash to that of a hash
+# flagged by the coarse fit, to refit it at full resolution
+COARSE_MIN_SIMILARITY = 0.5
+
+# Hashes per chunk when comparing presence to that of the flagged hashes
+SIMILARITY_CHUNK_SIZE = 100000
+
 
 # Default backend for scikit-learn logistic regression
 PENALTY = 'l1'
 SOLVER = 'saga'
 
 
+# Score of the cross-validated selection of C on the regularization path.
+# Balanced like the class weights, as group1 is usually much smaller than the
+# rest
+CV_SCORING = 'balanced_accuracy'
+
+
+# Signature files per chunk, and passes over all signatures, of --streaming
+CHUNK_SIZE = 1000
+EPOCHS = 5
+
+
+# Bump when the fits or the format of --cache-results entries change
+RESULT_CACHE_VERSION = 1
+
+
 # Create a logger
 logging.basicConfig(format='%(name)s - %(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.INFO)
 
 
-def make_hash_df(sigs, with_abundance=False):
-    if with_abundance:
-        records = {x.name(): x.minhash.get_mins(with_abundance=with_abundance)
-                   for x in sigs}
+def get_hashes_and_values(sketch, with_abundance=False):
+    """Get sorted uint64 hash values and their abundances (or 1s) of a sketch
+
+    sketch is a sourmash_utils.SketchArrays
+    """
+    if with_abundance and sketch.abundances is not None:
+        values = np.asarray(sketch.abundances, dtype=np.float64)
     else:
         # Set value of each hash abundance to 1
-        records = {x.name(): dict.fromkeys(x.minhash.get_mins(with_abundance=with_abundance), 1)
-                   for x in sigs}
-    return pd.DataFrame(records)
+        values = np.ones(len(sketch.hashes), dtype=np.float64)
+    return sketch.hashes, values
+
+
+def make_hash_matrix(sigs, with_abundance=False):
+    """Create sparse (n_signatures, n_hashes) CSR matrix of hash abundances
+
+    sigs are sourmash_utils.SketchArrays
+
+    Returns
+    -------
+    X : scipy.sparse.csr_matrix
+        Rows are signatures in the order given, columns are hashes
+    hashes : numpy.ndarray
+        Sorted uint64 hash values corresponding to the columns of X
+    """
+    from scipy import sparse
+    hashes_per_sig = []
+    values_per_sig = []
+    for sig in sigs:
+        sig_hashes, sig_values = get_hashes_and_values(sig, with_abundance)
+        hashes_per_sig.append(sig_hashes)
+        values_per_sig.append(sig_values)
+
+    if not hashes_per_sig:
+        return sparse.csr_matrix((0, 0)), np.array([], dtype=np.uint64)
+
+    # Column vocabulary is the sorted, unique set of hashes across all
+    # signatures, and the inverse gives the column of every stored value
+    hashes, columns = np.unique(np.concatenate(hashes_per_sig),
+                                return_inverse=True)
+    indptr = np.zeros(len(hashes_per_sig) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in hashes_per_sig], out=indptr[1:])
+
+    X = sparse.csr_matrix(
+        (np.concatenate(values_per_sig), columns.ravel(), indptr),
+        shape=(len(hashes_per_sig), len(hashes)))
+    return X, hashes
+
+
+def make_hash_matrix_with_vocabulary(sigs, vocabulary, with_abundance=False):
+    """Create sparse (n_signatures, len(vocabulary)) CSR matrix of hash abundances
+
+    Columns are the sorted uint64 hashes of vocabulary, which must contain
+    every hash of sigs, so that matrices of different signatures share the
+    same columns
+    """
+    from scipy import sparse
+    hashes_per_sig = []
+    values_per_sig = []
+    for sig in sigs:
+        sig_hashes, sig_values = get_hashes_and_values(sig, with_abundance)
+        hashes_per_sig.append(sig_hashes)
+        values_per_sig.append(sig_values)
+
+    indptr = np.zeros(len(hashes_per_sig) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in hashes_per_sig], out=indptr[1:])
+    columns = np.searchsorted(
+        vocabulary,
+        np.concatenate(hashes_per_sig + [np.array([], dtype=np.uint64)]))
+    values = np.concatenate(values_per_sig + [np.array([], dtype=np.float64)])
+    return sparse.csr_matrix((values, columns, indptr),
+                             shape=(len(hashes_per_sig), len(vocabulary)))
 
 
 def make_target_vector(n_group1, n_group2):
@@ -54,31 +154,233 @@ def make_target_vector(n_group1, n_group2):
     return y_target
 
 
-def get_training_data(sigs1, sigs2, with_abundance=False, verbose=False):
-    """Create X feature matrix and y target vector for machine learning"""
+def transform_abundances(X, transform):
+    """Rescale the abundances of the feature matrix, keeping it sparse
 
-    # Create pandas dataframe of hash abundances
-    hash_df1 = make_hash_df(sigs1, with_abundance=with_abundance)
-    logger.info(f"Group1 hash dataframe head: {hash_df1.head()}")
+    Raw hash counts span orders of magnitude, and the saga solver only
+    converges fast on features of similar scale. All transforms map zeros to
+    zeros, so only the stored values change:
 
-    hash_df2 = make_hash_df(sigs2, with_abundance=with_abundance)
-    logger.info(f"Group2 hash dataframe head: {hash_df2.head()}")
+    - log1p: log(1 + abundance), damping very abundant hashes
+    - total: divide each sample by its total abundance, times the median
+      total of all samples, for samples sequenced to different depths
+    - tfidf: abundance times the inverse document frequency of the hash,
+      each sample scaled to unit length, as by scikit-learn's
+      TfidfTransformer
+    - maxabs: divide each hash by its maximum abundance, as by
+      scikit-learn's MaxAbsScaler, so that all values are in [0, 1]
+    """
+    from scipy import sparse
+    if transform is None:
+        return X
+    with profiler.stage('transform_abundances'):
+        X = sparse.csr_matrix(X, dtype=np.float64, copy=True)
+        if transform == 'log1p':
+            np.log1p(X.data, out=X.data)
+        elif transform == 'total':
+            totals = np.asarray(X.sum(axis=1)).ravel()
+            nonempty = totals > 0
+            target = np.median(totals[nonempty]) if nonempty.any() else 1
+            scale = np.divide(target, totals, out=np.zeros_like(totals),
+                              where=nonempty)
+            X.data *= np.repeat(scale, np.diff(X.indptr))
+        elif transform == 'tfidf':
+            from sklearn.feature_extraction.text import TfidfTransformer
+            X = TfidfTransformer().fit_transform(X).tocsr()
+        elif transform == 'maxabs':
+            from sklearn.preprocessing import maxabs_scale
+            X = maxabs_scale(X).tocsr()
+        else:
+            raise ValueError(f'Unknown abundance transform: {transform}, '
+                             f'choose one of {ABUNDANCE_TRANSFORMS}')
+    logger.info(f'Transformed abundances with {transform}, values range '
+                f'from {X.data.min() if X.nnz else 0:.3g} to '
+                f'{X.data.max() if X.nnz else 0:.3g}')
+    return X
 
-    logger.info(f'Number of hashes in group1: {len(hash_df1.index)}')
-    logger.info(f'Number of hashes in group2: {len(hash_df2.index)}')
 
-    # Concatenate to make feature matrix
-    hash_df = pd.concat([hash_df1, hash_df2], axis=1)
-    X = hash_df.T
-    X = X.fillna(0)
+def get_training_data(sigs1, sigs2, with_abundance=False,
+                      abundance_transform=None, verbose=False):
+    """Create sparse X feature matrix, y target vector and hash ids of columns
+
+    Group1 signatures are the first rows of X, followed by group2 signatures.
+    With abundance_transform, the abundances are rescaled by
+    transform_abundances.
+    """
+    with profiler.stage('make_matrix'):
+        X, hashes = make_hash_matrix(list(sigs1) + list(sigs2),
+                                     with_abundance=with_abundance)
+    profiler.count('hashes', X.shape[1])
+    profiler.count('nonzero_entries', X.nnz)
+    X = transform_abundances(X, abundance_transform)
+
+    n_group1 = len(sigs1)
+    n_hashes1 = np.count_nonzero(X[:n_group1].getnnz(axis=0))
+    n_hashes2 = np.count_nonzero(X[n_group1:].getnnz(axis=0))
+    logger.info(f'Number of hashes in group1: {n_hashes1}')
+    logger.info(f'Number of hashes in group2: {n_hashes2}')
+    logger.info(f'Feature matrix: {X.shape[0]} samples x {X.shape[1]} hashes, '
+                f'{X.nnz} nonzero entries')
 
     # Create target vector "group1" is 1s and everything else is 0
-    y_target = make_target_vector(len(sigs1), len(sigs2))
+    y_target = make_target_vector(n_group1, len(sigs2))
+
+    return X, y_target, hashes
 
-    return X, y_target
 
+def collapse_identical_columns(X):
+    """Keep one column of every set of columns with the same nonzero rows
 
-def differential_hash_expression(sigs1, sigs2, with_abundance=False, verbose=False,
+    Hashes of the same protein are often present in exactly the same
+    samples, which makes them perfectly collinear presence/absence features.
+    Columns are grouped by their number of nonzero rows and two sums of
+    random 64-bit weights of their nonzero rows, a 128-bit hash of the
+    pattern, and the first column of each group is kept.
+
+    Returns
+    -------
+    X : scipy.sparse.csr_matrix
+        The kept columns, in their original order
+    members : numpy.ndarray
+        Index of the kept column of every column of X, so that
+        coefficients[members] are the coefficients of all columns
+    """
+    with profiler.stage('collapse_columns'):
+        X_csc = X.tocsc()
+        random_state = np.random.RandomState(0)
+        patterns = [np.diff(X_csc.indptr).astype(np.uint64)]
+        for _ in range(2):
+            weights = random_state.randint(
+                np.iinfo(np.uint64).max, size=X.shape[0], dtype=np.uint64)
+            # Sums wrap around, and don't depend on the order of the rows
+            cumsum = np.zeros(X_csc.nnz + 1, dtype=np.uint64)
+            np.cumsum(weights[X_csc.indices], out=cumsum[1:])
+            patterns.append(cumsum[X_csc.indptr[1:]]
+                            - cumsum[X_csc.indptr[:-1]])
+
+        _, first, inverse = np.unique(np.column_stack(patterns), axis=0,
+                                      return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        members = rank[inverse.ravel()]
+        X = X_csc[:, first[order]].tocsr()
+
+    profiler.count('hashes_after_collapse', X.shape[1])
+    logger.info(f'Collapsed {len(members)} hashes into {X.shape[1]} '
+                f'distinct presence patterns')
+    return X, members
+
+
+def presence_counts(X, y):
+    """Number of group1 (y == 1) and group2 samples in which each hash is present"""
+    y = np.asarray(y)
+    n_present1 = X[y == 1].getnnz(axis=0)
+    n_present2 = X[y == 0].getnnz(axis=0)
+    return n_present1, n_present2
+
+
+def univariate_scores(X, y, statistic=PRESCREEN_STATISTIC):
+    """Score every hash on presence/absence in group1 vs group2
+
+    All statistics are computed from the 2x2 contingency table of presence
+    counts, vectorized over the columns of the sparse matrix. Higher scores
+    are more different between groups, in either direction.
+    """
+    y = np.asarray(y)
+    n_group1 = np.count_nonzero(y == 1)
+    n_group2 = len(y) - n_group1
+    n_present1, n_present2 = presence_counts(X, y)
+
+    if statistic == 'fraction':
+        return np.abs(n_present1 / n_group1 - n_present2 / n_group2)
+    elif statistic == 'chi2':
+        a = n_present1.astype(np.float64)
+        b = n_group1 - a
+        c = n_present2.astype(np.float64)
+        d = n_group2 - c
+        denominator = (a + b) * (c + d) * (a + c) * (b + d)
+        numerator = len(y) * (a * d - b * c) ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chi2 = numerator / denominator
+        # Hashes present in all (or no) samples are uninformative
+        chi2[denominator == 0] = 0
+        return chi2
+    elif statistic == 'fisher':
+        # One-sided Fisher's exact tests for enrichment and depletion in
+        # group1 from the hypergeometric distribution, scored as -log(p) of
+        # the more significant direction
+        from scipy.stats import hypergeom
+        n_present = n_present1 + n_present2
+        log_p_enriched = hypergeom.logsf(n_present1 - 1, len(y), n_present,
+                                         n_group1)
+        log_p_depleted = hypergeom.logcdf(n_present1, len(y), n_present,
+                                          n_group1)
+        return -np.minimum(log_p_enriched, log_p_depleted)
+    else:
+        raise ValueError(f"{statistic} is not a valid prescreening statistic, "
+                         f"only {', '.join(PRESCREEN_STATISTICS)} can be used")
+
+
+def prescreen_hashes(X, y, hashes, min_prevalence=None, top_n=None,
+                     statistic=PRESCREEN_STATISTIC):
+    """Drop hashes that can't be informative before fitting the model
+
+    Parameters
+    ----------
+    min_prevalence : float, optional
+        Keep only hashes present in at least this fraction of group1 samples
+    top_n : int, optional
+        Then keep only the top_n hashes with the highest univariate statistic
+    statistic : str
+        One of 'chi2', 'fisher' or 'fraction' (absolute difference in the
+        fraction of samples with the hash between groups)
+
+    Returns
+    -------
+    X, hashes
+        Feature matrix and hash values of only the hashes that were kept
+    """
+    with profiler.stage('prescreen'):
+        logger.info(f'Prescreening {len(hashes)} hashes')
+        keep = np.arange(len(hashes))
+
+        if min_prevalence is not None:
+            n_group1 = np.count_nonzero(np.asarray(y) == 1)
+            n_present1 = X[np.asarray(y) == 1].getnnz(axis=0)
+            keep = np.flatnonzero(n_present1 >= min_prevalence * n_group1)
+            logger.info(f'Kept {len(keep)} hashes present in at least '
+                        f'{min_prevalence:.2%} of group1 samples')
+
+        if top_n is not None and len(keep) > top_n:
+            scores = univariate_scores(X[:, keep], y, statistic=statistic)
+            # Keep original (sorted hash) order of the best scoring columns
+            keep = keep[np.sort(np.argpartition(-scores, top_n - 1)[:top_n])]
+            logger.info(f'Kept top {len(keep)} hashes by {statistic} statistic')
+
+    profiler.count('hashes_after_prescreen', len(keep))
+    return X[:, keep], hashes[keep]
+
+
+def fit_regressor(regressor, X, y):
+    """Fit regressor, and log its solver iterations and fit time
+
+    Returns the number of solver iterations
+    """
+    start = time.perf_counter()
+    with profiler.stage('fit'):
+        regressor.fit(X, y)
+    seconds = time.perf_counter() - start
+    n_iter = int(np.max(regressor.n_iter_))
+    profiler.count('fits')
+    profiler.count('solver_iterations', n_iter)
+    logger.info(f'Fit in {seconds:.2f} s and {n_iter} solver iterations'
+                + (' (reached max_iter, did not converge)'
+                   if n_iter >= regressor.max_iter else ''))
+    return n_iter
+
+
+def differential_hash_expression(X, y, verbose=False,
                                  penalty=PENALTY, solver=SOLVER,
                                  random_state=0, class_weight='balanced',
                                  # Smaller C for stronger regularization
@@ -86,18 +388,21 @@ def differential_hash_expression(sigs1, sigs2, with_abundance=False, verbose=Fal
                                  # This also (seems to) help with convergence?
                                  C=0.1,
                                  **kwargs):
-    if verbose:
-        print("Creating training data")
-    X, y = get_training_data(sigs1, sigs2, with_abundance=with_abundance,
-                             verbose=verbose)
+    """Fit logistic regression on the (sparse) feature matrix of hashes
 
+    Returns
+    -------
+    coefficients : numpy.ndarray
+        Coefficient of every column (hash) of X
+    """
+    from sklearn.linear_model import LogisticRegression
     regressor = LogisticRegression(solver=solver, penalty=penalty, verbose=verbose,
                                    random_state=random_state, class_weight=class_weight,
                                    C=C, **kwargs)
     logger.info(f"Running logistic regression: {regressor}")
-    regressor.fit(X, y)
+    fit_regressor(regressor, X, y)
 
-    coefficients = pd.Series(regressor.coef_[0], index=X.columns)
+    coefficients = regressor.coef_[0]
     n_positive = (coefficients > regressor.tol).sum()
     logger.info(f'Number of coefficients greater than tolerance '
                 f'(tolerance: {regressor.tol}): {n_positive}')
@@ -105,6 +410,290 @@ def differential_hash_expression(sigs1, sigs2, with_abundance=False, verbose=Fal
     return coefficients
 
 
+def multinomial_hash_expression(X, y, verbose=False, penalty=PENALTY,
+                                solver=SOLVER, random_state=0,
+                                class_weight='balanced', C=0.1, **kwargs):
+    """Fit one multinomial logistic regression of all groups at once
+
+    y holds the group of every row of X
+
+    Returns
+    -------
+    coefficients : dict
+        Coefficient of every column (hash) of X, for each group. With only
+        two groups, the coefficients of the first are the negated
+        coefficients of the second
+    """
+    from sklearn.linear_model import LogisticRegression
+    regressor = LogisticRegression(solver=solver, penalty=penalty, verbose=verbose,
+                                   random_state=random_state, class_weight=class_weight,
+                                   C=C, multi_class='multinomial', **kwargs)
+    logger.info(f"Running multinomial logistic regression: {regressor}")
+    fit_regressor(regressor, X, y)
+
+    if len(regressor.classes_) == 2:
+        coef = np.vstack([-regressor.coef_[0], regressor.coef_[0]])
+    else:
+        coef = regressor.coef_
+    return dict(zip(regressor.classes_, coef))
+
+
+def regularization_path(X, y, Cs, threshold=0, target_n_informative=None,
+                        cv_folds=None, column_counts=None, verbose=False,
+                        penalty=PENALTY, solver=SOLVER, random_state=0,
+                        class_weight='balanced', C=None, n_jobs=None,
+                        **kwargs):
+    """Fit logistic regression for every C of Cs, warm starting each fit
+
+    Cs are fit from the strongest regularization (smallest C) to the
+    weakest, each fit starting from the coefficients of the previous one.
+    The single C argument is ignored. One C of the path is selected:
+
+    - with target_n_informative, the first C with at least that many
+      coefficients above threshold, and larger Cs are not fit
+    - with cv_folds, the C with the best mean cross-validated score, with
+      the folds fit in parallel on n_jobs processes
+    - otherwise the last (largest) C
+
+    column_counts is the number of hashes each column of X stands for, see
+    collapse_identical_columns, when counting coefficients.
+
+    Returns
+    -------
+    coefficients : numpy.ndarray
+        Coefficients of the selected C
+    path : pandas.DataFrame
+        C, solver iterations, number of nonzero and informative coefficients,
+        cross-validated score and whether it was selected of every fit C
+    path_coefficients : scipy.sparse.csr_matrix
+        (n_fit_Cs, n_hashes) coefficients of every fit C
+    """
+    import pandas as pd
+    from scipy import sparse
+    Cs = np.sort(np.asarray(Cs, dtype=np.float64))
+    if column_counts is None:
+        column_counts = np.ones(X.shape[1], dtype=np.int64)
+    from sklearn.linear_model import LogisticRegression
+    regressor = LogisticRegression(solver=solver, penalty=penalty, verbose=verbose,
+                                   random_state=random_state, class_weight=class_weight,
+                                   warm_start=True, **kwargs)
+    logger.info(f"Running logistic regression for C in {list(Cs)}: {regressor}")
+
+    rows = []
+    path_coefficients = []
+    selected = len(Cs) - 1
+    for i, C in enumerate(Cs):
+        regressor.set_params(C=C)
+        n_iter = fit_regressor(regressor, X, y)
+
+        coefficients = regressor.coef_[0].copy()
+        rows.append(dict(
+            C=C, n_iter=n_iter,
+            n_nonzero=int(column_counts[coefficients != 0].sum()),
+            n_informative=int(column_counts[coefficients > threshold].sum())))
+        path_coefficients.append(sparse.csr_matrix(coefficients))
+        logger.info(f'C: {C}, nonzero coefficients: {rows[-1]["n_nonzero"]}, '
+                    f'informative hashes: {rows[-1]["n_informative"]}')
+
+        if target_n_informative is not None and \
+                rows[-1]['n_informative'] >= target_n_informative:
+            selected = i
+            break
+    else:
+        if target_n_informative is not None:
+            logger.warning(f'No C yields {target_n_informative} informative '
+                           f'hashes, using the largest C: {Cs[-1]}')
+
+    path = pd.DataFrame(rows, columns=['C', 'n_iter', 'n_nonzero',
+                                       'n_informative'])
+    if cv_folds is not None:
+        from sklearn.linear_model import LogisticRegressionCV
+        cv_regressor = LogisticRegressionCV(
+            Cs=list(Cs), cv=cv_folds, penalty=penalty, solver=solver,
+            scoring=CV_SCORING, class_weight=class_weight, refit=False,
+            random_state=random_state, n_jobs=n_jobs, verbose=verbose,
+            **kwargs)
+        logger.info(f"Cross-validating logistic regression: {cv_regressor}")
+        with profiler.stage('cross_validate'):
+            cv_regressor.fit(X, y)
+        profiler.count('fits', cv_folds * len(Cs))
+        # Scores of every fold and C, of the only (positive) class
+        scores = next(iter(cv_regressor.scores_.values()))
+        path['cv_score'] = scores.mean(axis=0)
+        selected = int(np.argmax(path['cv_score']))
+    path['selected'] = np.arange(len(path)) == selected
+    logger.info(f'Selected C: {path["C"][selected]}')
+
+    path_coefficients = sparse.vstack(path_coefficients, format='csr')
+    coefficients = path_coefficients[selected].toarray().ravel()
+    return coefficients, path, path_coefficients
+
+
+def presence_similarity(X, columns, chunk_size=SIMILARITY_CHUNK_SIZE):
+    """Maximum Jaccard similarity of the samples containing each hash, to
+    the samples containing any of the hashes of columns
+
+    Co-occurrence counts are sparse products of the presence of chunk_size
+    hashes at a time with the presence of the hashes of columns, which are
+    few.
+    """
+    from scipy import sparse
+    X_csc = X.tocsc()
+    present = sparse.csc_matrix(
+        (np.ones(X_csc.nnz), X_csc.indices, X_csc.indptr), shape=X.shape)
+    n_present = np.diff(present.indptr)
+    flagged = present[:, columns].tocsr()
+    n_flagged = n_present[columns]
+
+    similarity = np.zeros(X.shape[1])
+    for start in range(0, X.shape[1], chunk_size):
+        stop = min(start + chunk_size, X.shape[1])
+        shared = (present[:, start:stop].T @ flagged).tocsr()
+        rows = np.repeat(np.arange(stop - start), np.diff(shared.indptr))
+        shared.data = shared.data / (n_present[start + rows]
+                                     + n_flagged[shared.indices]
+                                     - shared.data)
+        similarity[start:stop] = shared.max(axis=1).toarray().ravel()
+    return similarity
+
+
+def coarse_to_fine_hashes(X, y, hashes, scaled, threshold=0,
+                          min_similarity=COARSE_MIN_SIMILARITY, top_n=None,
+                          **kwargs):
+    """Select the hashes to fit at full resolution by first fitting on
+    sketches downsampled to scaled
+
+    Downsampling a sketch keeps its hashes up to max_hash, so the coarse fit
+    is on the columns of those hashes, about 1 in scaled, with the same
+    parameters (kwargs). Its hashes with coefficients above threshold are
+    flagged. The hashes kept for the fine fit are those present in similar
+    samples as a flagged hash, e.g. the other k-mers of its protein, with a
+    Jaccard similarity of at least min_similarity, and at most the top_n
+    most similar ones.
+
+    Returns X and hashes of the kept columns
+    """
+    coarse = np.flatnonzero(
+        hashes <= np.uint64(sourmash_utils.max_hash_for_scaled(scaled)))
+    logger.info(f'Coarse fit of the {len(coarse)} of {len(hashes)} hashes '
+                f'kept at scaled={scaled}')
+    if len(coarse) == 0:
+        logger.warning(f'No hashes kept at scaled={scaled}, use a smaller '
+                       f'scaled value')
+        return X[:, coarse], hashes[coarse]
+
+    coefficients = differential_hash_expression(X[:, coarse], y, **kwargs)
+    flagged = coarse[coefficients > threshold]
+    profiler.count('hashes_flagged_by_coarse_fit', len(flagged))
+    logger.info(f'Coarse fit flagged {len(flagged)} informative hashes')
+    if len(flagged) == 0:
+        logger.warning(f'No informative hashes at scaled={scaled}, use a '
+                       f'smaller scaled value')
+        return X[:, flagged], hashes[flagged]
+
+    with profiler.stage('presence_similarity'):
+        similarity = presence_similarity(X, flagged)
+    keep = np.flatnonzero(similarity >= min_similarity)
+    if top_n is not None and len(keep) > top_n:
+        keep = np.sort(keep[np.argsort(-similarity[keep],
+                                       kind='stable')[:top_n]])
+    profiler.count('hashes_after_coarse_fit', len(keep))
+    logger.info(f'Kept {len(keep)} hashes with presence similarity of at '
+                f'least {min_similarity} to a flagged hash for the fine fit')
+    return X[:, keep], hashes[keep]
+
+
+def build_streaming_vocabulary(sig_files, ksize, molecule,
+                               chunk_size=CHUNK_SIZE, **load_kwargs):
+    """Sorted unique hashes of all signatures, reading a chunk at a time
+
+    Returns the vocabulary, and the number of signatures in each file
+    """
+    vocabulary = np.array([], dtype=np.uint64)
+    n_signatures = defaultdict(int)
+    for sketches in sourmash_utils.iter_sketch_array_chunks(
+            sig_files, ksize, molecule, chunk_size, **load_kwargs):
+        with profiler.stage('build_vocabulary'):
+            for sketch in sketches:
+                n_signatures[sketch.filename] += 1
+            chunk_hashes = np.concatenate(
+                [s.hashes for s in sketches] + [np.array([], dtype=np.uint64)])
+            vocabulary = np.union1d(vocabulary, chunk_hashes)
+    profiler.count('hashes', len(vocabulary))
+    logger.info(f'Vocabulary of {len(vocabulary)} hashes from '
+                f'{sum(n_signatures.values())} signatures')
+    return vocabulary, n_signatures
+
+
+def streaming_differential_hash_expression(
+        sig_files, is_group1, vocabulary, n_signatures, ksize, molecule,
+        chunk_size=CHUNK_SIZE, epochs=EPOCHS, with_abundance=False,
+        penalty=PENALTY, C=0.1, l1_ratio=0.15, random_state=0, verbose=False,
+        **load_kwargs):
+    """Fit a linear classifier of group1 vs the rest on all signatures,
+    streaming chunk_size signature files at a time over several epochs
+
+    Only one chunk of signatures and its feature matrix are in memory at a
+    time, next to the vocabulary and the coefficients. The stochastic
+    gradient descent minimizes the same L1 (or elastic net) regularized
+    logistic loss as differential_hash_expression, with the inverse
+    regularization strength C translated to alpha = 1 / (C * n_samples),
+    and the classes balanced by weights computed from all signatures.
+
+    Parameters
+    ----------
+    sig_files : list of str
+        Signature files, visited in a new random order every epoch
+    is_group1 : dict
+        Whether the signatures of each file are group1
+    vocabulary, n_signatures
+        Returned by build_streaming_vocabulary
+
+    Returns
+    -------
+    coefficients : numpy.ndarray
+        Coefficient of every hash of the vocabulary
+    """
+    n_samples = sum(n_signatures.values())
+    n_group1 = sum(n for filename, n in n_signatures.items()
+                   if is_group1[filename])
+    n_group2 = n_samples - n_group1
+    if n_group1 == 0 or n_group2 == 0:
+        raise ValueError(f'Need signatures in both group1 and the rest, '
+                         f'got {n_group1} and {n_group2}')
+
+    # 'balanced' class weights aren't supported by partial_fit
+    class_weight = {1: n_samples / (2 * n_group1),
+                    0: n_samples / (2 * n_group2)}
+    from sklearn.linear_model import SGDClassifier
+    regressor = SGDClassifier(loss='log', penalty=penalty,
+                              alpha=1 / (C * n_samples), l1_ratio=l1_ratio,
+                              class_weight=class_weight,
+                              random_state=random_state, verbose=verbose)
+    logger.info(f"Running streaming logistic regression: {regressor}")
+
+    rng = np.random.RandomState(random_state)
+    for epoch in range(epochs):
+        for sketches in sourmash_utils.iter_sketch_array_chunks(
+                rng.permutation(sig_files), ksize, molecule, chunk_size,
+                **load_kwargs):
+            with profiler.stage('make_matrix'):
+                X = make_hash_matrix_with_vocabulary(
+                    sketches, vocabulary, with_abundance=with_abundance)
+                y = np.array([is_group1[s.filename] for s in sketches],
+                             dtype=np.float64)
+            with profiler.stage('fit'):
+                regressor.partial_fit(X, y, classes=np.array([0., 1.]))
+            profiler.count('chunks')
+        profiler.count('epochs')
+        logger.info(f'Finished epoch {epoch + 1} of {epochs}')
+
+    coefficients = regressor.coef_[0]
+    logger.info(f'Number of nonzero coefficients: '
+                f'{np.count_nonzero(coefficients)}')
+    return coefficients
+
+
 def maybe_subsample(sigs, subsample_groups=MAX_GROUP_SIZE, random_state=0):
     """If number of signatures is larger than specified, subsample to random"""
     if subsample_groups is not None:
@@ -113,96 +702,791 @@ def maybe_subsample(sigs, subsample_groups=MAX_GROUP_SIZE, random_state=0):
     return sigs
 
 
-def get_hashes_enriched_in_group(group1_name, annotations, group_col, sketch_series,
-                                 max_group_size=MAX_GROUP_SIZE, random_state=0,
-                                 verbose=False, with_abundance=False, **kwargs):
+def get_group_samples(group1_name, annotations, group_col, sample_ids):
+    """Get sample ids of group1 and of the rest, restricted to ``sample_ids``"""
     rows = annotations[group_col] == group1_name
 
-    group1_samples = annotations.loc[rows].index.intersection(sketch_series.index)
+    group1_samples = annotations.loc[rows].index.intersection(sample_ids)
     logger.info(f"\nNumber of samples in {group1_name}: {len(group1_samples)}")
 
     # Everything not in group 1
-    group2_samples = annotations.loc[~rows].index.intersection(sketch_series.index)
-    logger.info(f"\nNumber of samples in the rest -- aka NOT {group1_name}: {len(group1_samples)}")
+    group2_samples = annotations.loc[~rows].index.intersection(sample_ids)
+    logger.info(f"\nNumber of samples in the rest -- aka NOT {group1_name}: {len(group2_samples)}")
+    return group1_samples, group2_samples
+
+
+def get_hashes_enriched_in_group(group1_name, annotations, group_col, sketch_series,
+                                 max_group_size=MAX_GROUP_SIZE, random_state=0,
+                                 verbose=False, with_abundance=False, prescreen=None,
+                                 **kwargs):
+    group1_sigs, group2_sigs = subsample_loaded_sketches(
+        group1_name, annotations, group_col, sketch_series,
+        max_group_size=max_group_size)
+    return fit_group(group1_sigs, group2_sigs, random_state=random_state,
+                     verbose=verbose, with_abundance=with_abundance,
+                     prescreen=prescreen, **kwargs)
+
+
+def subsample_loaded_sketches(group1_name, annotations, group_col,
+                              sketch_series, max_group_size=MAX_GROUP_SIZE):
+    """Subsample the loaded sketches of group1 and of the rest"""
+    group1_samples, group2_samples = get_group_samples(
+        group1_name, annotations, group_col, sketch_series.index)
 
     group1_sigs = maybe_subsample(sketch_series[group1_samples], max_group_size)
     group2_sigs = maybe_subsample(sketch_series[group2_samples], max_group_size)
+    return group1_sigs, group2_sigs
+
+
+def fit_group(group1_sigs, group2_sigs, random_state=0, verbose=False,
+              with_abundance=False, abundance_transform=None, prescreen=None,
+              path=None, result_cache=None, **kwargs):
+    """Fit the (subsampled) group1 signatures vs the group2 signatures
+
+    abundance_transform is one of ABUNDANCE_TRANSFORMS, see
+    transform_abundances.
+    With path, a dict of the arguments of regularization_path, fit the whole
+    regularization path instead of a single C. With result_cache, a dict of
+    cache_dir and max_cache_size, the fit is looked up in and saved to the
+    cache, see result_cache_key.
+
+    Returns the coefficient and hash value of every (kept) hash, and the
+    regularization path, or None
+    """
     logger.info(f'\nGroup 1 signatures: {group1_sigs}')
     logger.info(f'\nGroup 2 signatures: {group2_sigs}')
 
-    coefficients = differential_hash_expression(group1_sigs, group2_sigs,
-                                                verbose=verbose,
-                                                random_state=random_state,
-                                                with_abundance=with_abundance,
-                                                **kwargs)
-    coefficients.name = group1_name
-    return coefficients
+    key = None
+    if result_cache is not None:
+        key = result_cache_key(
+            group1_sigs, group2_sigs, random_state=random_state,
+            with_abundance=with_abundance,
+            abundance_transform=abundance_transform, prescreen=prescreen,
+            path=path, **kwargs)
+        cached = read_cached_result(result_cache['cache_dir'], key)
+        if cached is not None:
+            return cached
 
+    if verbose:
+        print("Creating training data")
+    X, y, hashes = get_training_data(group1_sigs, group2_sigs,
+                                     with_abundance=with_abundance,
+                                     abundance_transform=abundance_transform,
+                                     verbose=verbose)
+    if prescreen is not None:
+        X, hashes = prescreen_hashes(X, y, hashes, **prescreen)
+    result = fit_coefficients(X, y, hashes, path=path, verbose=verbose,
+                              random_state=random_state, **kwargs)
+    if key is not None:
+        write_cached_result(key, *result, **result_cache)
+    return result
 
-def main(metadata_csv, ksize, molecule, group_col=GROUP, group1=None, sig_col=SIG,
-         threshold=0, verbose=True, C=0.1, solver=SOLVER, penalty=PENALTY, n_jobs=8,
-         random_state=0, use_sig_basename=False, with_abundance=False,
-          max_group_size=MAX_GROUP_SIZE):
-    metadata = pd.read_csv(metadata_csv, index_col='sample_id')
 
-    if use_sig_basename:
-        metadata[sig_col] = metadata[sig_col].map(os.path.basename)
-    logger.info(f"\nmetadata head:\n---\n{metadata.head()}\n---\n")
+def result_cache_key(group1_sigs, group2_sigs, **params):
+    """Digest of everything the fit of group1 vs group2 depends on
 
-    # Load all sketches into one object for reference later
-    sketches = sourmash_utils.load_sketches(metadata[sig_col], ksize, molecule)
+    That is the sample ids and the hashes and abundances of the signatures
+    of both groups, in order, which also cover the ksize, molecule and
+    subsampling, and the fitting params, except n_jobs and verbose, and the
+    version of scikit-learn.
+    """
+    from sklearn import __version__ as sklearn_version
+    params = {name: value for name, value in params.items()
+              if name not in ('n_jobs', 'verbose')}
+    digest = hashlib.sha1(json.dumps(
+        [RESULT_CACHE_VERSION, sklearn_version, params], sort_keys=True,
+        default=str).encode())
+    with profiler.stage('result_cache_key'):
+        for label, sigs in ((1, group1_sigs), (0, group2_sigs)):
+            for sample_id, sketch in sigs.items():
+                digest.update(f'{label}\t{sample_id}\t{len(sketch.hashes)}\n'
+                              .encode())
+                digest.update(np.ascontiguousarray(sketch.hashes).tobytes())
+                if sketch.abundances is not None:
+                    digest.update(
+                        np.ascontiguousarray(sketch.abundances).tobytes())
+    return f'fit-{digest.hexdigest()}'
+
+
+def read_cached_result(cache_dir, key):
+    """Coefficients, hashes and regularization path of a cached fit, or None
+    if not cached"""
+    import pandas as pd
+    from scipy import sparse
+    index = os.path.join(cache_dir, f'{key}.json')
+    try:
+        with open(index) as f:
+            entry = json.load(f)
+        with np.load(os.path.join(cache_dir, f'{key}.npz')) as arrays:
+            arrays = dict(arrays)
+    except (OSError, ValueError):
+        return None
+
+    # Mark entry as recently used, for eviction
+    os.utime(index)
+    profiler.count('fits_from_cache')
+    logger.info(f'Using the cached fit {key}')
+
+    regularization = None
+    if entry['path'] is not None:
+        path_coefficients = sparse.csr_matrix(
+            (arrays['path_data'], arrays['path_indices'],
+             arrays['path_indptr']), shape=tuple(arrays['path_shape']))
+        regularization = (pd.DataFrame(entry['path']), path_coefficients)
+    return arrays['coefficients'], arrays['hashes'], regularization
+
+
+def write_cached_result(key, coefficients, hashes, regularization,
+                        cache_dir=None, max_cache_size=None):
+    """Save a fit to the cache, then evict least recently used entries"""
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = dict(coefficients=coefficients, hashes=np.asarray(hashes))
+    path = None
+    if regularization is not None:
+        summary, path_coefficients = regularization
+        path = summary.to_dict(orient='list')
+        arrays.update(path_data=path_coefficients.data,
+                      path_indices=path_coefficients.indices,
+                      path_indptr=path_coefficients.indptr,
+                      path_shape=np.array(path_coefficients.shape))
+
+    # Write to temporary files and rename, so that concurrent readers never
+    # see a partially written entry. The index is written last
+    filename = os.path.join(cache_dir, f'{key}.npz')
+    with open(f'{filename}.tmp{os.getpid()}', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(f'{filename}.tmp{os.getpid()}', filename)
+    index = os.path.join(cache_dir, f'{key}.json')
+    with open(f'{index}.tmp{os.getpid()}', 'w') as f:
+        # Values of the path summary are NumPy scalars
+        json.dump(dict(path=path), f, default=lambda x: x.item())
+    os.replace(f'{index}.tmp{os.getpid()}', index)
+    sourmash_utils.evict_cache(cache_dir, max_cache_size)
+
+
+def fit_coefficients(X, y, hashes, path=None, collapse=False, coarse=None,
+                     **kwargs):
+    """Fit a single C, or the regularization path if path is given
+
+    With coarse, a dict of the arguments of coarse_to_fine_hashes, only the
+    hashes selected by a fit of downsampled sketches are fit. With collapse,
+    hashes present in the same samples are fit as a single column, see
+    collapse_identical_columns, and every hash gets the coefficient of its
+    column.
+
+    Returns coefficients, hashes and the regularization path, or None
+    """
+    if coarse is not None:
+        X, hashes = coarse_to_fine_hashes(X, y, hashes, **coarse, **kwargs)
+        if X.shape[1] == 0:
+            return np.zeros(0), hashes, None
+
+    members = None
+    column_counts = None
+    if collapse:
+        X, members = collapse_identical_columns(X)
+        column_counts = np.bincount(members, minlength=X.shape[1])
+
+    regularization = None
+    if path is None:
+        coefficients = differential_hash_expression(X, y, **kwargs)
+    else:
+        coefficients, summary, path_coefficients = regularization_path(
+            X, y, **path, column_counts=column_counts, **kwargs)
+        if members is not None:
+            path_coefficients = path_coefficients[:, members]
+        regularization = (summary, path_coefficients)
+
+    if members is not None:
+        coefficients = coefficients[members]
+    return coefficients, hashes, regularization
+
+
+def subsample_group_signatures(group1_name, metadata, group_col, sig_col,
+                               max_group_size=MAX_GROUP_SIZE):
+    """Plan the fit of group1 vs the rest from the metadata alone
+
+    Draws the same subsamples as get_hashes_enriched_in_group does from the
+    loaded signatures, assuming each signature is named after its sample id
+    and loads, so that only the signature files of the subsampled samples
+    need to be loaded. Check that assumption with select_sketches.
+
+    Returns
+    -------
+    group1_files, group2_files : pandas.Series
+        Signature files of the subsampled group1 and rest samples, indexed by
+        sample id in subsample order
+    """
+    group1_samples, group2_samples = get_group_samples(
+        group1_name, metadata, group_col, metadata.index)
+    group1_files = maybe_subsample(metadata.loc[group1_samples, sig_col],
+                                   max_group_size)
+    group2_files = maybe_subsample(metadata.loc[group2_samples, sig_col],
+                                   max_group_size)
+    return group1_files, group2_files
+
+
+def select_sketches(sketch_series, sample_ids):
+    """Sketches of sample_ids in that order, or None if any wasn't loaded"""
+    import pandas as pd
+    missing = pd.Index(sample_ids).difference(sketch_series.index)
+    if len(missing) > 0:
+        logger.warning(f'No signature loaded for {len(missing)} subsampled '
+                       f'samples, e.g. {missing[0]}')
+        return None
+    return sketch_series[sample_ids]
+
+
+def load_sketch_series(metadata_csv, sig_files, ksize, molecule,
+                       cache_dir=None,
+                       max_cache_size=sourmash_utils.MAX_CACHE_SIZE):
+    """Load the signatures of sig_files as a Series indexed by their names"""
+    import pandas as pd
+    with profiler.stage('load_signatures'):
+        sketches = sourmash_utils.load_sketch_arrays(
+            sig_files, ksize, molecule, cache_dir=cache_dir,
+            max_cache_size=max_cache_size)
     logger.info(f"\nLoaded {len(sketches)} sourmash signatures/sketches")
     if not sketches:
         # If sketches is empty --> something wrong happened
-        sketch_filenames = '\n'.join(metadata[sig_col].head())
+        sketch_filenames = '\n'.join(pd.Series(sig_files).head())
         raise ValueError(f"Could not load sourmash signatures/sketches from"
                          f" {metadata_csv}! These are some of the files we couldn't "
                          f"load:\n---\n{sketch_filenames}\n---\nMaybe the molecule or "
                          f"ksize is wrong? Molecule: {molecule} and ksize: {ksize}")
-    sketch_series = pd.Series(sketches, index=[x.name() for x in sketches])
+    sketch_series = pd.Series(sketches, index=[x.name for x in sketches])
     logger.info(f"\nSketch series head: {sketch_series.head()}")
+    return sketch_series
+
+
+def get_multinomial_training_data(metadata, group_col, sketch_series,
+                                  max_group_size=MAX_GROUP_SIZE,
+                                  with_abundance=False,
+                                  abundance_transform=None):
+    """Create the feature matrix of the (subsampled) signatures of all groups
+
+    Returns X, the group of every row and the hash of every column
+    """
+    sigs = []
+    y = []
+    for group in metadata[group_col].unique():
+        samples = metadata.index[metadata[group_col] == group].intersection(
+            sketch_series.index)
+        group_sigs = maybe_subsample(sketch_series[samples], max_group_size)
+        logger.info(f'Number of samples in {group}: {len(group_sigs)}')
+        sigs.extend(group_sigs)
+        y.extend([group] * len(group_sigs))
+
+    with profiler.stage('make_matrix'):
+        X, hashes = make_hash_matrix(sigs, with_abundance=with_abundance)
+    profiler.count('hashes', X.shape[1])
+    profiler.count('nonzero_entries', X.nnz)
+    logger.info(f'Feature matrix: {X.shape[0]} samples x {X.shape[1]} hashes, '
+                f'{X.nnz} nonzero entries')
+    X = transform_abundances(X, abundance_transform)
+    return X, np.array(y, dtype=object), hashes
+
+
+def save_shared_matrix(X, folder):
+    """Save CSR matrix arrays as .npy files so processes can memory-map them"""
+    for name in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(folder, f'{name}.npy'), getattr(X, name))
+    np.save(os.path.join(folder, 'shape.npy'), np.array(X.shape))
+
+
+def load_shared_matrix(folder):
+    """Load CSR matrix saved by save_shared_matrix without reading it into memory"""
+    from scipy import sparse
+    data, indices, indptr = (
+        np.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r')
+        for name in ('data', 'indices', 'indptr'))
+    shape = tuple(np.load(os.path.join(folder, 'shape.npy')))
+    return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def subset_training_data(X, hashes, rows1, rows2):
+    """Take group1 and group2 rows of the cohort matrix as training data
+
+    Columns (hashes) that are absent from all selected rows are dropped, so
+    the result is the same as building the matrix from only those signatures
+    """
+    X_subset = X[np.concatenate([rows1, rows2])]
+    columns = np.unique(X_subset.indices)
+    X_subset = X_subset[:, columns]
+    y = make_target_vector(len(rows1), len(rows2))
+    return X_subset, y, hashes[columns]
+
+
+def get_subsampled_rows(group1_name, annotations, group_col, sample_ids,
+                        max_group_size=MAX_GROUP_SIZE):
+    """Get row numbers of the (subsampled) group1 and rest signatures
+
+    The subsample is the same as the one drawn in get_hashes_enriched_in_group
+    """
+    import pandas as pd
+    rows = pd.Series(np.arange(len(sample_ids)), index=sample_ids)
+    group1_samples, group2_samples = get_group_samples(
+        group1_name, annotations, group_col, sample_ids)
+    rows1 = maybe_subsample(rows[group1_samples], max_group_size)
+    rows2 = maybe_subsample(rows[group2_samples], max_group_size)
+    return rows1.values, rows2.values
+
+
+def make_cohort_matrix(sketch_series, with_abundance=False):
+    """Build the feature matrix of all signatures, rows in sketch_series order"""
+    with profiler.stage('make_matrix'):
+        X, hashes = make_hash_matrix(sketch_series.values,
+                                     with_abundance=with_abundance)
+    profiler.count('hashes', X.shape[1])
+    profiler.count('nonzero_entries', X.nnz)
+    logger.info(f'Cohort feature matrix: {X.shape[0]} samples x {X.shape[1]} '
+                f'hashes, {X.nnz} nonzero entries')
+    return X, hashes
+
+
+@contextmanager
+def shared_matrix_executor(X, hashes, processes=1):
+    """Process pool whose workers memory-map X and hashes from a folder
+
+    The matrix is saved to a temporary folder in the current directory, so
+    the worker processes share it instead of each getting a copy. Submit
+    _fit_group_on_shared_matrix with row numbers of the matrix to fit them.
+    """
+    with tempfile.TemporaryDirectory(prefix='diff_hash_', dir='.') as folder:
+        save_shared_matrix(X, folder)
+        np.save(os.path.join(folder, 'hashes.npy'), hashes)
+        del X, hashes
+
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_shared_matrix_worker,
+                                 initargs=(folder,)) as executor:
+            yield executor
+
+
+# Cohort matrix and hash vocabulary, memory-mapped once per worker process
+_shared = {}
+
+
+def _init_shared_matrix_worker(folder):
+    _shared['X'] = load_shared_matrix(folder)
+    _shared['hashes'] = np.load(os.path.join(folder, 'hashes.npy'), mmap_mode='r')
+
+
+def _fit_group_on_shared_matrix(group1_name, rows1, rows2,
+                                abundance_transform, prescreen, path, kwargs):
+    # Profile of this fit only, merged into the profile of the main process
+    profiler.reset()
+    with profiler.stage('subset_matrix'):
+        X, y, hashes = subset_training_data(_shared['X'], _shared['hashes'],
+                                            rows1, rows2)
+    logger.info(f'{group1_name}: {X.shape[0]} samples x {X.shape[1]} hashes, '
+                f'{X.nnz} nonzero entries')
+    # Transformed per fit, as tfidf and maxabs depend on the selected rows
+    X = transform_abundances(X, abundance_transform)
+    if prescreen is not None:
+        X, hashes = prescreen_hashes(X, y, hashes, **prescreen)
+    coefficients, hashes, regularization = fit_coefficients(
+        X, y, np.asarray(hashes), path=path, **kwargs)
+    return group1_name, coefficients, hashes, regularization, \
+        profiler.results()
+
+
+def fit_all_groups_in_parallel(metadata, group_col, sketch_series, threshold,
+                               processes=1, max_group_size=MAX_GROUP_SIZE,
+                               with_abundance=False, abundance_transform=None,
+                               prescreen=None, path=None, result_cache=None,
+                               **kwargs):
+    """Build the cohort feature matrix once and fit every group concurrently
+
+    The matrix is shared by the worker processes through memory-mapped
+    files, and only the row numbers of each group are sent to the workers.
+    Groups whose fit is in the result_cache, see fit_group, are not fit.
+    """
+    X, hashes = make_cohort_matrix(sketch_series, with_abundance=with_abundance)
 
-    # If group1 is provided, only do one hash enrichment
-    if group1 is not None:
+    groups = metadata[group_col].unique()
+    with shared_matrix_executor(X, hashes, processes) as executor:
+        del X, hashes
+        futures = {}
+        for group1 in groups:
+            logger.info(f"\n--- group: {group1} ---")
+            rows1, rows2 = get_subsampled_rows(
+                group1, metadata, group_col, sketch_series.index,
+                max_group_size=max_group_size)
+            key = None
+            if result_cache is not None:
+                key = result_cache_key(
+                    sketch_series.iloc[rows1], sketch_series.iloc[rows2],
+                    with_abundance=with_abundance,
+                    abundance_transform=abundance_transform,
+                    prescreen=prescreen, path=path, **kwargs)
+                cached = read_cached_result(result_cache['cache_dir'], key)
+                if cached is not None:
+                    write_hash_coefficients(cached[0], cached[1], group1,
+                                            threshold,
+                                            regularization=cached[2])
+                    continue
+            futures[executor.submit(
+                _fit_group_on_shared_matrix, group1, rows1, rows2,
+                abundance_transform, prescreen, path, kwargs)] = key
+
+        for future in as_completed(futures):
+            group1, coefficients, hashes, regularization, profile = \
+                future.result()
+            profiler.merge(profile)
+            logger.info(f"Finished fitting group: {group1}")
+            if futures[future] is not None:
+                write_cached_result(futures[future], coefficients, hashes,
+                                    regularization, **result_cache)
+            write_hash_coefficients(coefficients, hashes, group1, threshold,
+                                    regularization=regularization)
+
+
+def draw_stability_rows(rows, sample_fraction, max_group_size, random_state):
+    """Random subsample of sample_fraction of rows, of at most max_group_size"""
+    n = max(1, int(round(sample_fraction * len(rows))))
+    if max_group_size is not None:
+        n = min(n, max_group_size)
+    return random_state.choice(rows, n, replace=False)
+
+
+def stability_selection_in_parallel(metadata, group_col, groups, sketch_series,
+                                    threshold, n_rounds=100, cutoff=0.6,
+                                    sample_fraction=0.5, processes=1,
+                                    max_group_size=MAX_GROUP_SIZE,
+                                    with_abundance=False,
+                                    abundance_transform=None, prescreen=None,
+                                    path=None, random_state=0, **kwargs):
+    """Fit groups on n_rounds random subsamples, and count hash selections
+
+    Every round fits a random sample_fraction (of at most max_group_size) of
+    the group vs a random sample_fraction of the rest. A hash is selected in
+    a round if its coefficient is above threshold. The feature matrix of all
+    signatures is built once and shared by the worker processes, which only
+    get the row numbers of each round, so every round costs one fit.
+
+    Hashes selected in at least a cutoff fraction of the rounds are the
+    informative hashes of the group.
+    """
+    X, all_hashes = make_cohort_matrix(sketch_series,
+                                       with_abundance=with_abundance)
+    rng = np.random.RandomState(random_state)
+
+    # Selection counts and summed coefficients of every hash, per group
+    n_selected = {}
+    coefficient_sums = {}
+    with shared_matrix_executor(X, all_hashes, processes) as executor:
+        del X
+        futures = []
+        for group1 in groups:
+            logger.info(f"\n--- group: {group1} ---")
+            n_selected[group1] = np.zeros(len(all_hashes), dtype=np.int64)
+            coefficient_sums[group1] = np.zeros(len(all_hashes))
+            rows1, rows2 = get_subsampled_rows(
+                group1, metadata, group_col, sketch_series.index,
+                max_group_size=None)
+            for _ in range(n_rounds):
+                futures.append(executor.submit(
+                    _fit_group_on_shared_matrix, group1,
+                    draw_stability_rows(rows1, sample_fraction,
+                                        max_group_size, rng),
+                    draw_stability_rows(rows2, sample_fraction,
+                                        max_group_size, rng),
+                    abundance_transform, prescreen, path, kwargs))
+
+        for future in as_completed(futures):
+            group1, coefficients, hashes, regularization, profile = \
+                future.result()
+            profiler.merge(profile)
+            # Hashes of each round are a subset of the cohort's hashes
+            columns = np.searchsorted(all_hashes, hashes)
+            n_selected[group1][columns[coefficients > threshold]] += 1
+            coefficient_sums[group1][columns] += coefficients
+
+    for group1 in groups:
+        logger.info(f"Finished {n_rounds} rounds of group: {group1}")
+        write_stability_selection(n_selected[group1] / n_rounds,
+                                  coefficient_sums[group1] / n_rounds,
+                                  all_hashes, group1, cutoff)
+
+
+def main(metadata_csv, ksize, molecule, group_col=GROUP, group1=None, sig_col=SIG,
+         threshold=0, verbose=True, C=0.1, solver=SOLVER, penalty=PENALTY, n_jobs=8,
+         random_state=0, use_sig_basename=False, with_abundance=False,
+         max_group_size=MAX_GROUP_SIZE, parallel_groups=False, cache_dir=None,
+         max_cache_size=sourmash_utils.MAX_CACHE_SIZE, min_prevalence=None,
+         prescreen_top_n=None, prescreen_statistic=PRESCREEN_STATISTIC,
+         regularization_path_Cs=None, target_n_informative=None,
+         cv_folds=None, stability_rounds=None, stability_cutoff=0.6,
+         stability_sample_fraction=0.5, streaming=False, chunk_size=CHUNK_SIZE,
+         epochs=EPOCHS, l1_ratio=0.15, multinomial=False,
+         collapse_identical=False, cache_results=False,
+         abundance_transform=None, coarse_scaled=None,
+         coarse_min_similarity=COARSE_MIN_SIMILARITY, coarse_top_n=None):
+    import pandas as pd
+    metadata = pd.read_csv(metadata_csv, index_col='sample_id')
+
+    if use_sig_basename:
+        metadata[sig_col] = metadata[sig_col].map(os.path.basename)
+    logger.info(f"\nmetadata head:\n---\n{metadata.head()}\n---\n")
+
+    if group1 is None:
+        write_group_file_prefixes(list(metadata[group_col].unique()))
+
+    prescreen = None
+    if min_prevalence is not None or prescreen_top_n is not None:
+        prescreen = dict(min_prevalence=min_prevalence, top_n=prescreen_top_n,
+                         statistic=prescreen_statistic)
+
+    coarse = None
+    if coarse_scaled is not None:
+        coarse = dict(scaled=coarse_scaled, threshold=threshold,
+                      min_similarity=coarse_min_similarity, top_n=coarse_top_n)
+
+    result_cache = None
+    if cache_results:
+        result_cache = dict(cache_dir=cache_dir, max_cache_size=max_cache_size)
+
+    path = None
+    if regularization_path_Cs is not None:
+        path = dict(Cs=regularization_path_Cs, threshold=threshold,
+                    target_n_informative=target_n_informative,
+                    cv_folds=cv_folds)
+
+    # Fit on all signatures, streaming them from disk, without subsampling
+    if streaming:
+        load_kwargs = dict(cache_dir=cache_dir, max_cache_size=max_cache_size)
+        sig_files = metadata[sig_col].unique()
+        vocabulary, n_signatures = build_streaming_vocabulary(
+            sig_files, ksize, molecule, chunk_size=chunk_size, **load_kwargs)
+        groups = [group1] if group1 is not None \
+            else metadata[group_col].unique()
+        for group in groups:
+            logger.info(f"\n--- group: {group} ---")
+            group1_files = set(metadata.loc[metadata[group_col] == group,
+                                            sig_col])
+            coefficients = streaming_differential_hash_expression(
+                sig_files, {f: f in group1_files for f in sig_files},
+                vocabulary, n_signatures, ksize, molecule,
+                chunk_size=chunk_size, epochs=epochs,
+                with_abundance=with_abundance, penalty=penalty, C=C,
+                l1_ratio=l1_ratio, random_state=random_state,
+                verbose=verbose, **load_kwargs)
+            write_hash_coefficients(coefficients, vocabulary, group, threshold)
+        return
+
+    # If group1 is provided, only do one hash enrichment, and only load the
+    # signatures of the samples it subsamples
+    if group1 is not None and stability_rounds is None:
         logger.info(f"\n--- group: {group1} ---")
-        coefficients = get_hashes_enriched_in_group(group1, metadata, group_col,
-                                                    sketch_series, verbose=verbose, C=C,
-                                                    n_jobs=n_jobs, solver=solver,
-                                                    penalty=penalty,
-                                                    random_state=random_state,
-                                                    max_group_size=max_group_size,
-                                                    with_abundance=with_abundance)
-        write_hash_coefficients(coefficients, group1, threshold)
+        group1_files, group2_files = subsample_group_signatures(
+            group1, metadata, group_col, sig_col, max_group_size=max_group_size)
+        sig_files = pd.concat([group1_files, group2_files])
+        logger.info(f"\nLoading {len(sig_files)} of {len(metadata)} "
+                    f"signature files")
+        sketch_series = load_sketch_series(
+            metadata_csv, sig_files.unique(), ksize, molecule,
+            cache_dir=cache_dir, max_cache_size=max_cache_size)
+        group1_sigs = select_sketches(sketch_series, group1_files.index)
+        group2_sigs = select_sketches(sketch_series, group2_files.index)
+        if group1_sigs is None or group2_sigs is None:
+            # Subsample among the signatures that do load instead, as when
+            # fitting all groups
+            logger.warning('Loading all signature files to subsample the '
+                           'loaded signatures instead')
+            sketch_series = load_sketch_series(
+                metadata_csv, metadata[sig_col], ksize, molecule,
+                cache_dir=cache_dir, max_cache_size=max_cache_size)
+            group1_sigs, group2_sigs = subsample_loaded_sketches(
+                group1, metadata, group_col, sketch_series,
+                max_group_size=max_group_size)
+        coefficients, hashes, regularization = fit_group(
+            group1_sigs, group2_sigs, verbose=verbose, C=C, n_jobs=n_jobs, solver=solver,
+            penalty=penalty, random_state=random_state,
+            with_abundance=with_abundance,
+            abundance_transform=abundance_transform, prescreen=prescreen,
+            path=path, collapse=collapse_identical, coarse=coarse,
+            result_cache=result_cache)
+        write_hash_coefficients(coefficients, hashes, group1, threshold,
+                                regularization=regularization)
+        return
+
+    # Load all sketches into one object for reference later
+    sketch_series = load_sketch_series(
+        metadata_csv, metadata[sig_col], ksize, molecule, cache_dir=cache_dir,
+        max_cache_size=max_cache_size)
+
+    if multinomial:
+        X, y, hashes = get_multinomial_training_data(
+            metadata, group_col, sketch_series, max_group_size=max_group_size,
+            with_abundance=with_abundance,
+            abundance_transform=abundance_transform)
+        members = None
+        if collapse_identical:
+            X, members = collapse_identical_columns(X)
+        coefficients = multinomial_hash_expression(
+            X, y, verbose=verbose, C=C, n_jobs=n_jobs, solver=solver,
+            penalty=penalty, random_state=random_state)
+        for group, group_coefficients in coefficients.items():
+            if members is not None:
+                group_coefficients = group_coefficients[members]
+            write_hash_coefficients(group_coefficients, hashes, group,
+                                    threshold)
+    elif stability_rounds is not None:
+        # Parallelism is over rounds, so each fit gets a single job
+        groups = [group1] if group1 is not None \
+            else metadata[group_col].unique()
+        stability_selection_in_parallel(
+            metadata, group_col, groups, sketch_series, threshold,
+            n_rounds=stability_rounds, cutoff=stability_cutoff,
+            sample_fraction=stability_sample_fraction, processes=n_jobs,
+            max_group_size=max_group_size, with_abundance=with_abundance,
+            abundance_transform=abundance_transform, prescreen=prescreen,
+            path=path, random_state=random_state, verbose=verbose, C=C,
+            n_jobs=1, solver=solver, penalty=penalty,
+            collapse=collapse_identical, coarse=coarse)
+    elif parallel_groups:
+        # Parallelism is over groups, so each fit gets a single job
+        fit_all_groups_in_parallel(
+            metadata, group_col, sketch_series, threshold, processes=n_jobs,
+            max_group_size=max_group_size, with_abundance=with_abundance,
+            abundance_transform=abundance_transform, prescreen=prescreen,
+            path=path, verbose=verbose, C=C, n_jobs=1, solver=solver,
+            penalty=penalty, random_state=random_state,
+            collapse=collapse_identical, coarse=coarse,
+            result_cache=result_cache)
     else:
         for group1, df in metadata.groupby(group_col):
             logger.info(f"\n--- group: {group1} ---")
-            coefficients = get_hashes_enriched_in_group(group1, metadata, group_col,
-                                                        sketch_series, verbose=verbose,
-                                                        C=C,
-                                                        n_jobs=n_jobs, solver=solver,
-                                                        penalty=penalty,
-                                                        random_state=random_state,
-                                                        max_group_size=max_group_size,
-                                                        with_abundance=with_abundance)
-            write_hash_coefficients(coefficients, group1, threshold)
-
-
-def write_hash_coefficients(coefficients, group, threshold):
+            coefficients, hashes, regularization = get_hashes_enriched_in_group(
+                group1, metadata, group_col, sketch_series, verbose=verbose,
+                C=C, n_jobs=n_jobs, solver=solver, penalty=penalty,
+                random_state=random_state, max_group_size=max_group_size,
+                with_abundance=with_abundance,
+                abundance_transform=abundance_transform, prescreen=prescreen,
+                path=path, collapse=collapse_identical, coarse=coarse,
+                result_cache=result_cache)
+            write_hash_coefficients(coefficients, hashes, group1, threshold,
+                                    regularization=regularization)
+
+
+def sanitize_group(group):
+    """Prefix of the output files of a group"""
+    from pathvalidate import sanitize_filename
     # No funny characters, and all lowercase, no spaces
-    sanitized = sanitize_filename(group).lower().replace(' ', '_')
+    return sanitize_filename(group).lower().replace(' ', '_')
 
-    # Write hashes with coefficients to file
-    csv = f'{sanitized}__hash_coefficients.csv'
-    coefficients.to_csv(csv, header=False)
 
-    # Write only hashes above threshold to file
-    filtered_coef = coefficients[coefficients > threshold]
-    txt = f'{sanitized}__informative_hashes.txt'
-    informative_hashes = pd.Series(filtered_coef.index)
-    informative_hashes.to_csv(txt, index=False, header=False)
+def write_group_file_prefixes(groups, filename=GROUP_FILE_PREFIXES_CSV):
+    """Write the prefix of the output files of every group
 
+    The "prefix" and "group" columns let the pipeline find the group of each
+    output file, without reimplementing sanitize_group
+    """
+    import pandas as pd
+    pd.DataFrame({
+        'prefix': [sanitize_group(group) for group in groups],
+        'group': groups,
+    }).to_csv(filename, index=False)
 
-if __name__ == "__main__":
+
+def save_coefficients_npz(filename, group, hashes, coefficients, informative):
+    """Save the nonzero coefficients and informative hashes of a group
+
+    The arrays of the npz are "group", "hashes" (uint64), "coefficients" and
+    "informative" (bool) of every hash with a nonzero coefficient or that is
+    informative, see combine_hash_coefficients.py
+    """
+    keep = np.flatnonzero((coefficients != 0) | informative)
+    np.savez_compressed(filename, group=np.array(group),
+                        hashes=np.asarray(hashes[keep], dtype=np.uint64),
+                        coefficients=coefficients[keep],
+                        informative=informative[keep])
+
+
+def write_hash_coefficients(coefficients, hashes, group, threshold,
+                            regularization=None):
+    """Write nonzero coefficients and informative hashes of a group
+
+    The nonzero coefficients are written to "<group>__hash_coefficients.csv",
+    the informative hashes to "<group>__informative_hashes.txt", and both to
+    "<group>__hash_coefficients.npz" by save_coefficients_npz.
+
+    With regularization, the path and path coefficients returned by
+    regularization_path, also write the summary of the path to
+    "<group>__regularization_path.csv" and the nonzero coefficients of every
+    C to "<group>__regularization_path_coefficients.csv"
+    """
+    import pandas as pd
+    with profiler.stage('write_coefficients'):
+        sanitized = sanitize_group(group)
+
+        # Write hashes with nonzero coefficients to file, only mapping those
+        # columns back to their hash values
+        csv = f'{sanitized}__hash_coefficients.csv'
+        nonzero = np.flatnonzero(coefficients)
+        nonzero_coef = pd.Series(coefficients[nonzero], index=hashes[nonzero])
+        nonzero_coef.to_csv(csv, header=False)
+
+        # Write only hashes above threshold to file
+        informative = coefficients > threshold
+        informative_hashes = pd.Series(hashes[informative])
+        txt = f'{sanitized}__informative_hashes.txt'
+        informative_hashes.to_csv(txt, index=False, header=False)
+
+        save_coefficients_npz(f'{sanitized}__hash_coefficients.npz', group,
+                              hashes, coefficients, informative)
+
+        if regularization is not None:
+            path, path_coefficients = regularization
+            path.to_csv(f'{sanitized}__regularization_path.csv', index=False)
+            path_coefficients = path_coefficients.tocoo()
+            pd.DataFrame({
+                'C': path['C'].values[path_coefficients.row],
+                'hash': hashes[path_coefficients.col],
+                'coefficient': path_coefficients.data,
+            }).to_csv(f'{sanitized}__regularization_path_coefficients.csv',
+                      index=False)
+
+
+def write_stability_selection(frequencies, mean_coefficients, hashes, group,
+                              cutoff):
+    """Write selection frequencies, mean coefficients and stable hashes
+
+    "<group>__stability_selection.csv" has the selection frequency and mean
+    coefficient over all rounds of every hash selected at least once,
+    "<group>__hash_coefficients.csv" the nonzero mean coefficients and
+    "<group>__informative_hashes.txt" the hashes selected in at least a
+    cutoff fraction of the rounds, and "<group>__hash_coefficients.npz" both.
+    """
+    import pandas as pd
+    with profiler.stage('write_coefficients'):
+        sanitized = sanitize_group(group)
+
+        selected = frequencies > 0
+        pd.DataFrame({
+            'hash': hashes[selected],
+            'selection_frequency': frequencies[selected],
+            'mean_coefficient': mean_coefficients[selected],
+        }).to_csv(f'{sanitized}__stability_selection.csv', index=False)
+
+        nonzero = np.flatnonzero(mean_coefficients)
+        nonzero_coef = pd.Series(mean_coefficients[nonzero],
+                                 index=hashes[nonzero])
+        nonzero_coef.to_csv(f'{sanitized}__hash_coefficients.csv', header=False)
+
+        informative = frequencies >= cutoff
+        informative_hashes = pd.Series(hashes[informative])
+        informative_hashes.to_csv(f'{sanitized}__informative_hashes.txt',
+                                  index=False, header=False)
+
+        save_coefficients_npz(f'{sanitized}__hash_coefficients.npz', group,
+                              hashes, mean_coefficients, informative)
+    logger.info(f'{len(informative_hashes)} hashes selected in at least '
+                f'{cutoff:.0%} of rounds')
+
+
+def cli(argv=None):
     parser = argparse.ArgumentParser(
         description="""Perform logistic regression on """)
     parser.add_argument("--metadata-csv", type=str,
@@ -216,6 +1500,15 @@ if __name__ == "__main__":
         '--with-abundance', action='store_true',
         help='Include hash abundances for differential hash expression'
     )
+    parser.add_argument('--abundance-transform', type=str, default=None,
+                        choices=ABUNDANCE_TRANSFORMS,
+                        help='With --with-abundance, rescale the abundances '
+                             'of the feature matrix, keeping it sparse, so '
+                             'that the saga solver converges in fewer '
+                             'iterations: log(1 + abundance), normalize each '
+                             'sample to the median total abundance, TF-IDF, '
+                             'or divide each hash by its maximum abundance. '
+                             'Not supported with --streaming')
     parser.add_argument('-g', "--group-col", type=str,
                         default='group',
                         help="Name of column in metadata containing paths to signature "
@@ -263,6 +1556,119 @@ sklearn.preprocessing.""")
     parser.add_argument('-p', '--n-jobs', type=int, default=1,
                         help='Number of concurrent processes to use for'
                              ' joblib.Parallel')
+    parser.add_argument('--parallel-groups', action='store_true',
+                        help='If --group1 is not provided, build the feature matrix '
+                             'of all signatures once and fit every group vs the '
+                             'rest concurrently on --n-jobs processes, sharing '
+                             'the matrix through memory-mapped files')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='If provided, keep the hashes and abundances parsed '
+                             'from each signature as memory-mapped arrays in this '
+                             'folder, so that re-runs do not re-parse the '
+                             'signature JSON files')
+    parser.add_argument('--max-cache-size', type=float,
+                        default=sourmash_utils.MAX_CACHE_SIZE / 1024 ** 3,
+                        help='Maximum size of --cache-dir in GiB. Least recently '
+                             'used signatures are evicted first')
+    parser.add_argument('--cache-results', action='store_true',
+                        help='Also keep the fit of each group in --cache-dir, '
+                             'keyed by a digest of its subsampled signatures '
+                             'and the fitting parameters, and reuse it '
+                             'instead of fitting again on re-runs. Not '
+                             'supported with --streaming, --multinomial or '
+                             '--stability-rounds')
+    parser.add_argument('--min-prevalence', type=float, default=None,
+                        help='Before fitting, drop hashes present in less than '
+                             'this fraction of group1 samples, e.g. 0.05')
+    parser.add_argument('--prescreen-top-n', type=int, default=None,
+                        help='Before fitting, keep only this many hashes with the '
+                             'highest --prescreen-statistic')
+    parser.add_argument('--prescreen-statistic', type=str,
+                        default=PRESCREEN_STATISTIC, choices=PRESCREEN_STATISTICS,
+                        help='Univariate statistic on hash presence/absence in '
+                             'group1 vs the rest used by --prescreen-top-n: '
+                             'chi-squared, Fisher\'s exact test, or absolute '
+                             'difference in the fraction of samples with the hash')
+    parser.add_argument('--regularization-path', type=float, nargs='+',
+                        default=None, metavar='C',
+                        help='Fit every one of these inverse regularization '
+                             'strengths, from the smallest to the largest, '
+                             'warm starting each fit from the previous one. '
+                             'Uses the last C unless --target-n-informative or '
+                             '--cv-folds is given, and writes the fits of all '
+                             'Cs to <group>__regularization_path.csv and '
+                             '<group>__regularization_path_coefficients.csv')
+    path_selection = parser.add_mutually_exclusive_group()
+    path_selection.add_argument('--target-n-informative', type=int, default=None,
+                                help='With --regularization-path, use the first '
+                                     'C with at least this many informative '
+                                     'hashes, and stop there')
+    path_selection.add_argument('--cv-folds', type=int, default=None,
+                                help='With --regularization-path, use the C with '
+                                     'the best balanced accuracy in this many '
+                                     'cross-validation folds, fit on --n-jobs '
+                                     'processes')
+    parser.add_argument('--stability-rounds', type=int, default=None,
+                        help='Stability selection: fit every group (or only '
+                             '--group1) vs the rest on this many random '
+                             'subsamples, concurrently on --n-jobs processes '
+                             'sharing one memory-mapped feature matrix, and '
+                             'write how often each hash is selected to '
+                             '<group>__stability_selection.csv')
+    parser.add_argument('--stability-cutoff', type=float, default=0.6,
+                        help='With --stability-rounds, informative hashes are '
+                             'those selected in at least this fraction of the '
+                             'rounds')
+    parser.add_argument('--stability-sample-fraction', type=float, default=0.5,
+                        help='With --stability-rounds, fraction of the samples '
+                             'of the group and of the rest drawn in each round, '
+                             'at most --max-group-size')
+    parser.add_argument('--multinomial', action='store_true',
+                        help='If --group1 is not provided, fit a single '
+                             'multinomial logistic regression of all groups '
+                             'on one feature matrix, instead of one fit per '
+                             'group vs the rest, and write the coefficients '
+                             'of each group to its usual files. Not supported '
+                             'by the liblinear solver')
+    parser.add_argument('--collapse-identical-hashes', action='store_true',
+                        help='Fit a single feature for the hashes present in '
+                             'exactly the same samples, e.g. of the same '
+                             'protein, and give all of them its coefficient. '
+                             'Not supported with --with-abundance')
+    parser.add_argument('--coarse-scaled', type=int, default=None,
+                        help='Coarse-to-fine fitting: first fit only the '
+                             'hashes kept by downsampling the signatures to '
+                             'this scaled value, e.g. 100, then refit at full '
+                             'resolution only the hashes present in similar '
+                             'samples as the informative hashes of the first '
+                             'fit. Not supported with --streaming or '
+                             '--multinomial')
+    parser.add_argument('--coarse-min-similarity', type=float,
+                        default=COARSE_MIN_SIMILARITY,
+                        help='With --coarse-scaled, minimum Jaccard '
+                             'similarity of the samples containing a hash to '
+                             'those containing an informative hash of the '
+                             'coarse fit, to refit it')
+    parser.add_argument('--coarse-top-n', type=int, default=None,
+                        help='With --coarse-scaled, refit at most this many '
+                             'of the most similar hashes')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Fit on all signatures without subsampling, '
+                             'reading --chunk-size signature files at a time '
+                             'and training a logistic regression by stochastic '
+                             'gradient descent over --epochs passes, so memory '
+                             'does not grow with the number of samples. Use '
+                             'with --cache-dir to avoid re-parsing the '
+                             'signatures every epoch')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='With --streaming, number of signature files per '
+                             'chunk')
+    parser.add_argument('--epochs', type=int, default=EPOCHS,
+                        help='With --streaming, number of passes over all '
+                             'signatures')
+    parser.add_argument('--l1-ratio', type=float, default=0.15,
+                        help="With --streaming and --penalty elasticnet, the "
+                             "mix of L1 and L2 penalty, 1 being only L1")
     parser.add_argument('-m', '--max-group-size', type=int, default=MAX_GROUP_SIZE,
                         help='If a group is larger than this, subsample random cells '
                              '(using the --random-state) ')
@@ -276,9 +1682,39 @@ sklearn.preprocessing.""")
                              "the metadata csv. Useful primarily for Nextflow "
                              "pipelines, as the files needed for each process are soft"
                              " linked into the working folder")
+    sourmash_utils.add_profile_args(parser)
 
     add_construct_moltype_args(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.streaming and (args.regularization_path or args.stability_rounds
+                           or args.min_prevalence or args.prescreen_top_n):
+        parser.error('--streaming does not support --regularization-path, '
+                     '--stability-rounds or prescreening')
+    if args.multinomial and (args.group1 or args.streaming
+                             or args.regularization_path
+                             or args.stability_rounds or args.min_prevalence
+                             or args.prescreen_top_n):
+        parser.error('--multinomial does not support --group1, --streaming, '
+                     '--regularization-path, --stability-rounds or '
+                     'prescreening')
+    if args.collapse_identical_hashes and (args.with_abundance
+                                           or args.streaming):
+        parser.error('--collapse-identical-hashes does not support '
+                     '--with-abundance or --streaming')
+    if args.cache_results and (not args.cache_dir or args.streaming
+                               or args.multinomial or args.stability_rounds):
+        parser.error('--cache-results requires --cache-dir, and does not '
+                     'support --streaming, --multinomial or '
+                     '--stability-rounds')
+    if args.abundance_transform and (not args.with_abundance
+                                     or args.streaming):
+        parser.error('--abundance-transform requires --with-abundance, and '
+                     'does not support --streaming')
+    if args.coarse_scaled and (args.streaming or args.multinomial):
+        parser.error('--coarse-scaled does not support --streaming or '
+                     '--multinomial')
+    if args.profile:
+        profiler.enable(trace_memory=args.profile_tracemalloc)
 
     # Ensure that protein ksizes are divisible by 3
     if (args.protein or args.dayhoff or args.hp) and not args.input_is_protein:
@@ -304,4 +1740,32 @@ sklearn.preprocessing.""")
          random_state=args.random_state,
          use_sig_basename=args.use_sig_basename,
          max_group_size=args.max_group_size,
-         with_abundance=args.with_abundance)
+         with_abundance=args.with_abundance,
+         parallel_groups=args.parallel_groups,
+         cache_dir=args.cache_dir,
+         max_cache_size=int(args.max_cache_size * 1024 ** 3),
+         min_prevalence=args.min_prevalence,
+         prescreen_top_n=args.prescreen_top_n,
+         prescreen_statistic=args.prescreen_statistic,
+         regularization_path_Cs=args.regularization_path,
+         target_n_informative=args.target_n_informative,
+         cv_folds=args.cv_folds,
+         stability_rounds=args.stability_rounds,
+         stability_cutoff=args.stability_cutoff,
+         stability_sample_fraction=args.stability_sample_fraction,
+         streaming=args.streaming,
+         chunk_size=args.chunk_size,
+         epochs=args.epochs,
+         l1_ratio=args.l1_ratio,
+         multinomial=args.multinomial,
+         collapse_identical=args.collapse_identical_hashes,
+         cache_results=args.cache_results,
+         abundance_transform=args.abundance_transform,
+         coarse_scaled=args.coarse_scaled,
+         coarse_min_similarity=args.coarse_min_similarity,
+         coarse_top_n=args.coarse_top_n)
+    profiler.write(args.profile, 'Differential hash expression profile')
+
+
+if __name__ == "__main__":
+    sys.exit(sourmash_utils.run_script(cli))
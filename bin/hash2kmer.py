@@ -6,25 +6,58 @@ NOTE: for now, only implemented for DNA & for seed=42.
 """
 import sys
 import argparse
-from sourmash._minhash import hash_murmur
-import screed
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+import gzip
+from itertools import islice
+import json
+import multiprocessing
+import os
+import subprocess
 import csv
-from sourmash.logging import notify, error
-from sourmash.cli.utils import add_construct_moltype_args
-from sourmash.sourmash_args import calculate_moltype
-from sencha.sequence_encodings import encode_peptide, AMINO_ACID_SINGLE_LETTERS
+import numpy as np
+# sourmash, screed and sencha are imported where they are used, as importing
+# them is slow
+
+# Local file
+import sourmash_utils
+from sourmash_utils import (add_construct_moltype_args, calculate_moltype,
+                            error, notify, profiler)
 
 NOTIFY_EVERY_BP = 1e7
 
+# Number of k-mers to hash at once, bounding memory use on long sequences
+WINDOWS_PER_CHUNK = 2 ** 16
+
+# Letters that screed.rc can reverse complement
+DNA_LETTERS = set('ACGTN')
+
+# Maximum number of per-hash sequence files to keep open at once
+MAX_OPEN_FILES = 256
+
+# Sequence length to send to a worker process at once with --processes
+BP_PER_CHUNK = 2 ** 22
+
+# Files of a k-mer index built by kmer_index.py
+INDEX_METADATA = 'index.json'
+INDEX_KEYS = 'keys.npy'
+INDEX_OFFSETS = 'offsets.npy'
+INDEX_POSTINGS = 'postings.npy'
+INDEX_RECORDS = 'records.npy'
+INDEX_UNHASHED = 'unhashed.npy'
+
 
 def get_kmer_moltype(sequence, start, ksize, moltype, input_is_protein):
     kmer = sequence[start:start + ksize]
     if moltype == "DNA":
         # Get reverse complement
+        import screed
         kmer_rc = screed.rc(kmer)
         if kmer > kmer_rc:                # choose fwd or rc
             kmer = kmer_rc
     elif input_is_protein:
+        from sencha.sequence_encodings import encode_peptide
         kmer = encode_peptide(kmer, moltype)
     elif not input_is_protein:
         raise NotImplementedError("Currently cannot translate DNA to protein "
@@ -43,15 +76,21 @@ def revise_ksize(ksize, moltype, input_is_protein):
         return ksize
 
 
-def get_kmers_for_hashvals(sequence, hashvals, ksize, moltype,
-                           input_is_protein):
-    "Return k-mers from 'sequence' that yield hashes in 'hashvals'."
+def get_kmers_for_hashvals_per_position(sequence, hashvals, ksize, moltype,
+                                        input_is_protein):
+    """Return k-mers from 'sequence' that yield hashes in 'hashvals'.
+
+    Hashes one k-mer at a time. Used for sequences that the batched
+    get_kmers_for_hashvals can't handle, so that they behave as before
+    """
     # uppercase!
     sequence = sequence.upper()
 
     # Divide ksize by 3 if sequence is protein
     ksize = revise_ksize(ksize, moltype, input_is_protein)
 
+    from sencha.sequence_encodings import AMINO_ACID_SINGLE_LETTERS
+    from sourmash._minhash import hash_murmur
     for start in range(0, len(sequence) - ksize + 1):
         # Skip protein sequences with invalid input
         # (workaround for sencha bug that wrote "Writing translate
@@ -71,7 +110,138 @@ def get_kmers_for_hashvals(sequence, hashvals, ksize, moltype,
             yield kmer, hashval
 
 
-def main():
+def as_hash_array(hashvals):
+    """Sorted uint64 array of hashes, for membership tests with searchsorted"""
+    if isinstance(hashvals, np.ndarray):
+        return hashvals
+    return np.array(sorted(hashvals), dtype=np.uint64)
+
+
+def sliding_windows(sequence_bytes, ksize):
+    """(n_windows, ksize) read-only view of all windows of a uint8 array"""
+    n_windows = len(sequence_bytes) - ksize + 1
+    stride = sequence_bytes.strides[0]
+    return np.lib.stride_tricks.as_strided(
+        sequence_bytes, shape=(n_windows, ksize), strides=(stride, stride),
+        writeable=False)
+
+
+def choose_canonical(windows, windows_rc):
+    """Per row, the lexicographically smaller of the forward and rc window"""
+    differs = windows != windows_rc
+    first_difference = differs.argmax(axis=1)
+    rows = np.arange(len(windows))
+    use_rc = differs[rows, first_difference] & (
+        windows_rc[rows, first_difference] < windows[rows, first_difference])
+    return np.where(use_rc[:, np.newaxis], windows_rc, windows)
+
+
+class NotBulkHashable(ValueError):
+    """The windows of a record can only be hashed one k-mer at a time"""
+
+
+def encode_record(sequence, ksize, moltype, input_is_protein):
+    """Validate and encode an uppercase record to hash its windows in bulk
+
+    ksize is the revised ksize, see revise_ksize. Returns uint8 arrays of the
+    encoded record and, for DNA, of its reverse complement (else None), or
+    None if the record has no k-mers to hash. Raises NotBulkHashable for
+    records whose windows are not fixed-width.
+    """
+    if len(sequence) < ksize:
+        return None
+
+    # Importing sencha takes seconds, so it is only imported when needed,
+    # which is not the case for DNA
+    if input_is_protein:
+        from sencha.sequence_encodings import (encode_peptide,
+                                               AMINO_ACID_SINGLE_LETTERS)
+
+    # Skip protein sequences with invalid input
+    # (workaround for sencha bug that wrote "Writing translate
+    # summary to coding_summary.json" to standard output and thus to the
+    # protein fasta)
+    if input_is_protein and not set(sequence).issubset(AMINO_ACID_SINGLE_LETTERS):
+        return None
+
+    encoded_rc = None
+    if moltype == "DNA":
+        if not set(sequence).issubset(DNA_LETTERS):
+            # screed.rc fails on these, at the first window containing them
+            raise NotBulkHashable(sequence)
+        encoded = sequence
+        import screed
+        encoded_rc = np.frombuffer(screed.rc(sequence).encode(),
+                                   dtype=np.uint8)
+    elif input_is_protein:
+        # Encoding is per letter, so the encoded windows are the windows of
+        # the encoded sequence
+        encoded = encode_peptide(sequence, moltype)
+    else:
+        raise NotImplementedError("Currently cannot translate DNA to protein "
+                                  "sequence")
+
+    if not encoded.isascii():
+        # Windows of multi-byte characters are not fixed-width
+        raise NotBulkHashable(sequence)
+    return np.frombuffer(encoded.encode(), dtype=np.uint8), encoded_rc
+
+
+def iter_window_hashes(encoded, encoded_rc, ksize):
+    """Yield (windows, hashes) of all windows of an encoded record in order,
+    WINDOWS_PER_CHUNK at a time"""
+    n_windows = len(encoded) - ksize + 1
+    for start in range(0, n_windows, WINDOWS_PER_CHUNK):
+        stop = min(start + WINDOWS_PER_CHUNK, n_windows)
+        windows = sliding_windows(encoded[start:stop + ksize - 1], ksize)
+        if encoded_rc is not None:
+            # Reverse complement of the window starting at i starts at
+            # len(sequence) - ksize - i in the reverse complemented sequence
+            rc_start = n_windows - stop
+            windows_rc = sliding_windows(
+                encoded_rc[rc_start:rc_start + stop - start + ksize - 1],
+                ksize)[::-1]
+            windows = choose_canonical(windows, windows_rc)
+        yield windows, sourmash_utils.hash_murmur_many(windows)
+
+
+def get_kmers_for_hashvals(sequence, hashvals, ksize, moltype,
+                           input_is_protein):
+    """Return k-mers from 'sequence' that yield hashes in 'hashvals'.
+
+    The record is validated and encoded once, and all of its windows are
+    hashed in bulk with sourmash_utils.hash_murmur_many, in chunks of
+    WINDOWS_PER_CHUNK. Output is the same as hashing one k-mer at a time.
+    hashvals can be a set, or a sorted uint64 array to avoid converting the
+    set for every record.
+    """
+    # uppercase!
+    sequence = sequence.upper()
+
+    # Divide ksize by 3 if sequence is protein
+    ksize = revise_ksize(ksize, moltype, input_is_protein)
+
+    try:
+        encoded = encode_record(sequence, ksize, moltype, input_is_protein)
+    except NotBulkHashable:
+        yield from get_kmers_for_hashvals_per_position(
+            sequence, hashvals, ksize, moltype, input_is_protein)
+        return
+    if encoded is None:
+        return
+
+    hash_array = as_hash_array(hashvals)
+    if not len(hash_array):
+        return
+
+    for windows, hashes in iter_window_hashes(*encoded, ksize):
+        positions = np.searchsorted(hash_array, hashes)
+        positions[positions == len(hash_array)] = 0
+        for i in np.flatnonzero(hash_array[positions] == hashes):
+            yield windows[i].tobytes().decode(), int(hashes[i])
+
+
+def main(argv=None):
     p = argparse.ArgumentParser()
     p.add_argument('hashfile') 					# file that contains hashes
     p.add_argument('seqfiles', nargs='+')		# sequence files from which to look for matches
@@ -79,6 +249,16 @@ def main():
                    help='save matching sequences to this file.')
     p.add_argument('--output-kmers', type=str, default=None,
                    help='save matching kmers to this file.')
+    p.add_argument('--bgzip', action='store_true',
+                   help='compress outputs ending in ".gz" with bgzip instead '
+                        'of gzip, so they can be indexed by samtools faidx')
+    p.add_argument('--output-dir', type=str, default=None,
+                   help='save matching k-mers and sequences of each hash to '
+                        'separate files in this folder, reading each sequence '
+                        'file only once for all hashes. The hashfile may then '
+                        'contain "hash,group" lines, and files are named '
+                        '"[group__]hash-<hash>__kmer.txt" and '
+                        '"[group__]hash-<hash>__sequences.fasta"')
     p.add_argument('-k', '--ksize', type=int, required=True)
     p.add_argument(
         '--input-is-protein', action='store_true',
@@ -90,98 +270,566 @@ def main():
              'sequence from each provided sequence file. Useful if you are '
              'searching for only one k-mer'
     )
+    p.add_argument('--processes', type=int, default=1,
+                   help='number of processes hashing chunks of sequence '
+                        'records in parallel. Output is in the same order as '
+                        'with a single process')
+    p.add_argument('--index', type=str, default=None,
+                   help='folder of a k-mer index of the sequence files built '
+                        'by kmer_index.py, to read only the records '
+                        'containing the hashes instead of all of them')
+    sourmash_utils.add_profile_args(p)
     add_construct_moltype_args(p)
-    args = p.parse_args()
+    args = p.parse_args(argv)
+    if args.profile:
+        profiler.enable(trace_memory=args.profile_tracemalloc)
 
-    # set up the outputs.
-    seqout_fp = None
-    if args.output_sequences:
-        seqout_fp = open(args.output_sequences, 'wt')
+    moltype = calculate_moltype(args)
+
+    kmer_index = None
+    if args.index:
+        with profiler.stage('load_index'):
+            kmer_index = load_kmer_index(args.index)
+        problem = check_kmer_index(kmer_index, args.seqfiles, args.ksize,
+                                   moltype, args.input_is_protein)
+        if problem:
+            error("ERROR, can't use k-mer index {}: {}", args.index, problem)
+            return -1
 
-    kmerout_fp = None
+    if args.output_dir:
+        returncode = main_per_hash(args, moltype, kmer_index)
+    else:
+        returncode = main_single_output(args, moltype, kmer_index)
+    profiler.write(args.profile, 'hash2kmer profile')
+    return returncode
 
-    if not (seqout_fp or kmerout_fp):
+
+def main_single_output(args, moltype, kmer_index=None):
+    """Find k-mers and sequences of all hashes, with one output for all"""
+    if not (args.output_sequences or args.output_kmers):
         error("No output options given!")
         return(-1)
 
-    if args.output_kmers:
-        kmerout_fp = open(args.output_kmers, 'wt')
-        kmerout_w = csv.writer(kmerout_fp)
-        kmerout_w.writerow(['kmer', 'hashval'])
+    check_protein_ksize(args)
+
+    # load in all the hashes
+    with profiler.stage('load_hashes'):
+        hashes = set(read_hash_groups(args.hashfile))
+    profiler.count('hashes', len(hashes))
+
+    if not hashes:
+        error("ERROR, no hashes loaded from {}!", args.hashfile)
+        return -1
+
+    notify('loaded {} distinct hashes from {}', len(hashes), args.hashfile)
+
+    # set up the outputs, closed even if scanning fails, as --worker runs
+    # many jobs in the same process
+    with ExitStack() as outputs:
+        seqout_fp = None
+        if args.output_sequences:
+            seqout_fp = open_output(args.output_sequences, args.bgzip)
+            outputs.callback(seqout_fp.close)
+
+        kmerout_fp = None
+        if args.output_kmers:
+            kmerout_fp = open_output(args.output_kmers, args.bgzip)
+            outputs.callback(kmerout_fp.close)
+            kmerout_w = csv.writer(kmerout_fp)
+            kmerout_w.writerow(['kmer', 'hashval'])
+
+        # now, iterate over the input sequences and output those that
+        # overlap with hashes!
+        n_seq = 0
+        n = 0  # bp loaded
+        m = 0  # bp in found sequences
+        # K-mers are written as soon as they are found. Only the k-mers
+        # already written are kept, for deduplication, and there are about as
+        # many of them as hashes
+        found_kmers = set()
+        watermark = NOTIFY_EVERY_BP
+        with profiler.stage('scan_sequences'):
+            for filename, name, sequence, kmers in iter_records(
+                    args, kmer_index, hashes, moltype, first=args.first):
+                n += len(sequence)
+                n_seq += 1
+                while n >= watermark:
+                    sys.stderr.write(
+                        '... {} {} {}\r'.format(n_seq, watermark, filename))
+                    watermark += NOTIFY_EVERY_BP
+
+                for kmer, hashval in kmers:
+                    if kmer not in found_kmers:
+                        found_kmers.add(kmer)
+                        if kmerout_fp:
+                            kmerout_w.writerow([kmer, str(hashval)])
+
+                # write out sequence, once with all of its matching hashes
+                if seqout_fp and kmers:
+                    hashvals = dict.fromkeys(
+                        str(hashval) for _, hashval in kmers)
+                    seqout_fp.write('>{} matching_hashvals={}\n{}\n'.format(
+                        name, ','.join(hashvals), sequence))
+                    m += len(sequence)
+                if args.first and m > 0:
+                    break
+
+    profiler.count('sequences_scanned', n_seq)
+    profiler.count('bp_scanned', n)
+    profiler.count('bp_written', m)
+    profiler.count('kmers_found', len(found_kmers))
+
+    if seqout_fp:
+        notify('read {} bp, wrote {} bp in matching sequences', n, m)
+
+    if kmerout_fp:
+        notify('read {} bp, found {} kmers matching hashvals', n,
+               len(found_kmers))
+
+
+class BgzipWriter:
+    """Text file compressed by a bgzip process, in the BGZF format of htslib"""
 
-    # Ensure that protein ksizes are divisible by 3
+    def __init__(self, filename):
+        self.fp = open(filename, 'wb')
+        self.process = subprocess.Popen(
+            ['bgzip', '--stdout'], stdin=subprocess.PIPE, stdout=self.fp,
+            universal_newlines=True)
+
+    def write(self, text):
+        return self.process.stdin.write(text)
+
+    def close(self):
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.fp.close()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, 'bgzip')
+
+
+def open_output(filename, bgzip=False):
+    """Open a text file for writing, gzip compressed if it ends in .gz"""
+    if not filename.endswith('.gz'):
+        return open(filename, 'wt')
+    if bgzip:
+        return BgzipWriter(filename)
+    return gzip.open(filename, 'wt')
+
+
+def check_protein_ksize(args):
+    """Ensure that protein ksizes are divisible by 3"""
     if (args.protein or args.dayhoff or args.hp) and not args.input_is_protein:
         if args.ksize % 3 != 0:
             error('protein ksizes must be divisible by 3, sorry!')
             error('bad ksizes: {}', ", ".join(args.ksize))
             sys.exit(-1)
 
-    # load in all the hashes
-    hashes = set()
-    for line in open(args.hashfile, 'rt'):
-        line = line.strip()
-        # Skip empty lines
-        if line:
-            hashval = int(line)
-            hashes.add(hashval)
 
-    moltype = calculate_moltype(args)
+def read_hash_groups(hashfile):
+    """Read hashes, one per line, each optionally followed by ",group"
 
-    if not hashes:
+    Returns an ordered mapping of every hash to the list of its groups
+    """
+    hash_groups = OrderedDict()
+    with open(hashfile, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            # Skip empty lines
+            if line:
+                hashval, _, group = line.partition(',')
+                groups = hash_groups.setdefault(int(hashval), [])
+                if group and group not in groups:
+                    groups.append(group)
+    return hash_groups
+
+
+def clean_group(group):
+    """Make group name filename-friendly, same as groupCleaner in main.nf"""
+    return group.replace(' ', '_').replace('/', '-slash-').lower()
+
+
+class PerHashWriter:
+    """Write the matching k-mers and sequences of each hash to its own files
+
+    Sequence files are appended to as matches are found, keeping at most
+    max_open_files open at once. K-mers are few per hash, so they are kept in
+    memory and written on close. Every hash gets its files, even if empty.
+    """
+
+    def __init__(self, output_dir, hash_groups, max_open_files=MAX_OPEN_FILES):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.hash_groups = hash_groups
+        self.max_open_files = max_open_files
+        self.kmers = defaultdict(dict)
+        self.open_files = OrderedDict()
+        self.started = set()
+
+    def prefixes(self, hashval):
+        groups = self.hash_groups[hashval] or [None]
+        for group in groups:
+            prefix = f'hash-{hashval}'
+            if group is not None:
+                prefix = f'{clean_group(group)}__{prefix}'
+            yield os.path.join(self.output_dir, prefix)
+
+    def _get_file(self, filename):
+        if filename in self.open_files:
+            self.open_files.move_to_end(filename)
+            return self.open_files[filename]
+        if len(self.open_files) >= self.max_open_files:
+            # Close least recently written file
+            _, fp = self.open_files.popitem(last=False)
+            fp.close()
+        mode = 'at' if filename in self.started else 'wt'
+        self.started.add(filename)
+        fp = self.open_files[filename] = open(filename, mode)
+        return fp
+
+    def write_sequence(self, hashval, name, sequence):
+        for prefix in self.prefixes(hashval):
+            fp = self._get_file(f'{prefix}__sequences.fasta')
+            fp.write('>{}\n{}\n'.format(name, sequence))
+
+    def add_kmer(self, hashval, kmer):
+        self.kmers[hashval][kmer] = hashval
+
+    def close(self):
+        for fp in self.open_files.values():
+            fp.close()
+        self.open_files.clear()
+
+        for hashval in self.hash_groups:
+            for prefix in self.prefixes(hashval):
+                sequences = f'{prefix}__sequences.fasta'
+                if sequences not in self.started:
+                    open(sequences, 'wt').close()
+                with open(f'{prefix}__kmer.txt', 'wt') as fp:
+                    kmerout_w = csv.writer(fp)
+                    kmerout_w.writerow(['kmer', 'hashval'])
+                    for kmer, kmer_hashval in self.kmers[hashval].items():
+                        kmerout_w.writerow([kmer, str(kmer_hashval)])
+
+
+def main_per_hash(args, moltype, kmer_index=None):
+    """Find k-mers and sequences of all hashes, with separate outputs per hash"""
+    check_protein_ksize(args)
+
+    with profiler.stage('load_hashes'):
+        hash_groups = read_hash_groups(args.hashfile)
+    profiler.count('hashes', len(hash_groups))
+    if not hash_groups:
         error("ERROR, no hashes loaded from {}!", args.hashfile)
         return -1
+    notify('loaded {} distinct hashes from {}', len(hash_groups), args.hashfile)
 
-    notify('loaded {} distinct hashes from {}', len(hashes), args.hashfile)
-
-    # now, iterate over the input sequences and output those that overlap
-    # with hashes!
-    n_seq = 0
+    # Hashes still being searched for. With --first, hashes are removed once
+    # found and reading stops when all of them have been found
+    hashes = set(hash_groups)
+    writer = PerHashWriter(args.output_dir, hash_groups)
     n = 0  # bp loaded
     m = 0  # bp in found sequences
-    p = 0  # number of k-mers found
-    found_kmers = {}
+    n_seq = 0
     watermark = NOTIFY_EVERY_BP
-    for filename in args.seqfiles:
-        m, n = get_matching_hashes_in_file(
-            filename, args.ksize, moltype, args.input_is_protein, hashes,
-            found_kmers, m, n, n_seq, seqout_fp, watermark, args.first)
-        if args.first and m > 0:
-            break
+    with profiler.stage('scan_sequences'):
+        try:
+            for filename, name, sequence, kmers in iter_records(
+                    args, kmer_index, hashes, moltype):
+                n += len(sequence)
+                n_seq += 1
+                while n >= watermark:
+                    sys.stderr.write(
+                        '... {} {} {}\r'.format(n_seq, watermark, filename))
+                    watermark += NOTIFY_EVERY_BP
 
-    if seqout_fp:
-        notify('read {} bp, wrote {} bp in matching sequences', n, m)
+                found = set()
+                for kmer, hashval in kmers:
+                    if hashval in hashes:
+                        writer.add_kmer(hashval, kmer)
+                        found.add(hashval)
 
-    if kmerout_fp and found_kmers:
-        for kmer, hashval in found_kmers.items():
-            kmerout_w.writerow([kmer, str(hashval)])
-        notify('read {} bp, found {} kmers matching hashvals', n,
-               len(found_kmers))
+                # Write each matching record once per hash it contains
+                for hashval in found:
+                    writer.write_sequence(hashval, name, sequence)
+                    m += len(sequence)
+                if args.first and found:
+                    hashes -= found
+                    if not hashes:
+                        break
+        finally:
+            writer.close()
+
+    profiler.count('sequences_scanned', n_seq)
+    profiler.count('bp_scanned', n)
+    profiler.count('bp_written', m)
+    profiler.count('kmers_found', sum(len(k) for k in writer.kmers.values()))
+
+    notify('read {} bp, wrote {} bp in matching sequences', n, m)
+    notify('found k-mers for {} of {} hashes', len(writer.kmers),
+           len(hash_groups))
+    return 0
+
+
+def iter_records(args, kmer_index, hashes, moltype, first=False):
+    """Matching k-mers of the records of args.seqfiles, see
+    iter_matching_kmers, using the k-mer index if there is one"""
+    if kmer_index is not None:
+        return iter_indexed_kmers(
+            kmer_index, args.seqfiles, as_hash_array(hashes), args.ksize,
+            moltype, args.input_is_protein, first=first)
+    return iter_matching_kmers(
+        args.seqfiles, as_hash_array(hashes), args.ksize, moltype,
+        args.input_is_protein, first=first, processes=args.processes)
+
+
+def read_record_chunks(seqfiles, last_chunks=None, bp_per_chunk=BP_PER_CHUNK):
+    """Split the records of all files into chunks of about bp_per_chunk
+
+    Yields (file_index, chunk_index, records) with records a list of
+    (name, sequence) tuples and chunk_index counting within each file. Reading
+    a file stops after chunk last_chunks[file_index], if provided.
+    """
+    import screed
+    for file_index, filename in enumerate(seqfiles):
+        chunk_index = 0
+        records = []
+        chunk_bp = 0
+        for record in screed.open(filename):
+            if last_chunks is not None and \
+                    last_chunks[file_index] < chunk_index:
+                break
+            records.append((record.name, record.sequence))
+            chunk_bp += len(record.sequence)
+            if chunk_bp >= bp_per_chunk:
+                yield file_index, chunk_index, records
+                chunk_index += 1
+                records = []
+                chunk_bp = 0
+        if records:
+            yield file_index, chunk_index, records
+
+
+# State of worker processes, set once per process by _init_worker
+_worker = {}
+
+
+def _init_worker(hashvals, ksize, moltype, input_is_protein, first,
+                 last_chunks):
+    _worker.update(hashvals=hashvals, ksize=ksize, moltype=moltype,
+                   input_is_protein=input_is_protein, first=first,
+                   last_chunks=last_chunks)
+
+
+def _find_kmers_in_chunk(file_index, chunk_index, records):
+    """Matching k-mers of a chunk of records, in a worker process
+
+    Returns a list of (record index, [(kmer, hashval), ...]) for the records
+    with matches, or None if the chunk is no longer needed
+    """
+    last_chunks = _worker['last_chunks']
+    matches = []
+    for i, (name, sequence) in enumerate(records):
+        # Another worker found a match in an earlier chunk with --first, or
+        # the results are not read anymore
+        if last_chunks[file_index] < chunk_index:
+            return None
+        kmers = get_kmers_for_hashvals(
+            sequence, _worker['hashvals'], _worker['ksize'],
+            _worker['moltype'], _worker['input_is_protein'])
+        if _worker['first']:
+            kmers = islice(kmers, 1)
+        kmers = list(kmers)
+        if kmers:
+            matches.append((i, kmers))
+            if _worker['first']:
+                with last_chunks.get_lock():
+                    last_chunks[file_index] = min(last_chunks[file_index],
+                                                  chunk_index)
+                break
+    return matches
+
+
+def iter_matching_kmers(seqfiles, hashvals, ksize, moltype, input_is_protein,
+                        first=False, processes=1):
+    """Yield (filename, name, sequence, kmers) for every record, in input order
+
+    kmers is the list of (kmer, hashval) found in the record. With first, only
+    the first k-mer of the first matching record of each file is returned,
+    and no records after it in that file.
+
+    With more than one process, records are read in chunks that are hashed
+    in worker processes, and results are merged back in input order. With
+    first, workers skip the remaining chunks of a file as soon as any of them
+    finds a match in it, and all pending chunks are cancelled when the
+    caller stops iterating.
+    """
+    if processes <= 1:
+        import screed
+        for filename in seqfiles:
+            for record in screed.open(filename):
+                kmers = get_kmers_for_hashvals(
+                    record.sequence, hashvals, ksize, moltype,
+                    input_is_protein)
+                if first:
+                    kmers = islice(kmers, 1)
+                kmers = list(kmers)
+                yield filename, record.name, record.sequence, kmers
+                if first and kmers:
+                    break
+        return
+
+    # Per file, the last chunk whose results are needed
+    last_chunks = multiprocessing.Array('q', [sys.maxsize] * len(seqfiles))
+    chunks = read_record_chunks(seqfiles, last_chunks)
+    pending = deque()
+    with ProcessPoolExecutor(
+            processes, initializer=_init_worker,
+            initargs=(hashvals, ksize, moltype, input_is_protein, first,
+                      last_chunks)) as executor:
+        try:
+            while True:
+                # Keep all workers busy while merging results in order
+                while len(pending) < 2 * processes:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.append(
+                        (chunk, executor.submit(_find_kmers_in_chunk, *chunk)))
+                if not pending:
+                    break
+
+                (file_index, chunk_index, records), future = pending.popleft()
+                matches = future.result()
+                if matches is None or last_chunks[file_index] < chunk_index:
+                    continue
+                matches = dict(matches)
+                filename = seqfiles[file_index]
+                for i, (name, sequence) in enumerate(records):
+                    kmers = matches.get(i, [])
+                    yield filename, name, sequence, kmers
+                    if first and kmers:
+                        break
+        finally:
+            # Stop workers early if the caller stopped iterating
+            for file_index in range(len(seqfiles)):
+                last_chunks[file_index] = -1
+            for chunk, future in pending:
+                future.cancel()
+
+
+# K-mer indexes loaded by load_kmer_index, by folder and modification time
+_kmer_indexes = {}
+
+
+def open_fasta(filename):
+    """Open a FASTA file for reading bytes, gunzipped if it ends in .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def iter_fasta_records(fp):
+    """Yield (offset, name, sequence) of the records of a FASTA file opened
+    with open_fasta, from its current position
+
+    Records are parsed like screed does, and offset is the position of the
+    header line of each record, to seek to with fp.seek.
+    """
+    offset = fp.tell()
+    line = fp.readline()
+    while line:
+        header = line.decode().strip()
+        if not header.startswith('>'):
+            raise IOError("Bad FASTA format: no '>' at beginning of line: "
+                          f"{header}")
+        next_offset = offset + len(line)
+        lines = []
+        line = fp.readline()
+        while line and not line.startswith(b'>'):
+            lines.append(line.decode().strip())
+            next_offset += len(line)
+            line = fp.readline()
+        yield offset, header[1:].strip(), ''.join(lines)
+        offset = next_offset
+
+
+def load_kmer_index(index_dir):
+    """Load the metadata of a k-mer index built by kmer_index.py, and
+    memory-map its arrays
+
+    Indexes stay loaded for the next jobs of a worker, see
+    sourmash_utils.run_script, until they are rebuilt.
+    """
+    metadata = os.path.join(index_dir, INDEX_METADATA)
+    cache_key = os.path.realpath(index_dir), os.stat(metadata).st_mtime_ns
+    if cache_key in _kmer_indexes:
+        return _kmer_indexes[cache_key]
+
+    with open(metadata) as f:
+        index = json.load(f)
+    for key, name in (('keys', INDEX_KEYS), ('offsets', INDEX_OFFSETS),
+                      ('postings', INDEX_POSTINGS),
+                      ('records', INDEX_RECORDS),
+                      ('unhashed', INDEX_UNHASHED)):
+        index[key] = np.load(os.path.join(index_dir, name), mmap_mode='r')
+    _kmer_indexes[cache_key] = index
+    return index
+
+
+def check_kmer_index(index, seqfiles, ksize, moltype, input_is_protein):
+    """Return why the index can't be used for these arguments, or None
+
+    Sequence files are matched to the indexed files by their names and sizes
+    rather than their paths, so that they can be staged in another folder.
+    """
+    options = dict(ksize=ksize, moltype=moltype,
+                   input_is_protein=input_is_protein)
+    for key, value in options.items():
+        if index[key] != value:
+            return f'index was built with {key} {index[key]}, not {value}'
+    files = [dict(name=os.path.basename(filename),
+                  size=os.path.getsize(filename)) for filename in seqfiles]
+    if files != index['files']:
+        return ('sequence files are not the {} indexed files, in the same '
+                'order, or changed since'.format(len(index['files'])))
+    return None
+
+
+def iter_indexed_kmers(index, seqfiles, hashvals, ksize, moltype,
+                       input_is_protein, first=False):
+    """Yield (filename, name, sequence, kmers) like iter_matching_kmers, but
+    only for the records that the k-mer index says contain any of hashvals
+
+    Records are read by seeking to their offsets, and their k-mers are found
+    with get_kmers_for_hashvals, so matches are the same as when reading all
+    records. Records that were not hashed in bulk when indexing are always
+    read.
+    """
+    hash_array = as_hash_array(hashvals)
+    keys, offsets, postings = index['keys'], index['offsets'], \
+        index['postings']
+    positions = np.searchsorted(keys, hash_array)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == hash_array[found]
+    record_ids = np.unique(np.concatenate(
+        [postings[offsets[i]:offsets[i + 1]] for i in positions[found]]
+        + [index['unhashed'], np.array([], dtype=np.uint32)]))
+    records = index['records'][record_ids]
 
+    for file_index, filename in enumerate(seqfiles):
+        with open_fasta(filename) as fp:
+            for offset in records[records[:, 0] == file_index, 1]:
+                fp.seek(offset)
+                _, name, sequence = next(iter_fasta_records(fp))
+                kmers = get_kmers_for_hashvals(
+                    sequence, hash_array, ksize, moltype, input_is_protein)
+                if first:
+                    kmers = islice(kmers, 1)
+                kmers = list(kmers)
+                yield filename, name, sequence, kmers
+                if first and kmers:
+                    break
 
-def get_matching_hashes_in_file(filename, ksize, moltype, input_is_protein,
-                                hashes, found_kmers, m, n,
-                                n_seq, seqout_fp, watermark, first=False):
-    for record in screed.open(filename):
-        n += len(record.sequence)
-        n_seq += 1
-        while n >= watermark:
-            sys.stderr.write(
-                '... {} {} {}\r'.format(n_seq, watermark, filename))
-            watermark += NOTIFY_EVERY_BP
-
-        # now do the hard work of finding the matching k-mers!
-        for kmer, hashval in get_kmers_for_hashvals(
-                record.sequence, hashes, ksize, moltype, input_is_protein):
-            found_kmers[kmer] = hashval
-
-            # write out sequence
-            if seqout_fp:
-                seqout_fp.write('>{}\n{}\n'.format(record.name,
-                                                   record.sequence))
-                m += len(record.sequence)
-            if first:
-                return m, n
-    return m, n
 
 if __name__ == '__main__':
-    sys.exit(main())
+    sys.exit(sourmash_utils.run_script(main))
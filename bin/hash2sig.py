@@ -2,22 +2,35 @@
 """
 Given a list of hash values, create a sourmash signature.
 
+With --per-hash, create one signature per hash instead, named
+"hash-<value>", and save them all to the multi-signature --output file, or
+to separate "hash-<value>.sig" files in --output-dir.
+
 CTB: Should eventually be added to sourmash signature import/export.
 CTB: recommend people use scaled=1; make default?
 """
 import sys
 import argparse
-import sourmash
-from sourmash import MinHash
-from sourmash.logging import notify, error
-from sourmash.cli.utils import add_construct_moltype_args
+import os
+# sourmash is imported where it is used, as importing it is slow
+
+# Local file
+import sourmash_utils
+from sourmash_utils import add_construct_moltype_args, error, notify, profiler
 
 
-def main():
+def main(argv=None):
     p = argparse.ArgumentParser()
     p.add_argument('hashfile') 					# file that contains hashes
     p.add_argument('-o', '--output', default=None,
                    help='file to output signature to')
+    p.add_argument('--per-hash', action='store_true',
+                   help='create one signature per hash, named '
+                        '"hash-<value>", instead of one for all hashes')
+    p.add_argument('--output-dir', default=None,
+                   help='with --per-hash, save each signature to '
+                        '"hash-<value>.sig" in this folder instead of all '
+                        'of them to --output')
     p.add_argument('-k', '--ksize', default=None, type=int)
     p.add_argument('--scaled', default=None, type=int)
     p.add_argument('--num', default=None, type=int)
@@ -28,9 +41,18 @@ def main():
         '--input-is-protein', action='store_true',
         help='Consume protein sequences - no translation needed.'
     )
+    sourmash_utils.add_profile_args(p)
     add_construct_moltype_args(p)
-    args = p.parse_args()
+    args = p.parse_args(argv)
+    if args.profile:
+        profiler.enable(trace_memory=args.profile_tracemalloc)
+
+    returncode = hash2sig(args)
+    profiler.write(args.profile, 'hash2sig profile')
+    return returncode
 
+
+def hash2sig(args):
     # check arguments.
     if args.scaled and args.num:
         error('cannot specify both --num and --scaled! exiting.')
@@ -40,15 +62,24 @@ def main():
         error('must specify --ksize')
         return -1
 
-    if not args.output:
+    if args.output_dir and not args.per_hash:
+        error('--output-dir requires --per-hash')
+        return -1
+
+    if not (args.output or args.output_dir):
         error('must specify --output')
         return -1
 
-    # first, load in all the hashes
-    hashes = set()
-    for line in open(args.hashfile, 'rt'):
-        hashval = int(line.strip())
-        hashes.add(hashval)
+    # first, load in all the hashes, keeping the order of the file
+    hashes = {}
+    with profiler.stage('load_hashes'):
+        with open(args.hashfile, 'rt') as f:
+            for line in f:
+                line = line.strip()
+                # Skip empty lines
+                if line:
+                    hashes[int(line)] = None
+    profiler.count('hashes', len(hashes))
 
     if not hashes:
         error("ERROR, no hashes loaded from {}!", args.hashfile)
@@ -63,6 +94,41 @@ def main():
 
     notify('loaded {} distinct hashes from {}', len(hashes), args.hashfile)
 
+    import sourmash
+    if args.per_hash:
+        with profiler.stage('make_signatures'):
+            sigobjs = [
+                make_signature([hashval], args, name=f'hash-{hashval}')
+                for hashval in hashes]
+        with profiler.stage('write_signatures'):
+            if args.output_dir:
+                os.makedirs(args.output_dir, exist_ok=True)
+                for hashval, sigobj in zip(hashes, sigobjs):
+                    sig = os.path.join(args.output_dir, f'hash-{hashval}.sig')
+                    with open(sig, 'wt') as fp:
+                        sourmash.save_signatures([sigobj], fp)
+                notify('wrote {} signatures to {}', len(sigobjs),
+                       args.output_dir)
+            else:
+                with open(args.output, 'wt') as fp:
+                    sourmash.save_signatures(sigobjs, fp)
+                notify('wrote {} signatures to {}', len(sigobjs), args.output)
+        profiler.count('signatures_written', len(sigobjs))
+        return 0
+
+    with profiler.stage('make_signatures'):
+        sigobj = make_signature(hashes, args, name=args.name)
+
+    with profiler.stage('write_signatures'):
+        with open(args.output, 'wt') as fp:
+            sourmash.save_signatures([sigobj], fp)
+    profiler.count('signatures_written', 1)
+    notify('wrote signature to {}', args.output)
+    return 0
+
+
+def make_signature(hashes, args, name):
+    """Create a signature of the hashes, with the MinHash parameters of args"""
     # now, create the MinHash object that we'll use.
     scaled = 0
     num = 0
@@ -71,11 +137,13 @@ def main():
     elif args.num:
         num = args.num
     else:
-        notify('setting --num automatically from the number of hashes.')
+        if not args.per_hash:
+            notify('setting --num automatically from the number of hashes.')
         num = len(hashes)
 
     # construct empty MinHash object according to args
-    minhash = MinHash(
+    import sourmash
+    minhash = sourmash.MinHash(
         n=num, ksize=args.ksize, scaled=scaled, dayhoff=args.dayhoff,
         is_protein=args.input_is_protein, hp=args.hp)
 
@@ -95,13 +163,9 @@ def main():
         notify("WARNING: --num set to {}, but only {} hashes in signature.",
                num, len(minhash))
 
-    sigobj = sourmash.SourmashSignature(minhash, name=args.name,
-                                        filename=args.filename)
-
-    with open(args.output, 'wt') as fp:
-        sourmash.save_signatures([sigobj], fp)
-    notify('wrote signature to {}', args.output)
+    return sourmash.SourmashSignature(minhash, name=name,
+                                      filename=args.filename)
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    sys.exit(sourmash_utils.run_script(main))
@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+"""
+Build a k-mer index of sequence files, to find the records containing any
+hash with hash2kmer.py --index without reading all of the files.
+
+    kmer_index.py -k 45 --dayhoff --no-dna --input-is-protein \\
+        --output kmer_index *.fasta
+    hash2kmer.py -k 45 --dayhoff --no-dna --input-is-protein \\
+        --index kmer_index --output-dir . hashes.txt *.fasta
+
+Every k-mer of every record is hashed once, as hash2kmer.py does. The index
+folder holds the sorted uint64 hashes of all k-mers (keys.npy), offsets into
+the postings of each hash (offsets.npy), the indices of the records
+containing each hash (postings.npy), and the file index and byte offset of
+the header line of each record (records.npy). Records whose k-mers can only
+be hashed one at a time are not indexed, but listed in unhashed.npy to
+always be read. index.json has the ksize, molecule and the names and sizes
+of the indexed files, which hash2kmer.py checks before using the index.
+
+Arrays are memory-mapped when querying. Records are found by seeking to
+their offsets, which is slow for gzipped files, so index uncompressed ones.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+# Local files
+import hash2kmer
+import sourmash_utils
+from sourmash_utils import (add_construct_moltype_args, calculate_moltype,
+                            error, notify, profiler)
+
+
+def hash_record(sequence, ksize, moltype, input_is_protein):
+    """Distinct hashes of all k-mers of a record, or None if they can only be
+    hashed one at a time"""
+    sequence = sequence.upper()
+    ksize = hash2kmer.revise_ksize(ksize, moltype, input_is_protein)
+    try:
+        encoded = hash2kmer.encode_record(sequence, ksize, moltype,
+                                          input_is_protein)
+    except hash2kmer.NotBulkHashable:
+        return None
+    if encoded is None:
+        return np.array([], dtype=np.uint64)
+    return np.unique(np.concatenate(
+        [hashes for _, hashes in hash2kmer.iter_window_hashes(*encoded,
+                                                               ksize)]))
+
+
+def build_index(seqfiles, ksize, moltype, input_is_protein):
+    """Map the hash of every k-mer to the indices of the records containing it
+
+    Returns
+    -------
+    keys : numpy.ndarray
+        Sorted, unique uint64 hashes
+    offsets : numpy.ndarray
+        int64 array of len(keys) + 1, postings of keys[i] are
+        postings[offsets[i]:offsets[i + 1]]
+    postings : numpy.ndarray
+        uint32 record indices, sorted within each hash
+    records : numpy.ndarray
+        int64 array of (file index, byte offset) of each record
+    unhashed : numpy.ndarray
+        uint32 indices of the records that are not indexed
+    """
+    record_hashes = []
+    records = []
+    unhashed = []
+    for file_index, filename in enumerate(seqfiles):
+        with hash2kmer.open_fasta(filename) as fp:
+            for offset, _, sequence in hash2kmer.iter_fasta_records(fp):
+                hashes = hash_record(sequence, ksize, moltype,
+                                     input_is_protein)
+                if hashes is None:
+                    unhashed.append(len(records))
+                else:
+                    record_hashes.append((len(records), hashes))
+                records.append((file_index, offset))
+    profiler.count('records', len(records))
+
+    hashes = np.concatenate(
+        [h for _, h in record_hashes] + [np.array([], dtype=np.uint64)])
+    postings = np.concatenate(
+        [np.full(len(h), i, dtype=np.uint32) for i, h in record_hashes]
+        + [np.array([], dtype=np.uint32)])
+
+    # Hashes are distinct within each record, and records are in order
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    postings = postings[order]
+
+    keys, counts = np.unique(hashes, return_counts=True)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return (keys, offsets, postings,
+            np.array(records, dtype=np.int64).reshape(-1, 2),
+            np.array(unhashed, dtype=np.uint32))
+
+
+def save_index(index_dir, seqfiles, ksize, moltype, input_is_protein, keys,
+               offsets, postings, records, unhashed):
+    os.makedirs(index_dir, exist_ok=True)
+    for name, array in ((hash2kmer.INDEX_KEYS, keys),
+                        (hash2kmer.INDEX_OFFSETS, offsets),
+                        (hash2kmer.INDEX_POSTINGS, postings),
+                        (hash2kmer.INDEX_RECORDS, records),
+                        (hash2kmer.INDEX_UNHASHED, unhashed)):
+        np.save(os.path.join(index_dir, name), array)
+    files = [dict(name=os.path.basename(filename),
+                  size=os.path.getsize(filename)) for filename in seqfiles]
+    with open(os.path.join(index_dir, hash2kmer.INDEX_METADATA), 'w') as f:
+        json.dump(dict(ksize=ksize, moltype=moltype,
+                       input_is_protein=input_is_protein, files=files), f,
+                  indent=2)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('seqfiles', nargs='+', help='sequence files to index')
+    p.add_argument('-o', '--output', required=True,
+                   help='folder to save the index to')
+    p.add_argument('-k', '--ksize', type=int, required=True)
+    p.add_argument(
+        '--input-is-protein', action='store_true',
+        help='Consume protein sequences - no translation needed.'
+    )
+    sourmash_utils.add_profile_args(p)
+    add_construct_moltype_args(p)
+    args = p.parse_args()
+    if args.profile:
+        profiler.enable(trace_memory=args.profile_tracemalloc)
+
+    moltype = calculate_moltype(args)
+    hash2kmer.check_protein_ksize(args)
+
+    names = [os.path.basename(filename) for filename in args.seqfiles]
+    if len(set(names)) < len(names):
+        error("ERROR, sequence files must have distinct names!")
+        return -1
+
+    with profiler.stage('build_index'):
+        keys, offsets, postings, records, unhashed = build_index(
+            args.seqfiles, args.ksize, moltype, args.input_is_protein)
+    with profiler.stage('save_index'):
+        save_index(args.output, args.seqfiles, args.ksize, moltype,
+                   args.input_is_protein, keys, offsets, postings, records,
+                   unhashed)
+    profiler.count('hashes', len(keys))
+    notify('indexed {} distinct hashes in {} records of {} files, {} records '
+           'not indexed', len(keys), len(records), len(args.seqfiles),
+           len(unhashed))
+    profiler.write(args.profile, 'kmer_index profile')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
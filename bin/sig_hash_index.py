@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+"""
+Find the signature files containing each of a list of hashes, using an
+inverted index from hash to signature files built once for all hashes.
+
+    sig_hash_index.py build -k 45 --dayhoff --no-dna --output index *.sig
+    sig_hash_index.py query --index index --output-dir . hashes.txt
+
+The index folder holds the sorted uint64 hashes of all signatures
+(keys.npy), offsets into the postings of each hash (offsets.npy), the
+indices of the entries containing each hash (postings.npy) and the entries
+(signatures.csv). Entries are signature files, or with build --by-signature
+the individual signatures, e.g. the --singleton signatures of a reference
+proteome. Arrays are memory-mapped when querying.
+
+For each hash, query writes the matching signature filenames to
+"[prefix]hash-<hash>__matches.txt", one per line, like
+"rg --files-with-matches <hash>" but without matching the hash's digits
+inside unrelated numbers. With query --csv, it writes the matching
+signatures to "[prefix]hash-<hash>.csv" instead, with the columns of
+"sourmash search --containment" of a signature with only that hash.
+"""
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+# Local file
+import sourmash_utils
+from sourmash_utils import (add_construct_moltype_args, calculate_moltype,
+                            error, notify, profiler)
+
+KEYS = 'keys.npy'
+OFFSETS = 'offsets.npy'
+POSTINGS = 'postings.npy'
+SIGNATURES = 'signatures.csv'
+
+# Columns of the entries of the index, and of the "sourmash search" csv
+ENTRY_COLUMNS = ['name', 'filename', 'md5']
+SEARCH_COLUMNS = ['similarity', 'name', 'filename', 'md5']
+
+
+def build_index(sketches, entries):
+    """Map each hash to the indices of the entries containing it
+
+    Parameters
+    ----------
+    sketches : list of sourmash_utils.SketchArrays
+        Hashes of all signatures
+    entries : list of int
+        Index of the entry each sketch belongs to, e.g. of its file
+
+    Returns
+    -------
+    keys : numpy.ndarray
+        Sorted, unique uint64 hashes
+    offsets : numpy.ndarray
+        int64 array of len(keys) + 1, postings of keys[i] are
+        postings[offsets[i]:offsets[i + 1]]
+    postings : numpy.ndarray
+        uint32 entry indices, sorted within each hash
+    """
+    hashes = np.concatenate(
+        [s.hashes for s in sketches] + [np.array([], dtype=np.uint64)])
+    postings = np.concatenate(
+        [np.full(len(s.hashes), entry, dtype=np.uint32)
+         for s, entry in zip(sketches, entries)]
+        + [np.array([], dtype=np.uint32)])
+
+    order = np.lexsort((postings, hashes))
+    hashes = hashes[order]
+    postings = postings[order]
+
+    # A file can contain several signatures with the same hash
+    distinct = np.ones(len(hashes), dtype=bool)
+    distinct[1:] = (hashes[1:] != hashes[:-1]) | \
+        (postings[1:] != postings[:-1])
+    hashes = hashes[distinct]
+    postings = postings[distinct]
+
+    keys, counts = np.unique(hashes, return_counts=True)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return keys, offsets, postings
+
+
+def load_signatures_with_md5(filenames, ksize, molecule):
+    """Load hashes of every signature, with entries for each signature"""
+    from sourmash import signature as sig
+    sketches = []
+    entries = []
+    for filename in filenames:
+        for s in sig.load_signatures(filename, ksize=ksize,
+                                     select_moltype=molecule):
+            sketches.append(sourmash_utils.sketch_to_arrays(s, filename))
+            entries.append(dict(name=s.name(), filename=filename,
+                                md5=s.md5sum()))
+    return sketches, entries
+
+
+def save_index(index_dir, keys, offsets, postings, entries):
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, KEYS), keys)
+    np.save(os.path.join(index_dir, OFFSETS), offsets)
+    np.save(os.path.join(index_dir, POSTINGS), postings)
+    with open(os.path.join(index_dir, SIGNATURES), 'w', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=ENTRY_COLUMNS)
+        w.writeheader()
+        w.writerows(entries)
+
+
+def load_index(index_dir):
+    """Memory-map the arrays of an index, returns keys, offsets, postings
+    and entries"""
+    keys, offsets, postings = (
+        np.load(os.path.join(index_dir, name), mmap_mode='r')
+        for name in (KEYS, OFFSETS, POSTINGS))
+    with open(os.path.join(index_dir, SIGNATURES), newline='') as f:
+        entries = list(csv.DictReader(f))
+    return keys, offsets, postings, entries
+
+
+def query_index(hashes, keys, offsets, postings):
+    """Yield the indices of the entries containing each hash"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    positions = np.searchsorted(keys, hashes)
+    for hashval, position in zip(hashes, positions):
+        if position < len(keys) and keys[position] == hashval:
+            yield postings[offsets[position]:offsets[position + 1]]
+        else:
+            yield postings[:0]
+
+
+def read_hashes(hashfile):
+    """Read distinct hashes, one per line, in order of first appearance"""
+    hashes = {}
+    with open(hashfile, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            # Skip empty lines
+            if line:
+                hashes[int(line)] = None
+    return list(hashes)
+
+
+def build(args):
+    moltype = calculate_moltype(args)
+    if args.by_signature:
+        with profiler.stage('load_signatures'):
+            sketches, entries = load_signatures_with_md5(
+                args.signatures, args.ksize, moltype)
+        sketch_entries = range(len(sketches))
+    else:
+        with profiler.stage('load_signatures'):
+            sketches = sourmash_utils.load_sketch_arrays(
+                args.signatures, args.ksize, moltype,
+                cache_dir=args.cache_dir)
+        entries = [dict(name='', filename=filename, md5='')
+                   for filename in args.signatures]
+        file_indices = {filename: i
+                        for i, filename in enumerate(args.signatures)}
+        sketch_entries = [file_indices[s.filename] for s in sketches]
+    if not sketches:
+        error("ERROR, no signatures with ksize {} and molecule {} loaded!",
+              args.ksize, moltype)
+        return -1
+
+    with profiler.stage('build_index'):
+        keys, offsets, postings = build_index(sketches, sketch_entries)
+    with profiler.stage('save_index'):
+        save_index(args.output, keys, offsets, postings, entries)
+    profiler.count('signatures', len(sketches))
+    profiler.count('hashes', len(keys))
+    notify('indexed {} distinct hashes from {} signatures in {} files',
+           len(keys), len(sketches), len(args.signatures))
+    return 0
+
+
+def write_matches(filename, matches):
+    """Write the distinct filenames of the matching entries"""
+    with open(filename, 'w') as f:
+        for match in dict.fromkeys(entry['filename'] for entry in matches):
+            f.write(f'{match}\n')
+
+
+def write_search_csv(filename, matches):
+    """Write matching entries like "sourmash search --containment --output"
+
+    A signature of a single hash is fully contained in every signature with
+    that hash, so similarity is always 1. As in sourmash, signatures with
+    the same md5sum are only reported once.
+    """
+    with open(filename, 'w', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=SEARCH_COLUMNS)
+        w.writeheader()
+        md5s = set()
+        for entry in matches:
+            if entry['md5'] in md5s:
+                continue
+            md5s.add(entry['md5'])
+            w.writerow(dict(entry, similarity=1.0))
+
+
+def query(args):
+    with profiler.stage('load_index'):
+        keys, offsets, postings, entries = load_index(args.index)
+    with profiler.stage('load_hashes'):
+        hashes = read_hashes(args.hashfile)
+    if not hashes:
+        error("ERROR, no hashes loaded from {}!", args.hashfile)
+        return -1
+
+    if args.csv and not all(entry['md5'] for entry in entries):
+        error("ERROR, --csv requires an index built with --by-signature")
+        return -1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    n_found = 0
+    with profiler.stage('query_index'):
+        for hashval, found in zip(hashes, query_index(hashes, keys, offsets,
+                                                      postings)):
+            matches = [entries[i] for i in found]
+            prefix = os.path.join(args.output_dir,
+                                  f'{args.prefix}hash-{hashval}')
+            if args.csv:
+                write_search_csv(f'{prefix}.csv', matches)
+            else:
+                write_matches(f'{prefix}__matches.txt', matches)
+            n_found += len(matches) > 0
+    profiler.count('hashes', len(hashes))
+    profiler.count('hashes_found', n_found)
+    notify('found {} of {} hashes in {} indexed entries', n_found,
+           len(hashes), len(entries))
+    return 0
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = p.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p_build = subparsers.add_parser(
+        'build', help='index the hashes of signature files')
+    p_build.add_argument('signatures', nargs='+',
+                         help='signature files to index')
+    p_build.add_argument('-o', '--output', required=True,
+                         help='folder to save the index to')
+    p_build.add_argument('-k', '--ksize', type=int, required=True)
+    p_build.add_argument('--cache-dir', type=str, default=None,
+                         help='folder to cache the hashes parsed from each '
+                              'signature file in, see '
+                              'differential_hash_expression.py --cache-dir')
+    p_build.add_argument('--by-signature', action='store_true',
+                         help='index the individual signatures in the files, '
+                              'with their names and md5sums, instead of the '
+                              'files. Required for query --csv')
+    sourmash_utils.add_profile_args(p_build)
+    add_construct_moltype_args(p_build)
+    p_build.set_defaults(func=build)
+
+    p_query = subparsers.add_parser(
+        'query', help='write the signature files containing each hash')
+    p_query.add_argument('hashfile', help='file with one hash per line')
+    p_query.add_argument('-i', '--index', required=True,
+                         help='folder of the index')
+    p_query.add_argument('--output-dir', type=str, default='.',
+                         help='folder to write the __matches.txt files to')
+    p_query.add_argument('--prefix', type=str, default='',
+                         help='prefix of the output filenames')
+    p_query.add_argument('--csv', action='store_true',
+                         help='write the matching signatures of each hash to '
+                              '"[prefix]hash-<hash>.csv", with the columns of '
+                              '"sourmash search" output')
+    sourmash_utils.add_profile_args(p_query)
+    p_query.set_defaults(func=query)
+
+    args = p.parse_args()
+    if args.profile:
+        profiler.enable(trace_memory=args.profile_tracemalloc)
+
+    returncode = args.func(args)
+    profiler.write(args.profile, f'sig_hash_index {args.command} profile')
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,693 @@
-from sourmash import signature as sig
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, redirect_stdout
+import hashlib
+import json
+import logging
+import os
+import resource
+import shlex
+import signal
+import socketserver
+import sys
+import time
+import tracemalloc
+import traceback
+
+import numpy as np
 from tqdm import tqdm
+# sourmash is imported where it is used, as importing it is slow, and the
+# scripts only need it after parsing their arguments
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+
+# Default limit on the size of the on-disk signature hash cache: 10 GiB
+MAX_CACHE_SIZE = 10 * 1024 ** 3
+CACHE_VERSION = 1
+
+# Constants of MurmurHash3_x64_128, the hash function of sourmash
+MURMUR_SEED = 42
+_C1 = np.uint64(0x87c37b91114253d5)
+_C2 = np.uint64(0x4cf5ad432745937f)
+
+# Hashes of one signature as compact arrays instead of a SourmashSignature.
+# hashes: sorted uint64, abundances: uint32 of the same length, or None if the
+# signature does not track abundance
+SketchArrays = namedtuple('SketchArrays',
+                          ['name', 'filename', 'hashes', 'abundances'])
+
+
+class Profiler:
+    """Record wall time, CPU time and peak memory of stages, and counters
+
+    Disabled unless enable() is called, so that stages and counters cost
+    nothing by default. Repeated stages are summed, with their peak memory
+    the maximum over all calls. Only stages that are not nested in another
+    stage record peak memory: the peak RSS of the process during the stage,
+    read from VmHWM after resetting it at the start of the stage. Where it
+    can't be reset, the stages record the maximum RSS of the process so far
+    instead, and the column is labelled as cumulative.
+    """
+
+    # Columns of the stage table, with the MultiQC header of each
+    METRICS = OrderedDict([
+        ('calls', dict(title='Calls', format='{:,.0f}')),
+        ('wall_seconds', dict(title='Wall time (s)', format='{:,.2f}')),
+        ('cpu_seconds', dict(title='CPU time (s)', format='{:,.2f}')),
+        ('peak_rss_mib', dict(title='Peak RSS (MiB)', format='{:,.1f}')),
+        ('peak_traced_mib', dict(title='Peak traced (MiB)',
+                                 format='{:,.1f}')),
+    ])
+    # Replaces peak_rss_mib when stages couldn't reset the peak RSS
+    CUMULATIVE_RSS_METRIC = 'cumulative_max_rss_mib', dict(
+        title='Cumulative max RSS (MiB)', format='{:,.1f}')
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.reset()
+
+    def reset(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self._depth = 0
+        self._start = time.perf_counter(), _cpu_time()
+        # Peak RSS of the process in bytes before the last reset of VmHWM
+        self._process_peak_rss = 0
+        self.cumulative_rss = False
+
+    def enable(self, trace_memory=False):
+        """Start recording, with tracemalloc too if trace_memory"""
+        self.enabled = True
+        self.trace_memory = trace_memory
+        self.reset()
+
+    def disable(self):
+        """Stop recording, e.g. after a job of a worker"""
+        self.enabled = False
+        self.trace_memory = False
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        outermost = self._depth == 0
+        self._depth += 1
+        if outermost:
+            self._process_peak_rss = max(self._process_peak_rss,
+                                         _vm_hwm() or 0)
+            stage_rss = _reset_peak_rss()
+            self.cumulative_rss = self.cumulative_rss or not stage_rss
+            if self.trace_memory:
+                tracemalloc.start()
+        wall, cpu = time.perf_counter(), _cpu_time()
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            stage = self.stages.setdefault(
+                name, OrderedDict((metric, 0) for metric in self.METRICS))
+            stage['calls'] += 1
+            stage['wall_seconds'] += time.perf_counter() - wall
+            stage['cpu_seconds'] += _cpu_time() - cpu
+            if outermost:
+                rss = _vm_hwm() if stage_rss else _max_rss()
+                self._process_peak_rss = max(self._process_peak_rss, rss)
+                stage['peak_rss_mib'] = max(stage['peak_rss_mib'],
+                                            rss / 1024 ** 2)
+                if self.trace_memory:
+                    stage['peak_traced_mib'] = max(
+                        stage['peak_traced_mib'],
+                        tracemalloc.get_traced_memory()[1] / 1024 ** 2)
+                    tracemalloc.stop()
+
+    def count(self, name, value=1):
+        """Add value to the counter name"""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def results(self):
+        return dict(stages=self.stages, counters=self.counters,
+                    cumulative_rss=self.cumulative_rss)
+
+    def merge(self, results):
+        """Add the results of a profiler in another process"""
+        if not self.enabled:
+            return
+        self.cumulative_rss = self.cumulative_rss or results['cumulative_rss']
+        for name, other in results['stages'].items():
+            stage = self.stages.setdefault(
+                name, OrderedDict((metric, 0) for metric in self.METRICS))
+            for metric, value in other.items():
+                if metric.startswith('peak'):
+                    stage[metric] = max(stage[metric], value)
+                else:
+                    stage[metric] += value
+        for name, value in results['counters'].items():
+            self.count(name, value)
+
+    def write(self, prefix, section_name):
+        """Write stages and counters to {prefix}_profile_mqc.json, a MultiQC
+        custom content table, and {prefix}_profile.tsv
+
+        The table has one row per stage, and a "total" row with the wall
+        and CPU time since enable(), the peak RSS of the process and the
+        counters.
+        """
+        if not self.enabled:
+            return
+        # Resetting VmHWM for the stages doesn't reset ru_maxrss, but the
+        # peaks before each reset are kept in _process_peak_rss too. Stages
+        # merged from other processes can peak higher
+        peak_rss = max([max(self._process_peak_rss, _vm_hwm() or 0,
+                            _max_rss()) / 1024 ** 2] + [
+            stage['peak_rss_mib'] for stage in self.stages.values()])
+        total = OrderedDict([
+            ('wall_seconds', time.perf_counter() - self._start[0]),
+            ('cpu_seconds', _cpu_time() - self._start[1]),
+            ('peak_rss_mib', peak_rss)])
+        total.update(self.counters)
+        rows = OrderedDict(
+            (name, OrderedDict((metric, value)
+                               for metric, value in stage.items()
+                               if self.trace_memory
+                               or metric != 'peak_traced_mib'))
+            for name, stage in self.stages.items())
+        rows['total'] = total
+
+        headers = OrderedDict(
+            (metric, dict(title=header['title'], format=header['format']))
+            for metric, header in self.METRICS.items())
+        for counter in self.counters:
+            headers[counter] = dict(title=counter.replace('_', ' ').capitalize(),
+                                    format='{:,.0f}')
+        if not self.trace_memory:
+            del headers['peak_traced_mib']
+        if self.cumulative_rss:
+            metric, header = self.CUMULATIVE_RSS_METRIC
+            rows = OrderedDict(
+                (name, OrderedDict(
+                    (metric if key == 'peak_rss_mib' else key, value)
+                    for key, value in row.items()))
+                for name, row in rows.items())
+            headers = OrderedDict(
+                (metric if key == 'peak_rss_mib' else key,
+                 header if key == 'peak_rss_mib' else value)
+                for key, value in headers.items())
+
+        section_id = os.path.basename(prefix).replace(' ', '_')
+        report = OrderedDict([
+            ('id', f'{section_id}_profile'),
+            ('section_name', section_name),
+            ('description', 'Wall time, CPU time and peak memory of the '
+                            'stages of a script, and its counters'),
+            ('plot_type', 'table'),
+            ('pconfig', dict(id=f'{section_id}_profile_table',
+                             namespace=section_name)),
+            ('headers', headers),
+            ('data', rows),
+        ])
+        with open(f'{prefix}_profile_mqc.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+        with open(f'{prefix}_profile.tsv', 'w') as f:
+            f.write('stage\tmetric\tvalue\n')
+            for stage, metrics in rows.items():
+                for metric, value in metrics.items():
+                    f.write(f'{stage}\t{metric}\t{value}\n')
+
+
+def _cpu_time():
+    """CPU time of this process and of its finished child processes"""
+    times = os.times()
+    return times.user + times.system + times.children_user + \
+        times.children_system
+
+
+def _max_rss():
+    """Maximum resident set size of the process in bytes (kilobytes on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    """Reset VmHWM, the peak RSS read by _vm_hwm, on Linux 4.0 or later
+
+    This doesn't reset ru_maxrss, the maximum RSS reported by getrusage.
+    Returns whether VmHWM was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return _vm_hwm() is not None
+
+
+def _vm_hwm():
+    """Peak RSS in bytes since the last _reset_peak_rss, or None without
+    /proc/self/status"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# Profiler shared by the scripts, enabled by their --profile option
+profiler = Profiler()
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile', type=str, default=None,
+                        help='record wall time, CPU time and peak memory of '
+                             'each stage, and counters, and write them to '
+                             '"<PROFILE>_profile_mqc.json" for MultiQC and '
+                             '"<PROFILE>_profile.tsv"')
+    parser.add_argument('--profile-tracemalloc', action='store_true',
+                        help='with --profile, also record the peak memory '
+                             'traced by tracemalloc, which slows down '
+                             'allocating Python objects')
+
+
+def add_construct_moltype_args(parser):
+    """The molecule options of sourmash.cli.utils.add_construct_moltype_args
+
+    Defined here so that parsing arguments, e.g. -h, doesn't import sourmash
+    """
+    parser.add_argument(
+        '--protein', dest='protein', action='store_true',
+        help='choose a protein signature; by default, a nucleotide signature '
+             'is used')
+    parser.add_argument(
+        '--no-protein', dest='protein', action='store_false',
+        help='do not choose a protein signature')
+    parser.add_argument(
+        '--dayhoff', dest='dayhoff', action='store_true',
+        help='build Dayhoff-encoded amino acid signatures')
+    parser.add_argument(
+        '--no-dayhoff', dest='dayhoff', action='store_false',
+        help='do not build Dayhoff-encoded amino acid signatures')
+    parser.add_argument(
+        '--hp', '--hydrophobic-polar', dest='hp', action='store_true',
+        help='build hydrophobic-polar-encoded amino acid signatures')
+    parser.add_argument(
+        '--no-hp', '--no-hydrophobic-polar', dest='hp', action='store_false',
+        help='do not build hydrophobic-polar-encoded amino acid signatures')
+    parser.add_argument(
+        '--dna', '--rna', dest='dna', action='store_true',
+        help='choose a nucleotide signature (default: True)')
+    parser.add_argument(
+        '--no-dna', '--no-rna', dest='dna', action='store_false',
+        help='do not choose a nucleotide signature')
+    parser.set_defaults(protein=False, dayhoff=False, hp=False, dna=True)
+
+
+def calculate_moltype(args, default=None):
+    """sourmash.sourmash_args.calculate_moltype, importing sourmash when
+    called"""
+    from sourmash.sourmash_args import calculate_moltype
+    return calculate_moltype(args, default=default)
+
+
+def notify(s, *args, **kwargs):
+    """sourmash.logging.notify, importing sourmash when called"""
+    from sourmash.logging import notify
+    notify(s, *args, **kwargs)
+
+
+def error(s, *args, **kwargs):
+    """sourmash.logging.error, importing sourmash when called"""
+    from sourmash.logging import error
+    error(s, *args, **kwargs)
+
+
+def run_job(main, line):
+    """Run main on the arguments of one job of a worker, see run_script
+
+    Returns the response to the job, or None for an empty line
+    """
+    line = line.strip()
+    if not line:
+        return None
+    cwd = os.getcwd()
+    try:
+        job = json.loads(line) if line[0] in '[{' else shlex.split(line)
+        if isinstance(job, dict):
+            os.chdir(job.get('cwd', cwd))
+            job = job['args']
+        # Anything the script prints must not be mistaken for a response
+        with redirect_stdout(sys.stderr):
+            returncode = main([str(arg) for arg in job])
+        response = dict(returncode=returncode or 0)
+    except SystemExit as e:
+        # argparse errors, and scripts calling sys.exit
+        if e.code is None or isinstance(e.code, int):
+            response = dict(returncode=e.code or 0)
+        else:
+            response = dict(returncode=1, error=str(e.code))
+    except Exception as e:
+        traceback.print_exc()
+        response = dict(returncode=1, error=f'{type(e).__name__}: {e}')
+    finally:
+        os.chdir(cwd)
+        profiler.disable()
+    return response
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """Run the jobs sent over a connection to a worker, one per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            response = run_job(self.server.main, line.decode())
+            if response is not None:
+                self.wfile.write(f'{json.dumps(response)}\n'.encode())
+
+
+def run_script(main, argv=None):
+    """Run the main(argv) of a script once, or as a long-lived worker
+
+    "script.py --worker" reads jobs from standard input, one per line, and
+    "script.py --worker SOCKET" serves connections to a Unix socket at that
+    path, each sending jobs one per line. A job is the command line
+    arguments of the script, as a shell-quoted line, a JSON list, or a JSON
+    object of "args" and the "cwd" to run them in. The worker answers every
+    job with a line of JSON of its "returncode", and the "error" if it
+    failed.
+
+    Jobs run one at a time in the same process, so imported modules and
+    whatever the script caches, e.g. loaded indexes, are reused instead of
+    starting Python for every job. The profiles of jobs report the peak
+    resident memory of the whole worker.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] != '--worker':
+        return main(argv)
+    if len(argv) > 2:
+        print('usage: --worker [SOCKET]', file=sys.stderr)
+        return 2
+
+    if len(argv) == 1:
+        for line in sys.stdin:
+            response = run_job(main, line)
+            if response is not None:
+                print(json.dumps(response), flush=True)
+        return 0
+
+    socket_path = argv[1]
+    server = socketserver.UnixStreamServer(socket_path, _JobHandler)
+    server.main = main
+    # Remove the socket when stopped by Nextflow or kill too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+    return 0
+
 
 def load_sketches(filenames, ksize, molecule):
     sketches = []
+    from sourmash import signature as sig
     for filename in tqdm(filenames):
         s = sig.load_signatures(filename, ksize=ksize, select_moltype=molecule)
         sketches.extend(s)
     return sketches
+
+
+def sketch_to_arrays(sketch, filename=''):
+    """Extract sorted hashes and abundances of a signature as NumPy arrays"""
+    minhash = sketch.minhash
+    if minhash.track_abundance:
+        mins = minhash.get_mins(with_abundance=True)
+        hashes = np.fromiter(mins.keys(), dtype=np.uint64, count=len(mins))
+        abundances = np.fromiter(mins.values(), dtype=np.uint32,
+                                 count=len(mins))
+        order = np.argsort(hashes)
+        hashes, abundances = hashes[order], abundances[order]
+    else:
+        mins = minhash.get_mins()
+        hashes = np.sort(np.fromiter(mins, dtype=np.uint64, count=len(mins)))
+        abundances = None
+    return SketchArrays(sketch.name(), filename, hashes, abundances)
+
+
+def max_hash_for_scaled(scaled):
+    """Largest hash kept when downsampling a sketch to scaled, as in sourmash
+
+    Downsampling keeps exactly the hashes <= max_hash, so the hashes of the
+    downsampled sketch are a prefix of its sorted hashes
+    """
+    from sourmash.minhash import get_minhash_max_hash
+    if scaled == 1:
+        return get_minhash_max_hash()
+    return int(round(get_minhash_max_hash() / scaled, 0))
+
+
+def _cache_key(filename, ksize, molecule):
+    """Cache key covering the file (symlinks resolved), its size and mtime, and
+    the ksize and molecule selected from it
+    """
+    stat = os.stat(filename)
+    key = json.dumps([CACHE_VERSION, os.path.realpath(filename), stat.st_size,
+                      stat.st_mtime_ns, ksize, molecule])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _read_cache_entry(cache_dir, key, filename):
+    """Memory-map the cached arrays of a signature file, or None if not cached"""
+    index = os.path.join(cache_dir, f'{key}.json')
+    try:
+        with open(index) as f:
+            entry = json.load(f)
+        hashes = np.load(os.path.join(cache_dir, f'{key}.hashes.npy'),
+                         mmap_mode='r')
+        abundances = np.load(os.path.join(cache_dir, f'{key}.abundances.npy'),
+                             mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+    # Mark entry as recently used, for eviction
+    os.utime(index)
+
+    sketches = []
+    offsets = entry['offsets']
+    for i, (name, track_abundance) in enumerate(zip(entry['names'],
+                                                    entry['track_abundance'])):
+        start, end = offsets[i], offsets[i + 1]
+        sketches.append(SketchArrays(
+            name, filename, hashes[start:end],
+            abundances[start:end] if track_abundance else None))
+    return sketches
+
+
+def _write_cache_entry(cache_dir, key, sketches):
+    """Save the arrays of all signatures in a file as one cache entry"""
+    offsets = np.zeros(len(sketches) + 1, dtype=np.int64)
+    np.cumsum([len(s.hashes) for s in sketches], out=offsets[1:])
+    hashes = np.concatenate(
+        [s.hashes for s in sketches] + [np.array([], dtype=np.uint64)])
+    abundances = np.concatenate(
+        [s.abundances if s.abundances is not None
+         else np.ones(len(s.hashes), dtype=np.uint32) for s in sketches]
+        + [np.array([], dtype=np.uint32)])
+    entry = dict(names=[s.name for s in sketches],
+                 track_abundance=[s.abundances is not None for s in sketches],
+                 offsets=offsets.tolist())
+
+    # Write to temporary files and rename, so that concurrent readers never
+    # see a partially written entry. The index is written last
+    for suffix, array in (('hashes', hashes), ('abundances', abundances)):
+        path = os.path.join(cache_dir, f'{key}.{suffix}.npy')
+        with open(f'{path}.tmp{os.getpid()}', 'wb') as f:
+            np.save(f, array)
+        os.replace(f'{path}.tmp{os.getpid()}', path)
+    index = os.path.join(cache_dir, f'{key}.json')
+    with open(f'{index}.tmp{os.getpid()}', 'w') as f:
+        json.dump(entry, f)
+    os.replace(f'{index}.tmp{os.getpid()}', index)
+
+
+def evict_cache(cache_dir, max_cache_size=MAX_CACHE_SIZE):
+    """Remove least recently used entries until the cache fits in max_cache_size
+
+    An entry is all files named after the same key, last used when its .json
+    index was modified. Besides signature arrays, these are the fits cached
+    by differential_hash_expression.py --cache-results.
+    """
+    entries = {}
+    for filename in os.listdir(cache_dir):
+        key = filename.split('.')[0]
+        path = os.path.join(cache_dir, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        size, last_used, paths = entries.get(key, (0, 0, []))
+        if filename.endswith('.json'):
+            last_used = stat.st_mtime
+        entries[key] = (size + stat.st_size, last_used, paths + [path])
+
+    total = sum(size for size, last_used, paths in entries.values())
+    for key, (size, last_used, paths) in sorted(entries.items(),
+                                                key=lambda x: x[1][1]):
+        if total <= max_cache_size:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+
+
+def load_sketch_arrays(filenames, ksize, molecule, cache_dir=None,
+                       max_cache_size=MAX_CACHE_SIZE):
+    """Load hashes and abundances of signatures as compact arrays
+
+    If cache_dir is provided, the arrays extracted from each signature file
+    are kept there as .npy files and memory-mapped on later runs instead of
+    re-parsing the JSON. The cache holds at most max_cache_size bytes, least
+    recently used entries are evicted first.
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    sketches = []
+    n_cached = 0
+    for filename in tqdm(filenames):
+        key = None
+        if cache_dir is not None:
+            key = _cache_key(filename, ksize, molecule)
+            cached = _read_cache_entry(cache_dir, key, filename)
+            if cached is not None:
+                sketches.extend(cached)
+                n_cached += 1
+                continue
+
+        # Runs loading every file from the cache never import sourmash
+        from sourmash import signature as sig
+        loaded = [sketch_to_arrays(s, filename) for s in sig.load_signatures(
+            filename, ksize=ksize, select_moltype=molecule)]
+        if key is not None:
+            _write_cache_entry(cache_dir, key, loaded)
+        sketches.extend(loaded)
+
+    profiler.count('signature_files', len(filenames))
+    profiler.count('signatures_loaded', len(sketches))
+    if cache_dir is not None:
+        profiler.count('signature_files_from_cache', n_cached)
+        logger.info(f'Loaded {n_cached} of {len(filenames)} signature files '
+                    f'from cache {cache_dir}')
+        evict_cache(cache_dir, max_cache_size)
+    return sketches
+
+
+def iter_sketch_array_chunks(filenames, ksize, molecule, chunk_size,
+                             cache_dir=None, max_cache_size=MAX_CACHE_SIZE):
+    """Load signatures chunk_size files at a time with load_sketch_arrays
+
+    Yields the list of SketchArrays of each chunk, so that only one chunk of
+    signatures is in memory at a time.
+    """
+    filenames = list(filenames)
+    for start in range(0, len(filenames), chunk_size):
+        yield load_sketch_arrays(filenames[start:start + chunk_size], ksize,
+                                 molecule, cache_dir=cache_dir,
+                                 max_cache_size=max_cache_size)
+
+
+def _rotl64(x, r):
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def _fmix64(k):
+    k ^= k >> np.uint64(33)
+    k *= np.uint64(0xff51afd7ed558ccd)
+    k ^= k >> np.uint64(33)
+    k *= np.uint64(0xc4ceb9fe1a85ec53)
+    k ^= k >> np.uint64(33)
+    return k
+
+
+def _read_uint64(windows, start, stop):
+    """Little-endian uint64 of bytes start:stop of every window"""
+    k = np.zeros(len(windows), dtype=np.uint64)
+    for i in range(start, stop):
+        k |= windows[:, i].astype(np.uint64) << np.uint64(8 * (i - start))
+    return k
+
+
+def hash_murmur_many(windows, seed=MURMUR_SEED):
+    """Hash many equal-length byte strings at once, as sourmash's hash_murmur
+
+    Vectorized MurmurHash3_x64_128 returning the first 64 bits.
+
+    Parameters
+    ----------
+    windows : numpy.ndarray
+        (n_windows, length) uint8 array with one byte string per row
+
+    Returns
+    -------
+    hashes : numpy.ndarray
+        uint64 hash of every row
+    """
+    n_windows, length = windows.shape
+    h1 = np.full(n_windows, seed, dtype=np.uint64)
+    h2 = np.full(n_windows, seed, dtype=np.uint64)
+
+    # NumPy uint64 arithmetic wraps around, like the C implementation
+    with np.errstate(over='ignore'):
+        n_blocks = length // 16
+        for block in range(n_blocks):
+            k1 = _read_uint64(windows, block * 16, block * 16 + 8)
+            k2 = _read_uint64(windows, block * 16 + 8, block * 16 + 16)
+
+            k1 *= _C1
+            k1 = _rotl64(k1, 31)
+            k1 *= _C2
+            h1 ^= k1
+            h1 = _rotl64(h1, 27)
+            h1 += h2
+            h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+
+            k2 *= _C2
+            k2 = _rotl64(k2, 33)
+            k2 *= _C1
+            h2 ^= k2
+            h2 = _rotl64(h2, 31)
+            h2 += h1
+            h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+
+        tail = n_blocks * 16
+        if length - tail > 8:
+            k2 = _read_uint64(windows, tail + 8, length)
+            k2 *= _C2
+            k2 = _rotl64(k2, 33)
+            k2 *= _C1
+            h2 ^= k2
+        if length - tail > 0:
+            k1 = _read_uint64(windows, tail, min(tail + 8, length))
+            k1 *= _C1
+            k1 = _rotl64(k1, 31)
+            k1 *= _C2
+            h1 ^= k1
+
+        h1 ^= np.uint64(length)
+        h2 ^= np.uint64(length)
+        h1 += h2
+        h2 += h1
+        h1 = _fmix64(h1)
+        h2 = _fmix64(h2)
+        h1 += h2
+    return h1
@@ -46,6 +46,44 @@ def helpMessage() {
                                       This requires the --csv option and additional columns of "group" and "sig" in the csv
       --csv_has_is_aligned            If provided, then the --csv provided has a column named "is_aligned" that can be used to
                                       partition the signatures and differential hashes into aligned/unaligned bins
+      --diff_hash_abundance_transform With --diff_hash_with_abundance, rescale the abundances so the saga solver converges faster:
+                                      "log1p", "total" (normalize samples to the median total), "tfidf" or "maxabs". Default None
+      --diff_hash_cache_dir           Absolute path of a folder to cache the hashes parsed from the signatures in, so that
+                                      re-runs don't re-parse the signature files. Default None
+      --diff_hash_cache_results       With --diff_hash_cache_dir, also cache the fit of each group there, and reuse it on re-runs
+                                      with the same subsampled signatures and fitting parameters. Ignored with
+                                      --diff_hash_stability_rounds, --diff_hash_streaming or --diff_hash_multinomial. Default false
+      --diff_hash_min_prevalence      Before fitting, drop hashes present in less than this fraction of the group's samples. Default None
+      --diff_hash_prescreen_top_n     Before fitting, keep only this many hashes with the highest chi-squared statistic. Default None
+      --diff_hash_regularization_path Comma-separated inverse regularization strengths, e.g. "0.01,0.03,0.1,0.3,1", to fit in one
+                                      task with warm starts instead of --diff_hash_inverse_regularization_strength. Default None
+      --diff_hash_target_informative_hashes
+                                      With --diff_hash_regularization_path, use the first C with at least this many informative hashes
+      --diff_hash_cv_folds            With --diff_hash_regularization_path, use the C with the best cross-validated balanced accuracy
+                                      in this many folds. Otherwise the largest C is used
+      --diff_hash_stability_rounds    Stability selection: fit each group on this many random subsamples of half of its samples and of
+                                      the rest, and report how often each hash is selected. Default None
+      --diff_hash_stability_cutoff    With --diff_hash_stability_rounds, informative hashes are those selected in at least this
+                                      fraction of the rounds. Default 0.6
+      --diff_hash_streaming           Fit on all signatures instead of subsampling groups to 100 samples, by stochastic gradient
+                                      descent over chunks of signatures, with memory independent of the number of samples
+      --diff_hash_multinomial         Fit a single multinomial logistic regression of all groups in one task, instead of one task
+                                      per group vs the rest. Doesn't support the liblinear solver. Default false
+      --diff_hash_parallel_groups     Fit every group vs the rest in a single task, building the feature matrix of all signatures
+                                      once and fitting the groups concurrently, instead of one task per group. Default false
+      --diff_hash_collapse_identical_hashes
+                                      Fit one feature for all hashes present in exactly the same samples, and give each of them its
+                                      coefficient. Not supported with --diff_hash_with_abundance or --diff_hash_streaming. Default false
+      --diff_hash_coarse_scaled       Coarse-to-fine fitting: first fit only the hashes kept by downsampling the signatures to this
+                                      scaled value, e.g. 100, then refit at full resolution the hashes present in similar samples as
+                                      its informative hashes. Not supported with --diff_hash_streaming or --diff_hash_multinomial
+      --diff_hash_coarse_top_n        With --diff_hash_coarse_scaled, refit at most this many of the most similar hashes. Default None
+      --hash2kmer_per_group           Find the sequences of all informative hashes of a group in one task that reads each fasta
+                                      only once, instead of one task per hash. Default false
+      --hash2kmer_index               Hash the k-mers of the protein fastas once into an index, so that each per-hash hash2kmer task
+                                      reads only the sequences containing its hash. Default false
+      --profile_scripts               Record the time and peak memory of each stage of the differential hash expression,
+                                      hash2kmer and hash2sig scripts, and add them to the MultiQC report. Default false
 
     Options:
       --single_end [bool]             Specifies that the input is single-end reads
@@ -512,9 +550,32 @@ need_refseq_download = !existing_reference && !params.proteome_search_fasta && p
 /* -   Parse differential hash expression parameters         -- */
 //////////////////////////////////////////////////////////////////
 diff_hash_with_abundance = params.diff_hash_with_abundance
+diff_hash_abundance_transform = params.diff_hash_abundance_transform
 diff_hash_inverse_regularization_strength = params.diff_hash_inverse_regularization_strength
 diff_hash_solver = params.diff_hash_solver
 diff_hash_penalty = params.diff_hash_penalty
+diff_hash_cache_dir = params.diff_hash_cache_dir
+diff_hash_cache_results = params.diff_hash_cache_results
+diff_hash_min_prevalence = params.diff_hash_min_prevalence
+diff_hash_prescreen_top_n = params.diff_hash_prescreen_top_n
+diff_hash_regularization_path = params.diff_hash_regularization_path
+diff_hash_target_informative_hashes = params.diff_hash_target_informative_hashes
+diff_hash_cv_folds = params.diff_hash_cv_folds
+diff_hash_stability_rounds = params.diff_hash_stability_rounds
+diff_hash_stability_cutoff = params.diff_hash_stability_cutoff
+diff_hash_streaming = params.diff_hash_streaming
+diff_hash_multinomial = params.diff_hash_multinomial
+diff_hash_parallel_groups = params.diff_hash_parallel_groups
+diff_hash_collapse_identical_hashes = params.diff_hash_collapse_identical_hashes
+diff_hash_coarse_scaled = params.diff_hash_coarse_scaled
+diff_hash_coarse_top_n = params.diff_hash_coarse_top_n
+profile_scripts = params.profile_scripts
+
+// Profiles of the scripts, for MultiQC. Replaced by the outputs of the
+// processes that run
+ch_diff_hash_profiles = Channel.empty()
+ch_hash2kmer_profiles = Channel.empty()
+ch_hash2sig_profiles = Channel.empty()
 
 ///////////////////////////////////////////////////////////////////////////////
 ///////////////////////////////////////////////////////////////////////////////
@@ -542,9 +603,28 @@ if (params.hashes) summary['Hashes']                                        = pa
 if (using_hashes) summary['sourmash ksize']                                 = params.sourmash_ksize
 if (using_hashes) summary['sourmash molecule']                              = params.sourmash_molecule
 if (params.diff_hash_expression) summary['Diff Hash abundance?']            = params.diff_hash_with_abundance
+if (params.diff_hash_abundance_transform) summary['Diff Hash abundance transform'] = params.diff_hash_abundance_transform
 if (params.diff_hash_expression) summary['Diff Hash C']                     = params.diff_hash_inverse_regularization_strength
 if (params.diff_hash_expression) summary['Diff Hash solver']                = params.diff_hash_solver
 if (params.diff_hash_expression) summary['Diff Hash penalty']               = params.diff_hash_penalty
+if (params.diff_hash_cache_dir) summary['Diff Hash cache dir']              = params.diff_hash_cache_dir
+if (params.diff_hash_cache_results) summary['Diff Hash cache results']      = params.diff_hash_cache_results
+if (params.diff_hash_min_prevalence) summary['Diff Hash min prevalence']    = params.diff_hash_min_prevalence
+if (params.diff_hash_prescreen_top_n) summary['Diff Hash prescreen top N']  = params.diff_hash_prescreen_top_n
+if (params.diff_hash_regularization_path) summary['Diff Hash C path']       = params.diff_hash_regularization_path
+if (params.diff_hash_target_informative_hashes) summary['Diff Hash target informative'] = params.diff_hash_target_informative_hashes
+if (params.diff_hash_cv_folds) summary['Diff Hash CV folds']                = params.diff_hash_cv_folds
+if (params.diff_hash_stability_rounds) summary['Diff Hash stability rounds'] = params.diff_hash_stability_rounds
+if (params.diff_hash_stability_rounds) summary['Diff Hash stability cutoff'] = params.diff_hash_stability_cutoff
+if (params.diff_hash_streaming) summary['Diff Hash streaming']              = params.diff_hash_streaming
+if (params.diff_hash_multinomial) summary['Diff Hash multinomial']          = params.diff_hash_multinomial
+if (params.diff_hash_parallel_groups) summary['Diff Hash parallel groups'] = params.diff_hash_parallel_groups
+if (params.diff_hash_collapse_identical_hashes) summary['Diff Hash collapse identical'] = params.diff_hash_collapse_identical_hashes
+if (params.diff_hash_coarse_scaled) summary['Diff Hash coarse scaled']      = params.diff_hash_coarse_scaled
+if (params.diff_hash_coarse_top_n) summary['Diff Hash coarse top N']        = params.diff_hash_coarse_top_n
+if (params.hash2kmer_per_group) summary['hash2kmer per group']               = params.hash2kmer_per_group
+if (params.hash2kmer_index) summary['hash2kmer index']                       = params.hash2kmer_index
+if (params.profile_scripts) summary['Profile scripts']                      = params.profile_scripts
 if (params.protein_fastas) summary['Input protein fastas']                  = params.protein_fastas
 // How the DIAMOND search database is created
 if (params.proteome_search_fasta) summary['Proteome search ref']            = params.proteome_search_fasta
@@ -1007,52 +1087,197 @@ if (!(params.input_is_protein || params.protein_fastas || params.protein_fasta_p
  if (params.input_is_protein && params.csv && params.diff_hash_expression){
   // No protein fasta provided for searching for orthologs, need to
   // download refseq
-  process diff_hash {
-    tag "${group_cleaned}"
-    label "process_medium"
+  if (params.diff_hash_multinomial || params.diff_hash_parallel_groups) {
+    // All signatures
+    Channel
+      .fromPath(params.csv)
+      .splitCsv(header:true)
+      .map{ row -> file(row.sig, checkIfExists: true) }
+      .collect()
+      .set{ ch_all_signatures_for_diff_hash_all_groups }
+
+    process diff_hash_all_groups {
+      tag "all_groups"
+      label "process_medium"
+
+      publishDir "${params.outdir}/diff_hash/", mode: 'copy'
+
+      input:
+      file(all_signatures) from ch_all_signatures_for_diff_hash_all_groups
+      file metadata from ch_csv.collect()
+
+      output:
+      file("diff_hash_all_groups.log")
+      file("*__hash_coefficients.csv")
+      file("*__hash_coefficients.npz") into ch_hash_coefficients_npz
+      file("*__regularization_path*.csv") optional true
+      file("*__stability_selection.csv") optional true
+      file("*__informative_hashes.txt") into ch_informative_hashes_files_all_groups
+      file("group_file_prefixes.csv") into ch_group_file_prefixes_all_groups
+      file("*_profile.tsv") optional true
+      file("*_profile_mqc.json") optional true into ch_diff_hash_profiles
+
+      script:
+      profile_flag = profile_scripts ? "--profile all_groups__diff_hash" : ''
+      abundance_flag = diff_hash_with_abundance ? '--with-abundance' : ''
+      abundance_transform_flag = diff_hash_with_abundance && diff_hash_abundance_transform ? "--abundance-transform ${diff_hash_abundance_transform}" : ''
+      cache_flag = diff_hash_cache_dir ? "--cache-dir ${diff_hash_cache_dir}" : ''
+      collapse_flag = diff_hash_collapse_identical_hashes ? '--collapse-identical-hashes' : ''
+      mode_flag = diff_hash_multinomial ? '--multinomial' : '--parallel-groups'
+      // Only fitting each group vs the rest supports these
+      min_prevalence_flag = diff_hash_min_prevalence ? "--min-prevalence ${diff_hash_min_prevalence}" : ''
+      prescreen_flag = diff_hash_prescreen_top_n ? "--prescreen-top-n ${diff_hash_prescreen_top_n}" : ''
+      path_flag = diff_hash_regularization_path ? "--regularization-path ${diff_hash_regularization_path.toString().tokenize(',').join(' ')}" : ''
+      target_flag = diff_hash_target_informative_hashes ? "--target-n-informative ${diff_hash_target_informative_hashes}" : ''
+      cv_flag = diff_hash_cv_folds ? "--cv-folds ${diff_hash_cv_folds}" : ''
+      streaming_flag = diff_hash_streaming ? '--streaming' : ''
+      cache_results_flag = diff_hash_cache_dir && diff_hash_cache_results && !diff_hash_stability_rounds && !diff_hash_streaming ? '--cache-results' : ''
+      coarse_flag = diff_hash_coarse_scaled ? "--coarse-scaled ${diff_hash_coarse_scaled}" : ''
+      coarse_top_n_flag = diff_hash_coarse_scaled && diff_hash_coarse_top_n ? "--coarse-top-n ${diff_hash_coarse_top_n}" : ''
+      stability_flag = diff_hash_stability_rounds ? "--stability-rounds ${diff_hash_stability_rounds} --stability-cutoff ${diff_hash_stability_cutoff}" : ''
+      one_vs_rest_flags = diff_hash_multinomial ? '' : [
+        cache_results_flag, min_prevalence_flag, prescreen_flag, path_flag,
+        target_flag, cv_flag, stability_flag, streaming_flag, coarse_flag,
+        coarse_top_n_flag
+      ].join(' ')
+      """
+      differential_hash_expression.py \\
+          --ksize ${sourmash_ksize} \\
+          --input-is-protein \\
+          --n-jobs ${task.cpus} \\
+          ${mode_flag} \\
+          --${sourmash_molecule} \\
+          --no-dna \\
+          --metadata-csv ${metadata} \\
+          --use-sig-basename \\
+          --penalty ${diff_hash_penalty} \\
+          --solver ${diff_hash_solver} \\
+          --max-group-size 100 \\
+          ${abundance_flag} \\
+          ${abundance_transform_flag} \\
+          ${cache_flag} \\
+          ${collapse_flag} \\
+          ${one_vs_rest_flags} \\
+          ${profile_flag} \\
+          --inverse-regularization-strength ${diff_hash_inverse_regularization_strength} \\
+          > diff_hash_all_groups.log
+      """
+    }
+    // The groups by the prefix of their output files, as written by
+    // differential_hash_expression.py
+    ch_group_file_prefixes_all_groups
+      .splitCsv(header:true)
+      // [prefix: 'gamma_cell', group: 'gamma cell']
+      .map{ row -> tuple(row.prefix, row.group) }
+      .set{ ch_file_prefix_to_group }
+    ch_informative_hashes_files_all_groups
+      .flatten()
+      // alpha__informative_hashes.txt
+      .map{ it -> tuple(it.name - ~/__informative_hashes.txt$/, it) }
+      // ['alpha', alpha__informative_hashes.txt]
+      .join(ch_file_prefix_to_group)
+      // ['alpha', alpha__informative_hashes.txt, 'Alpha']
+      .map{ it -> tuple(it[2], it[1]) }
+      .set{ ch_informative_hashes_files_for_hash2kmer }
+  } else {
+    process diff_hash {
+      tag "${group_cleaned}"
+      label "process_medium"
+
+      publishDir "${params.outdir}/diff_hash/${group}", mode: 'copy'
+
+      input:
+      set val(group), file(all_signatures) from ch_groups_with_all_signatures_for_diff_hash
+      file metadata from ch_csv.collect()
+
+      output:
+      file("${group_cleaned}.log")
+      file("*__hash_coefficients.csv")
+      file("*__hash_coefficients.npz") into ch_hash_coefficients_npz
+      file("*__regularization_path*.csv") optional true
+      file("*__stability_selection.csv") optional true
+      set val(group), file("*__informative_hashes.txt") into ch_informative_hashes_files_for_hash2kmer
+      file("*_profile.tsv") optional true
+      file("*_profile_mqc.json") optional true into ch_diff_hash_profiles
+
+      script:
+      group_cleaned = groupCleaner(group)
+      profile_flag = profile_scripts ? "--profile ${group_cleaned}__diff_hash" : ''
+      abundance_flag = diff_hash_with_abundance ? '--with-abundance' : ''
+      abundance_transform_flag = diff_hash_with_abundance && diff_hash_abundance_transform ? "--abundance-transform ${diff_hash_abundance_transform}" : ''
+      cache_flag = diff_hash_cache_dir ? "--cache-dir ${diff_hash_cache_dir}" : ''
+      min_prevalence_flag = diff_hash_min_prevalence ? "--min-prevalence ${diff_hash_min_prevalence}" : ''
+      prescreen_flag = diff_hash_prescreen_top_n ? "--prescreen-top-n ${diff_hash_prescreen_top_n}" : ''
+      path_flag = diff_hash_regularization_path ? "--regularization-path ${diff_hash_regularization_path.toString().tokenize(',').join(' ')}" : ''
+      target_flag = diff_hash_target_informative_hashes ? "--target-n-informative ${diff_hash_target_informative_hashes}" : ''
+      cv_flag = diff_hash_cv_folds ? "--cv-folds ${diff_hash_cv_folds}" : ''
+      streaming_flag = diff_hash_streaming ? '--streaming' : ''
+      collapse_flag = diff_hash_collapse_identical_hashes ? '--collapse-identical-hashes' : ''
+      cache_results_flag = diff_hash_cache_dir && diff_hash_cache_results && !diff_hash_stability_rounds && !diff_hash_streaming ? '--cache-results' : ''
+      coarse_flag = diff_hash_coarse_scaled ? "--coarse-scaled ${diff_hash_coarse_scaled}" : ''
+      coarse_top_n_flag = diff_hash_coarse_scaled && diff_hash_coarse_top_n ? "--coarse-top-n ${diff_hash_coarse_top_n}" : ''
+      stability_flag = diff_hash_stability_rounds ? "--stability-rounds ${diff_hash_stability_rounds} --stability-cutoff ${diff_hash_stability_cutoff}" : ''
+      """
+      differential_hash_expression.py \\
+          --ksize ${sourmash_ksize} \\
+          --input-is-protein \\
+          --n-jobs ${task.cpus} \\
+          --group1 '${group}' \\
+          --${sourmash_molecule} \\
+          --no-dna \\
+          --metadata-csv ${metadata} \\
+          --use-sig-basename \\
+          --penalty ${diff_hash_penalty} \\
+          --solver ${diff_hash_solver} \\
+          --max-group-size 100 \\
+          ${abundance_flag} \\
+          ${abundance_transform_flag} \\
+          ${cache_flag} \\
+          ${cache_results_flag} \\
+          ${min_prevalence_flag} \\
+          ${prescreen_flag} \\
+          ${path_flag} \\
+          ${target_flag} \\
+          ${cv_flag} \\
+          ${stability_flag} \\
+          ${streaming_flag} \\
+          ${collapse_flag} \\
+          ${coarse_flag} \\
+          ${coarse_top_n_flag} \\
+          ${profile_flag} \\
+          --inverse-regularization-strength ${diff_hash_inverse_regularization_strength} \\
+          > '${group_cleaned}.log'
+      """
+    }
+  }
+  // One table of the coefficients of all groups, instead of a file per group
+  process combine_hash_coefficients {
+    tag "all_groups"
+    label "process_low"
 
-    publishDir "${params.outdir}/diff_hash/${group}", mode: 'copy'
+    publishDir "${params.outdir}/diff_hash/", mode: 'copy'
 
     input:
-    set val(group), file(all_signatures) from ch_groups_with_all_signatures_for_diff_hash
-    file metadata from ch_csv.collect()
+    file(coefficients) from ch_hash_coefficients_npz.collect()
 
     output:
-    file("${group_cleaned}.log")
-    file("*__hash_coefficients.csv")
-    set val(group), file("*__informative_hashes.txt") into ch_informative_hashes_files
+    file("hash_group_coefficients.csv") into ch_hash_group_coefficients
 
     script:
-    group_cleaned = groupCleaner(group)
-    abundance_flag = diff_hash_with_abundance ? '--with-abundance' : ''
     """
-    differential_hash_expression.py \\
-        --ksize ${sourmash_ksize} \\
-        --input-is-protein \\
-        --n-jobs ${task.cpus} \\
-        --group1 '${group}' \\
-        --${sourmash_molecule} \\
-        --no-dna \\
-        --metadata-csv ${metadata} \\
-        --use-sig-basename \\
-        --penalty ${diff_hash_penalty} \\
-        --solver ${diff_hash_solver} \\
-        --max-group-size 100 \\
-        ${abundance_flag} \\
-        --inverse-regularization-strength ${diff_hash_inverse_regularization_strength} \\
-        > '${group_cleaned}.log'
+    combine_hash_coefficients.py \\
+        --output hash_group_coefficients.csv \\
+        ${coefficients}
     """
   }
-  ch_informative_hashes_files
-      .dump(tag: 'ch_informative_hashes_files')
-      // [group_name, text_file]
-      .map{ it -> tuple(it[1].splitText(), it[0])}
-      // [['123\n', '456\n', '789\n'], group]
-      .dump(tag: 'ch_informative_hashes_files_split')
-      .transpose()
-      // ['123\n', group]
-      // ['456\n', group]
-      // ['789\n', group]
+  ch_hash_group_coefficients
+      .splitCsv(header: true)
+      // [hash: '123', group: group, coefficient: '0.5', informative: '1']
+      .filter{ row -> row.informative == '1' }
+      .map{ row -> tuple(row.hash, row.group) }
+      // ['123', group]
+      // ['456', group]
+      // ['789', group]
       .dump(tag: 'ch_hash_to_group')
       .into {
         ch_hash_to_group_for_finding_matches
@@ -1064,7 +1289,9 @@ if (!(params.input_is_protein || params.protein_fastas || params.protein_fasta_p
   ch_hash_to_group_for_finding_matches
     .map{ it -> it[0] }
     .unique()
-    .into{ ch_informative_hashes_flattened }
+    // All informative hashes of all groups, one per line
+    .collectFile(name: 'informative_hashes.txt', newLine: true)
+    .into{ ch_informative_hashes_for_finding_matches }
 
 
   ///////////////////////////////////////////////////////////////////////////////
@@ -1078,25 +1305,32 @@ if (!(params.input_is_protein || params.protein_fastas || params.protein_fasta_p
   * STEP 7 - Find signatures containing hashes
   */
   process sigs_with_hash {
-    tag "${hash_id}"
+    tag "all_informative_hashes"
     label "process_low"
 
     publishDir "${params.outdir}/diff_hash/sigs_with_hash", mode: 'copy'
 
     input:
-    val(hash) from ch_informative_hashes_flattened
+    file(hashes) from ch_informative_hashes_for_finding_matches
     file(sigs) from ch_all_signatures_flattened_for_finding_matches
 
     output:
     file("*__matches.txt")
 
     script:
-    hash_cleaned = hashCleaner(hash)
-    hash_id = "hash-${hash_cleaned}"
-    matches = "${hash_id}__matches.txt"
+    cache_flag = diff_hash_cache_dir ? "--cache-dir ${diff_hash_cache_dir}" : ''
     """
-    rg --threads ${task.cpus} --files-with-matches ${hash_cleaned} ${sigs} \\
-      > ${matches}
+    sig_hash_index.py build \\
+        --ksize ${sourmash_ksize} \\
+        --${sourmash_molecule} \\
+        --no-dna \\
+        ${cache_flag} \\
+        --output sig_hash_index \\
+        ${sigs}
+    sig_hash_index.py query \\
+        --index sig_hash_index \\
+        --output-dir . \\
+        ${hashes}
     """
   }
 }
@@ -1147,24 +1381,39 @@ if (params.hashes) {
   ch_protein_fastas
     .map{ it -> it[1] }  // get only the file, not the sample id
     .collect()           // make a single flat list
-    .map{ it -> [it] }   // Nest within a list so the next step does what I want
-    .set{ ch_protein_fastas_flat_list }
+    // ["hash", ["a", "b", "c"]], keyed like the hashes to combine them
+    .map{ it -> tuple("hash", it) }
+    .set{ ch_fastas_for_kmer_index }
 
   ch_hashes_for_hash2kmer
-      .combine( ch_protein_fastas_flat_list )
-      .set { ch_hashes_with_fastas_for_hash2kmer }
-      // Desired output:
+      .map{ it -> tuple("hash", it) }
+      .set { ch_hashes_with_key_for_hash2kmer }
+      // Desired output, after adding the fastas:
       // [1, ["a", "b", "c"]]
       // [2, ["a", "b", "c"]]
       // [3, ["a", "b", "c"]]
       // 1, 2, 3 = hashes
       // "a", "b", "c" = protein fasta files
+} else if (params.diff_hash_expression && params.hash2kmer_per_group) {
+  // Search all informative hashes of a group in one pass over its fastas
+  ch_informative_hashes_files_for_hash2kmer
+    .join( ch_group_to_fasta )
+    // [group, informative_hashes.txt, [fasta1, fasta2, ...]]
+    .dump( tag: 'ch_informative_hashes_with_fastas_for_hash2kmer' )
+    .set{ ch_informative_hashes_with_fastas_for_hash2kmer }
+
+  ch_hash_to_group_for_hash2sig
+    .map{ it -> it[0] }
+    .into{ ch_hashes_for_hash2sig }
 } else if (params.diff_hash_expression) {
 
+  ch_group_to_fasta
+    .set{ ch_fastas_for_kmer_index }
+
   ch_hash_to_group_for_hash2kmer
-    .join( ch_group_to_fasta )
-    .dump( tag: 'group_to_hashes_for_hash2kmer__combine__ch_group_to_fasta' )
-    .into{ ch_hashes_with_fastas_for_hash2kmer }
+    // ['123', group] -> [group, '123']
+    .map{ it -> tuple(it[1], it[0]) }
+    .set{ ch_hashes_with_key_for_hash2kmer }
 
   ch_hash_to_group_for_hash2sig
     .map{ it -> it[0] }
@@ -1182,7 +1431,90 @@ if (params.hashes) {
  * STEP 4 - convert hashes to k-mers & sequences -- but only needed for diamond search
  */
  do_hash2kmer = params.diff_hash_expression || params.hashes || params.do_featurecounts_orthology
- if (do_hash2kmer) {
+ if (do_hash2kmer && params.diff_hash_expression && params.hash2kmer_per_group) {
+  process hash2kmer_per_group {
+    tag "${group_cleaned}"
+    label "process_medium"
+
+    publishDir "${params.outdir}/hash2kmer/${group_cleaned}", mode: 'copy'
+
+    input:
+    set val(group), file(informative_hashes), file(peptide_fastas) from ch_informative_hashes_with_fastas_for_hash2kmer
+
+    output:
+    file("*__kmer.txt")
+    set val(group), file("*__sequences.fasta") into ch_group_seqs_from_hash2kmer
+    file("*_profile.tsv") optional true
+    file("*_profile_mqc.json") optional true into ch_hash2kmer_profiles
+
+    script:
+    group_cleaned = groupCleaner(group)
+    first_flag = params.do_featurecounts_orthology ? '' : '--first'
+    profile_flag = profile_scripts ? "--profile ${group_cleaned}__hash2kmer" : ''
+    """
+    hash2kmer.py \\
+        --ksize ${sourmash_ksize} \\
+        --no-dna \\
+        --input-is-protein \\
+        --output-dir . \\
+        --processes ${task.cpus} \\
+        --${sourmash_molecule} \\
+        ${first_flag} \\
+        ${profile_flag} \\
+        ${informative_hashes} \\
+        ${peptide_fastas}
+    """
+  }
+
+  ch_group_seqs_from_hash2kmer
+    // A single output file is not wrapped in a list
+    .map{ it -> tuple(it[0], it[1] instanceof List ? it[1] : [it[1]]) }
+    .transpose()
+    // [group, hash-123__sequences.fasta]
+    .map{ it -> tuple(it[1].name - ~/^hash-/ - ~/__sequences.fasta$/, it[0], it[1]) }
+    // ['123', group, hash-123__sequences.fasta]
+    .dump(tag: 'ch_group_seqs_from_hash2kmer')
+    .set{ ch_protein_seq_for_diamond }
+ } else if (do_hash2kmer) {
+  if (params.hash2kmer_index) {
+    // Hash the k-mers of the fastas of each group once, so that every
+    // hash2kmer task reads only the records containing its hash
+    process kmer_index {
+      tag "${key_cleaned}"
+      label "process_medium"
+
+      input:
+      set val(key), file(peptide_fastas) from ch_fastas_for_kmer_index
+
+      output:
+      set val(key), file(peptide_fastas), file(index) into ch_fastas_with_kmer_index
+
+      script:
+      key_cleaned = groupCleaner(key)
+      index = "${key_cleaned}__kmer_index"
+      """
+      kmer_index.py \\
+          --ksize ${sourmash_ksize} \\
+          --no-dna \\
+          --input-is-protein \\
+          --${sourmash_molecule} \\
+          --output ${index} \\
+          ${peptide_fastas}
+      """
+    }
+  } else {
+    ch_fastas_for_kmer_index
+      .map{ it -> tuple(it[0], it[1], []) }
+      .set{ ch_fastas_with_kmer_index }
+  }
+
+  ch_hashes_with_key_for_hash2kmer
+    .combine( ch_fastas_with_kmer_index, by: 0 )
+    // [group, hash, [fasta1, fasta2, ...], kmer_index]
+    .map{ it -> tuple(it[1], it[2], it[3]) }
+    .dump( tag: 'ch_hashes_with_fastas_for_hash2kmer' )
+    .set{ ch_hashes_with_fastas_for_hash2kmer }
+
   // No protein fasta provided for searching for orthologs, need to
   // download refseq
   process hash2kmer {
@@ -1192,12 +1524,14 @@ if (params.hashes) {
     publishDir "${params.outdir}/hash2kmer/${hash_id}", mode: 'copy'
 
     input:
-    tuple val(hash), file(peptide_fastas) from ch_hashes_with_fastas_for_hash2kmer
+    tuple val(hash), file(peptide_fastas), file(kmer_index) from ch_hashes_with_fastas_for_hash2kmer
 
     output:
     file(kmers)
     set val(hash), file(sequences) into ch_seqs_from_hash2kmer, ch_seqs_from_hash2kmer_to_print, ch_seqs_from_hash2kmer_for_bam_of_hashes
     set val(hash), val(hash_id), file(sequences) into ch_seqs_with_hashes_for_filter_unaligned_reads, ch_seqs_with_hashes_for_bam_of_hashes
+    file("*_profile.tsv") optional true
+    file("*_profile_mqc.json") optional true into ch_hash2kmer_profiles
 
     script:
     hash_cleaned = hashCleaner(hash)
@@ -1205,6 +1539,8 @@ if (params.hashes) {
     kmers = "${hash_id}__kmer.txt"
     sequences = "${hash_id}__sequences.fasta"
     first_flag = params.do_featurecounts_orthology ? '' : '--first'
+    profile_flag = profile_scripts ? "--profile ${hash_id}__hash2kmer" : ''
+    index_flag = kmer_index ? "--index ${kmer_index}" : ''
     """
     echo ${hash_cleaned} >> hash.txt
     hash2kmer.py \\
@@ -1215,6 +1551,8 @@ if (params.hashes) {
         --output-kmers ${kmers} \\
         --${sourmash_molecule} \\
         ${first_flag} \\
+        ${profile_flag} \\
+        ${index_flag} \\
         hash.txt \\
         ${peptide_fastas}
     """
@@ -1384,43 +1722,55 @@ if (params.protein_searcher == 'sourmash'){
     // No protein fasta provided for searching for orthologs, need to
     // download refseq
     process hash2sig {
-      tag "${hash_id}"
+      tag "all_hashes"
       label "process_low"
 
       publishDir "${params.outdir}/hash2sig/", mode: 'copy'
 
       input:
-      val(hash) from ch_hashes_for_hash2sig
+      file(hashes) from ch_hashes_for_hash2sig
+        .map{ it -> hashCleaner(it) }
+        .unique()
+        .collectFile(name: 'hashes.txt', newLine: true)
 
       output:
-      set val(hash), val(hash_id), file("${sig}") into ch_hash_sigs_from_hash2sig_to_print, ch_hash_sigs_from_hash2sig_to_join
+      file("hash-*.sig") into ch_hash_sigs_from_hash2sig
+      file("*_profile.tsv") optional true
+      file("*_profile_mqc.json") optional true into ch_hash2sig_profiles
 
       script:
-      hash_cleaned = hashCleaner(hash)
-      hash_id = "hash-${hash_cleaned}"
-      sig = "${hash_id}.sig"
+      profile_flag = profile_scripts ? "--profile all_hashes__hash2sig" : ''
       """
-      echo ${hash_cleaned} >> hash.txt
       hash2sig.py \\
           --ksize ${sourmash_ksize} \\
           --no-dna \\
           --scaled 1 \\
           --input-is-protein \\
           --${sourmash_molecule} \\
-          --output ${sig} \\
-          hash.txt
+          --per-hash \\
+          --output-dir . \\
+          ${profile_flag} \\
+          ${hashes}
       """
     }
+    ch_hash_sigs_from_hash2sig
+      .flatten()
+      // hash-4406535782145158631.sig
+      .map{ it -> tuple(it.baseName - ~/^hash-/, it.baseName, it) }
+      // ['4406535782145158631', hash-4406535782145158631, hash-4406535782145158631.sig]
+      .into{ ch_hash_sigs_from_hash2sig_to_print; ch_hash_sigs_from_hash2sig_to_join }
     ch_hash_sigs_from_hash2sig_to_print.dump(tag: 'ch_hash_sigs_from_hash2sig_to_print')
 
     ch_hash_to_group_for_joining_after_hash2sig
+      // Join on the cleaned hash, as in the signature filenames
+      .map{ it -> tuple(hashCleaner(it[0]), it[0], it[1]) }
       .join( ch_hash_sigs_from_hash2sig_to_join )
       // [DUMP: ch_hash_to_group_for_joining_after_hash2sig__ch_hash_sigs_from_hash2sig_to_join]
-      // ['4406535782145158631\n', 'monocyte', hash-4406535782145158631, hash-4406535782145158631.sig]
+      // ['4406535782145158631', '4406535782145158631', 'monocyte', hash-4406535782145158631, hash-4406535782145158631.sig]
       .dump( tag: 'ch_hash_to_group_for_joining_after_hash2sig__ch_hash_sigs_from_hash2sig_to_join' )
-      .map{ it -> tuple(it[1], it[0], it[2], it[3]) }
+      .map{ it -> tuple(it[2], it[1], it[3], it[4]) }
       .dump( tag: 'ch_group_to_hash_sig' )
-      // ['monocyte', '4406535782145158631\n', hash-4406535782145158631, hash-4406535782145158631.sig]
+      // ['monocyte', '4406535782145158631', hash-4406535782145158631, hash-4406535782145158631.sig]
       .set{ ch_group_to_hash_sig }
   }
 
@@ -1477,30 +1827,53 @@ if (params.protein_searcher == 'sourmash'){
     file(reference_proteome_sig) from ch_proteome_sig_for_sourmash_index.collect()
 
     output:
-    set file(".sbt*"), file("*.sbt.json") into ch_sourmash_index
+    file(index) into ch_sourmash_index
 
     script:
-    sketch_id = "molecule-${sourmash_molecule}__ksize-${sourmash_ksize}__scaled-1__track_abundance-true"
+    index = "${reference_proteome_sig.simpleName}__hash_index"
     """
-    sourmash index \\
+    sig_hash_index.py build \\
+        --by-signature \\
         --ksize ${sourmash_ksize} \\
         --${sourmash_molecule} \\
-        ${reference_proteome_sig.simpleName} \\
+        --no-dna \\
+        --output ${index} \\
         ${reference_proteome_sig}
     """
   }
 
   if ( params.csv_has_is_aligned ) {
-    ch_per_group_unaligned_sig
+    process unaligned_sig_hash_index {
+      tag "${group_cleaned}"
+      label "process_low"
+
+      input:
+      set val(group), file(group_unaligned_sigs) from ch_per_group_unaligned_sig
+
+      output:
+      set val(group), file(index) into ch_per_group_unaligned_sig_hash_index
+
+      script:
+      group_cleaned = groupCleaner(group)
+      index = "${group_cleaned}__sig_hash_index"
+      cache_flag = diff_hash_cache_dir ? "--cache-dir ${diff_hash_cache_dir}" : ''
+      """
+      sig_hash_index.py build \\
+          --ksize ${sourmash_ksize} \\
+          --${sourmash_molecule} \\
+          --no-dna \\
+          ${cache_flag} \\
+          --output ${index} \\
+          ${group_unaligned_sigs}
+      """
+    }
+
+    ch_per_group_unaligned_sig_hash_index
       .join( ch_group_to_hash_sig )
       // [DUMP: ch_group_to_hash_sig]
       // ['monocyte',
-      //  [10X_P1_14__unaligned__GACTAACAGCATGGCA_molecule-dayhoff_ksize-45_log2sketchsize-14_trackabundance-true.sig,
-      //   10X_P1_14__unaligned__AACTGGTAGGTTCCTA_molecule-dayhoff_ksize-45_log2sketchsize-14_trackabundance-true.sig,
-      //   10X_P1_14__unaligned__CTAATGGCAGCATACT_molecule-dayhoff_ksize-45_log2sketchsize-14_trackabundance-true.sig,
-      //   10X_P1_14__unaligned__ACACCCTGTAGCGTGA_molecule-dayhoff_ksize-45_log2sketchsize-14_trackabundance-true.sig,
-      //   MACA_18m_M_LUNG_53__unaligned__TAAGTGCAGTGTCCCG_molecule-dayhoff_ksize-45_log2sketchsize-14_trackabundance-true.sig],
-      // '2852067181280790833\n',
+      //  monocyte__sig_hash_index,
+      // '2852067181280790833',
       //  hash-2852067181280790833,
       //  hash-2852067181280790833.sig]
       .dump( tag: 'ch_group_to_hash_sig_with_group_unaligned_sigs' )
@@ -1523,7 +1896,7 @@ if (params.protein_searcher == 'sourmash'){
       publishDir "${params.outdir}/is_hash_in_unaligned", mode: 'copy'
 
       input:
-      set val(group), file(group_unaligned_sigs), val(hash), val(hash_id), file(query_sig) from ch_group_to_hash_sig_with_group_unaligned_sigs
+      set val(group), file(group_unaligned_index), val(hash), val(hash_id), file(query_sig) from ch_group_to_hash_sig_with_group_unaligned_sigs
 
       output:
       set val(group), val(hash), val(hash_id), file(query_sig), file(matches) into ch_hash_sigs_in_unaligned
@@ -1534,7 +1907,11 @@ if (params.protein_searcher == 'sourmash'){
       sample_id = "${group_cleaned}__${hash_id}"
       matches = "${sample_id}__matches.txt"
       """
-      rg --files-with-matches ${hash_cleaned} ${group_unaligned_sigs} > ${matches}
+      echo ${hash_cleaned} > hash.txt
+      sig_hash_index.py query \\
+          --index ${group_unaligned_index} \\
+          --prefix ${group_cleaned}__ \\
+          hash.txt
       """
     }
     ch_hash_sigs_in_unaligned
@@ -1569,25 +1946,25 @@ if (params.protein_searcher == 'sourmash'){
    publishDir "${params.outdir}/sourmash/search", mode: 'copy'
 
    input:
-   set file(sbt_hidden_files), file(reference_sbt_json) from ch_sourmash_index.collect()
-   set val(group), val(hash), val(hash_id), file(query_sig) from ch_group_hash_sigs_to_query
+   file(reference_hash_index) from ch_sourmash_index.collect()
+   set val(group), val(hashes) from ch_group_hash_sigs_to_query
+     .map{ it -> tuple(it[0], hashCleaner(it[1])) }
+     .groupTuple()
 
    output:
-   file("${csv_output}")
+   file("*.csv")
 
    script:
    group_cleaned = groupCleaner(group)
-   csv_output = "${group_cleaned}__${hash_id}.csv"
-   sketch_id = "molecule-${sourmash_molecule}__ksize-${sourmash_ksize}__scaled-1__track_abundance-true"
+   // Same csv as "sourmash search --containment" of each hash signature,
+   // written to ${group_cleaned}__hash-<hash>.csv
    """
-   sourmash search \\
-       --containment \\
-       --threshold 1e-100 \\
-       --output ${csv_output} \\
-       --ksize ${sourmash_ksize} \\
-       --${sourmash_molecule} \\
-       ${query_sig} \\
-       ${reference_sbt_json}
+   printf '%s\\n' ${hashes.join(' ')} > hashes.txt
+   sig_hash_index.py query \\
+       --csv \\
+       --index ${reference_hash_index} \\
+       --prefix ${group_cleaned}__ \\
+       hashes.txt
    """
  }
 
@@ -1702,6 +2079,7 @@ process multiqc {
     file ('fastqc/*') from ch_fastqc_results.collect().ifEmpty([])
     file ('software_versions/*') from ch_software_versions_yaml.collect()
     file ("fastp/*") from ch_fastp_results.collect().ifEmpty([])
+    file ('profiles/*') from ch_diff_hash_profiles.mix(ch_hash2kmer_profiles, ch_hash2sig_profiles).collect().ifEmpty([])
     file workflow_summary from create_workflow_summary(summary)
 
     output:
@@ -1715,7 +2093,7 @@ process multiqc {
     custom_config_file = params.multiqc_config ? "--config $mqc_custom_config" : ''
     // TODO nf-core: Specify which MultiQC modules to use with -m for a faster run time
     """
-    multiqc -f $rtitle $rfilename $custom_config_file -m fastqc -m fastp .
+    multiqc -f $rtitle $rfilename $custom_config_file -m fastqc -m fastp -m custom_content .
     touch multiqc_report.html multiqc_plots _data
     """
 }